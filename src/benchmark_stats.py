@@ -0,0 +1,17 @@
+from __future__ import print_function
+
+import math
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of values using the nearest rank."""
+    values = sorted(values)
+    rank = max(int(math.ceil(q / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def summary(values):
+    return {
+        "median": percentile(values, 50),
+        "p95": percentile(values, 95),
+    }
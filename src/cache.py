@@ -0,0 +1,135 @@
+from __future__ import print_function
+
+import json
+import sqlite3
+from collections import OrderedDict
+
+from sage.algebras.quatalg.quaternion_algebra import quaternion_algebra_cython
+from sage.arith.misc import gcd
+from sage.rings.rational_field import QQ
+
+
+def lattice_key(basis):
+    """Returns a string that only depends on the Z-span of basis.
+
+    The basis is written as Z/d with Z an integer matrix. The key is d and
+    the Hermite normal form of Z, with the common factor of d and the
+    entries removed, so any basis of an ideal or order gives the same key.
+    """
+    Z, d = (quaternion_algebra_cython.
+            integral_matrix_and_denom_from_rational_quaternions(list(basis)))
+    H = Z.hermite_form(include_zero_rows=False)
+    entries = H.list()
+    g = gcd([d] + entries)
+    return "%s/%s" % (d // g, ",".join(str(x // g) for x in entries))
+
+
+def cache_key(kind, lattices, B, ell=None, D=None):
+    """Returns the key under which a result of kind is stored.
+
+    Args:
+        kind: The name of the function the result is from.
+        lattices: The ideals or orders the result depends on.
+        B: The quaternion algebra they are in.
+        ell: The prime ell, if the result depends on it.
+        D: The index D, if the result depends on it.
+    """
+    a, b = B.invariants()
+    return "%s|%s,%s|ell=%s|D=%s|%s" % (
+        kind,
+        a,
+        b,
+        ell,
+        D,
+        "|".join(lattice_key(L.basis()) for L in lattices),
+    )
+
+
+def encode_elements(elements):
+    """Returns a string holding the coefficients of elements."""
+    return json.dumps(
+        [[str(c) for c in x.coefficient_tuple()] for x in elements]
+    )
+
+
+def decode_elements(value, B):
+    """Returns the elements of B that encode_elements encoded in value."""
+    return [B([QQ(c) for c in coeffs]) for coeffs in json.loads(value)]
+
+
+class MemoryCache(object):
+    """A cache of results in memory that keeps the most recently used ones.
+
+    Both this class and SqliteCache map the strings cache_key returns to the
+    strings encode_elements returns, and count their hits and misses.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the value stored under key or None."""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class SqliteCache(object):
+    """A cache of results in an sqlite database, so they outlive the process.
+
+    Args:
+        path: The file of the database. It is created if it does not exist.
+            ":memory:" gives a database that only lives as long as the
+            object.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the value stored under key or None."""
+        row = self.connection.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,59 @@
+from __future__ import print_function
+
+import unittest
+
+from sage.all import *
+from cache import MemoryCache
+from cache import SqliteCache
+from cache import cache_key
+from cache import decode_elements
+from cache import encode_elements
+from cache import lattice_key
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_lattice_key(self):
+        B = QuaternionAlgebra(59)
+        O = B.maximal_order()
+        basis = list(O.basis())
+        other = [basis[0] + 3 * basis[1], basis[1], basis[2] - basis[3],
+                 basis[3]]
+        self.assertEqual(lattice_key(basis), lattice_key(other))
+        self.assertNotEqual(
+            lattice_key(basis), lattice_key([2 * x for x in basis])
+        )
+        I = O.left_ideal(basis).scale(2)
+        self.assertNotEqual(
+            cache_key("f", [I], B, 2, 4), cache_key("f", [I], B, 3, 4)
+        )
+
+    def test_encode_elements(self):
+        B = QuaternionAlgebra(59)
+        i, j, k = B.gens()
+        elements = [1 + i / 2, 3 * j - k / 7]
+        self.assertEqual(
+            decode_elements(encode_elements(elements), B), elements
+        )
+
+    def test_memory_cache(self):
+        cache = MemoryCache(max_size=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        self.assertEqual(cache.get("a"), "1")
+        cache.put("c", "3")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_sqlite_cache(self):
+        with SqliteCache(":memory:") as cache:
+            self.assertEqual(cache.get("a"), None)
+            cache.put("a", "1")
+            cache.put("a", "2")
+            self.assertEqual(cache.get("a"), "2")
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+from __future__ import print_function
+
+import threading
+from time import monotonic
+
+
+class SearchAborted(Exception):
+    """Raised by a search that ran out of budget or was cancelled.
+
+    Attributes:
+        reason: "cancelled", "deadline" or "iterations".
+        stage: The name of the search that was aborted, for example
+            "strong_approximation".
+        stats: The statistics the search had collected so far, in the same
+            form as the stats argument of the search, or None.
+    """
+
+    def __init__(self, reason, stage=None, stats=None):
+        super(SearchAborted, self).__init__(
+            "%s aborted: %s" % (stage or "search", reason)
+        )
+        self.reason = reason
+        self.stage = stage
+        self.stats = stats
+
+    def __reduce__(self):
+        # So that it keeps its attributes when it is sent between processes.
+        return (SearchAborted, (self.reason, self.stage, self.stats))
+
+
+class CancellationToken(object):
+    """A flag that a caller sets to ask the searches to stop.
+
+    Args:
+        event: The object holding the flag. It needs is_set() and set(). If
+            None, a threading.Event is used, which works for threads and
+            asyncio tasks. A supervisor of a process pool can pass the
+            Event of a multiprocessing.Manager() instead, which can be sent
+            to the workers.
+    """
+
+    def __init__(self, event=None):
+        self.event = threading.Event() if event is None else event
+
+    def cancel(self):
+        self.event.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+
+class Budget(object):
+    """Limits on the work the searches in kplt.py may do.
+
+    The searches call check() once per candidate they try. It raises
+    SearchAborted as soon as the token is cancelled, the deadline has passed
+    or the total number of checks is above max_iterations. A budget is meant
+    to be passed to a single call of ell_power_equiv, all the stages it runs
+    share it.
+
+    Args:
+        timeout: If not None, the number of seconds from now until the
+            deadline.
+        deadline: If not None, the deadline as a value of time.monotonic().
+            If both are given, the earlier one is used.
+        max_iterations: If not None, the maximum number of candidates all
+            searches together may try.
+        token: If not None, a CancellationToken.
+    """
+
+    def __init__(
+        self, timeout=None, deadline=None, max_iterations=None, token=None
+    ):
+        if timeout is not None:
+            timed = monotonic() + timeout
+            deadline = timed if deadline is None else min(deadline, timed)
+        self.deadline = deadline
+        self.max_iterations = max_iterations
+        self.token = token
+        self.iterations = 0
+
+    def remaining(self):
+        """Returns the number of seconds until the deadline or None."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - monotonic(), 0.0)
+
+    def expired(self):
+        """Returns the reason the budget is used up, or None if it is not."""
+        if self.token is not None and self.token.is_cancelled():
+            return "cancelled"
+        if self.deadline is not None and monotonic() >= self.deadline:
+            return "deadline"
+        if (
+            self.max_iterations is not None
+            and self.iterations > self.max_iterations
+        ):
+            return "iterations"
+        return None
+
+    def for_task(self):
+        """Returns the part of this budget that a task on an executor checks.
+
+        It has the same deadline and token but no max_iterations, the caller
+        counts the tasks against those. time.monotonic() is the same clock in
+        all processes of a machine, so the deadline holds in the workers
+        too. A token backed by a threading.Event cannot be sent to another
+        process, and is only checked by the caller between tasks, so it is
+        left out. The Event of a multiprocessing.Manager() is kept, so
+        cancelling it stops the tasks that are running.
+        """
+        token = self.token
+        if token is not None and isinstance(token.event, threading.Event):
+            token = None
+        return Budget(deadline=self.deadline, token=token)
+
+    def check(self, stage, stats=None):
+        """Counts one iteration of stage and raises if the budget is used up.
+
+        Args:
+            stage: The name of the search.
+            stats: A dict or a function that returns one. It is only called
+                if the search is aborted, and the result is attached to the
+                exception.
+        """
+        self.iterations += 1
+        reason = self.expired()
+        if reason is not None:
+            if callable(stats):
+                stats = stats()
+            raise SearchAborted(reason, stage, stats)
+
+
+def check_budget(budget, stage, stats=None):
+    """Calls budget.check(stage, stats) unless budget is None."""
+    if budget is not None:
+        budget.check(stage, stats)
@@ -0,0 +1,72 @@
+from __future__ import print_function
+
+import multiprocessing
+import pickle
+import unittest
+from time import monotonic
+
+from cancellation import Budget
+from cancellation import CancellationToken
+from cancellation import SearchAborted
+from cancellation import check_budget
+
+
+class BudgetTest(unittest.TestCase):
+
+    def test_iterations(self):
+        budget = Budget(max_iterations=3)
+        for _ in range(3):
+            budget.check("search")
+        with self.assertRaises(SearchAborted) as cm:
+            budget.check("search", lambda: {"candidates": 3})
+        self.assertEqual(cm.exception.reason, "iterations")
+        self.assertEqual(cm.exception.stage, "search")
+        self.assertEqual(cm.exception.stats, {"candidates": 3})
+        copy = pickle.loads(pickle.dumps(cm.exception))
+        self.assertEqual(
+            (copy.reason, copy.stage, copy.stats),
+            ("iterations", "search", {"candidates": 3}),
+        )
+
+    def test_deadline(self):
+        budget = Budget(timeout=60, deadline=monotonic() - 1)
+        self.assertEqual(budget.remaining(), 0.0)
+        with self.assertRaises(SearchAborted) as cm:
+            budget.check("search")
+        self.assertEqual(cm.exception.reason, "deadline")
+        self.assertTrue(Budget(timeout=60).remaining() > 0)
+        self.assertEqual(Budget().remaining(), None)
+
+    def test_token(self):
+        token = CancellationToken()
+        budget = Budget(token=token)
+        budget.check("search")
+        token.cancel()
+        self.assertTrue(token.is_cancelled())
+        with self.assertRaises(SearchAborted) as cm:
+            check_budget(budget, "search")
+        self.assertEqual(cm.exception.reason, "cancelled")
+        check_budget(None, "search")
+
+    def test_for_task(self):
+        budget = Budget(
+            timeout=60, max_iterations=3, token=CancellationToken()
+        )
+        task_budget = budget.for_task()
+        self.assertEqual(task_budget.deadline, budget.deadline)
+        self.assertEqual(task_budget.max_iterations, None)
+        # A threading.Event only exists in this process.
+        self.assertEqual(task_budget.token, None)
+
+        with multiprocessing.Manager() as manager:
+            token = CancellationToken(manager.Event())
+            task_budget = pickle.loads(
+                pickle.dumps(Budget(token=token).for_task())
+            )
+            self.assertEqual(task_budget.expired(), None)
+            token.cancel()
+            self.assertEqual(task_budget.expired(), "cancelled")
+
+
+if __name__ == "__main__":
+    unittest.main()
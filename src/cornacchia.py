@@ -1,5 +1,12 @@
 from __future__ import print_function
-from sage.all import *
+
+from collections import OrderedDict
+from functools import lru_cache
+
+from sage.arith.misc import gcd
+from sage.rings.finite_rings.integer_mod import mod
+from sage.rings.integer import Integer
+from sage.rings.integer_ring import ZZ
 
 
 def cornacchia(d, m):
@@ -33,11 +40,209 @@ def cornacchia(d, m):
     x = curr
     y_squared = (m - x ** 2) / d
 
-    if not y_squared in Integers():
+    if not y_squared in ZZ:
         return None
     elif not Integer(y_squared).is_square():
         return None
     else:
-        y = sqrt(Integer(y_squared))
+        y = Integer(y_squared).isqrt()
         assert x ** 2 + d * y ** 2 == m and gcd(x, y) == 1
         return x, y
+
+
+# A fast path that only uses Python integers (or gmpy2 integers if gmpy2 is
+# installed). It avoids creating Sage objects, so it is much cheaper when it is
+# called many times, like from kplt.solve_norm_equation.
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+if gmpy2 is not None:
+    _isqrt = gmpy2.isqrt
+    _jacobi = gmpy2.jacobi
+    _mpz = gmpy2.mpz
+else:
+    from math import isqrt as _isqrt
+
+    _mpz = int
+
+    def _jacobi(a, n):
+        """Returns the Jacobi symbol (a / n) for odd n > 0."""
+        a %= n
+        result = 1
+        while a != 0:
+            while a % 2 == 0:
+                a //= 2
+                if n % 8 in (3, 5):
+                    result = -result
+            a, n = n, a
+            if a % 4 == 3 and n % 4 == 3:
+                result = -result
+            a %= n
+        return result if n == 1 else 0
+
+
+def sqrt_mod_prime(a, p):
+    """Returns x with x^2 = a mod p, using Tonelli-Shanks.
+
+    Args:
+        a: An integer.
+        p: A prime.
+
+    Returns:
+        An integer 0 <= x <= p / 2 or None if a is not a square modulo p. If p
+        is not prime the result is either None or a correct square root.
+    """
+    a = a % p
+    if a == 0 or p == 2:
+        return a
+    if _jacobi(a, p) != 1:
+        return None
+
+    if p % 4 == 3:
+        x = pow(a, (p + 1) // 4, p)
+    elif p % 8 == 5:
+        # Atkin's formula.
+        v = pow(2 * a, (p - 5) // 8, p)
+        i = 2 * a * v * v % p
+        x = a * v * (i - 1) % p
+    else:
+        q, s = p - 1, 0
+        while q % 2 == 0:
+            q, s = q // 2, s + 1
+        z = 2
+        while _jacobi(z, p) != -1:
+            z += 1
+            if z > 1000:
+                # p is not prime.
+                return None
+        m, c, t, x = s, pow(z, q, p), pow(a, q, p), pow(a, (q + 1) // 2, p)
+        while t != 1:
+            i, t_2 = 0, t
+            while t_2 != 1:
+                t_2 = t_2 * t_2 % p
+                i += 1
+                if i == m:
+                    return None
+            b = pow(c, 1 << (m - i - 1), p)
+            m, c = i, b * b % p
+            t, x = t * c % p, x * b % p
+
+    if x * x % p != a:
+        return None
+    return min(x, p - x)
+
+
+class CornacchiaSolver(object):
+    """Solves x^2 + d*y^2 = m for a fixed d and many primes m.
+
+    Everything that only depends on d is computed once:
+        * For m coprime to 2d the symbol (-d / m) only depends on m mod 4d.
+          If 4d is small there is a table of these, so most m for which
+          there is no solution are rejected with a single lookup.
+        * The square roots of -d modulo m are kept in a bounded cache.
+    """
+
+    TABLE_LIMIT = 2 ** 16
+    CACHE_SIZE = 1024
+
+    def __init__(self, d):
+        if d <= 0:
+            raise ValueError("d must be positive but d was " + str(d))
+        self.d = _mpz(int(d))
+        self.modulus = 4 * self.d
+        self.table = None
+        if self.modulus <= self.TABLE_LIMIT:
+            self.table = [
+                _jacobi(-self.d, c) if c % 2 == 1 else 0
+                for c in range(self.modulus)
+            ]
+        self.roots = OrderedDict()
+
+    def root(self, m):
+        """Returns sqrt(-d) mod m for a prime m, or None."""
+        try:
+            self.roots.move_to_end(m)
+            return self.roots[m]
+        except KeyError:
+            pass
+        x = sqrt_mod_prime(-self.d, m)
+        self.roots[m] = x
+        if len(self.roots) > self.CACHE_SIZE:
+            self.roots.popitem(last=False)
+        return x
+
+    def solve(self, m):
+        """Find a primitive solution to x^2 + d*y^2 = m for a prime m.
+
+        This is the same algorithm as cornacchia(), but with native integers.
+        The square root of -d is found with Tonelli-Shanks, which needs m to
+        be prime. For composite m, None may be returned even if there is a
+        solution, but a returned solution is always correct.
+
+        Args:
+            m: A positive integer.
+
+        Returns:
+            The solution (x, y) as a tuple of integers or None if there is no
+            solution.
+        """
+        m = _mpz(int(m))
+        if m <= 0:
+            raise ValueError("m must be greater than 0 but m was " + str(m))
+
+        d = self.d
+        if (
+            self.table is not None
+            and m % 2 == 1
+            and self.table[m % self.modulus] == -1
+        ):
+            return None
+
+        x = self.root(m)
+        if x is None:
+            return None
+
+        # A truncated Euclidean algorithm: run it on (m, x) and stop at the
+        # first remainder below sqrt(m).
+        limit = _isqrt(m - 1)
+        prev, curr = m, x
+        while curr > limit:
+            prev, curr = curr, prev % curr
+
+        rest = m - curr * curr
+        if rest % d != 0:
+            return None
+        y_squared = rest // d
+        y = _isqrt(y_squared)
+        if y * y != y_squared:
+            return None
+        return int(curr), int(y)
+
+    def solve_many(self, ms):
+        """Returns [self.solve(m) for m in ms]."""
+        return [self.solve(m) for m in ms]
+
+
+@lru_cache(maxsize=16)
+def cornacchia_solver(d):
+    """Returns a CornacchiaSolver for d, reusing a recent one if possible."""
+    return CornacchiaSolver(int(d))
+
+
+def fast_cornacchia(d, m):
+    """Find a primitive solution to x^2 + d*y^2 = m for a prime m.
+
+    A fast version of cornacchia() for prime m, see CornacchiaSolver.solve.
+
+    Args:
+        d: A positive integer.
+        m: A positive integer, which should be prime.
+
+    Returns:
+        The solution (x, y) as a tuple of Python integers or None if there is
+        no solution.
+    """
+    return cornacchia_solver(d).solve(m)
@@ -0,0 +1,59 @@
+from __future__ import print_function
+
+import argparse
+import time
+
+from sage.all import *
+from cornacchia import cornacchia
+from cornacchia import cornacchia_solver
+from cornacchia import fast_cornacchia
+
+
+def primes_with_solution(d, bits, count):
+    """Returns count random primes m of the given size with (-d / m) = 1."""
+    result = []
+    while len(result) < count:
+        m = random_prime(2 ** bits, lbound=2 ** (bits - 1))
+        if kronecker(-d, m) == 1:
+            result.append(m)
+    return result
+
+
+def benchmark(name, fn, ms):
+    start = time.time()
+    fn(ms)
+    elapsed = time.time() - start
+    print(
+        "%-10s %8.3f s %10.1f us/call"
+        % (name, elapsed, 1e6 * elapsed / len(ms))
+    )
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare cornacchia with fast_cornacchia."
+    )
+    parser.add_argument("--d", type=int, default=3)
+    parser.add_argument("--bits", type=int, default=100)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    set_random_seed(args.seed)
+    d = Integer(args.d)
+    ms = primes_with_solution(d, args.bits, args.count)
+    for m in ms[:50]:
+        assert (cornacchia(d, m) is None) == (fast_cornacchia(d, m) is None)
+
+    print("d = %s, %s primes of %s bits" % (d, len(ms), args.bits))
+    sage_time = benchmark(
+        "sage", lambda ms: [cornacchia(d, m) for m in ms], ms
+    )
+    fast_time = benchmark(
+        "fast", lambda ms: [fast_cornacchia(d, m) for m in ms], ms
+    )
+    solver = cornacchia_solver(d)
+    batch_time = benchmark("batch", solver.solve_many, ms)
+    print("speedup: fast %.1fx, batch %.1fx"
+          % (sage_time / fast_time, sage_time / batch_time))
@@ -4,6 +4,9 @@ import unittest
 
 from sage.all import *
 from cornacchia import cornacchia
+from cornacchia import cornacchia_solver
+from cornacchia import fast_cornacchia
+from cornacchia import sqrt_mod_prime
 
 
 class CornacchiaTest(unittest.TestCase):
@@ -20,6 +23,32 @@ class CornacchiaTest(unittest.TestCase):
         self.assertTrue(x ** 2 + d * y ** 2 == m)
         self.assertTrue(gcd(x, y) == 1)
 
+    def test_sqrt_mod_prime(self):
+        for p in prime_range(2, 500):
+            for a in range(p):
+                x = sqrt_mod_prime(a, p)
+                self.assertEqual(x is None, not mod(a, p).is_square())
+                if x is not None:
+                    self.assertEqual(mod(x, p) ** 2, mod(a, p))
+
+    def test_fast_cornacchia(self):
+        for d in [1, 2, 3, 7, 1019]:
+            for m in prime_range(2, 3000):
+                res = fast_cornacchia(d, m)
+                self.assertEqual(res is None, cornacchia(d, m) is None)
+                if res is not None:
+                    x, y = res
+                    self.assertTrue(x ** 2 + d * y ** 2 == m)
+                    self.assertTrue(gcd(x, y) == 1)
+
+    def test_solve_many(self):
+        d = 7
+        ms = [next_prime(10 ** 30 + 1000 * n) for n in range(20)]
+        solver = cornacchia_solver(d)
+        self.assertEqual(solver.solve_many(ms),
+                         [fast_cornacchia(d, m) for m in ms])
+        self.assertTrue(cornacchia_solver(d) is solver)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,82 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmark_stats import summary
+
+
+def measure_import(module, python):
+    """Imports module in a fresh interpreter.
+
+    Returns:
+        A pair (seconds, kb) of the wall time of the whole process and its
+        peak resident set size.
+    """
+    start = time.time()
+    process = subprocess.Popen([python, "-c", "import " + module])
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError("Importing %s failed." % module)
+    return elapsed, usage.ru_maxrss
+
+
+def run(args):
+    cases = []
+    for module in args.modules:
+        times = []
+        peaks = []
+        for _ in range(args.runs):
+            elapsed, peak = measure_import(module, args.python)
+            times.append(elapsed)
+            peaks.append(peak)
+        case = {
+            "module": module,
+            "runs": args.runs,
+            "time": summary(times),
+            "peak_rss_kb": summary(peaks),
+        }
+        print(
+            "%-16s %9.3f s median %9.3f s p95 %9d kB median rss"
+            % (
+                module,
+                case["time"]["median"],
+                case["time"]["p95"],
+                case["peak_rss_kb"]["median"],
+            )
+        )
+        cases.append(case)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"cases": cases}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the time and memory it takes to import modules."
+    )
+    parser.add_argument(
+        "--modules",
+        type=lambda s: s.split(","),
+        default=["kplt", "cornacchia", "service", "sage.all"],
+        help="The modules to import, separated by commas. sage.all is the "
+        "baseline the others are compared to.",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=5, help="The number of imports per module."
+    )
+    parser.add_argument(
+        "--python",
+        default=sys.executable,
+        help="The interpreter to run, for example the one of sage -python.",
+    )
+    parser.add_argument(
+        "--output", default=None, help="Also write the results as JSON here."
+    )
+    args = parser.parse_args()
+    run(args)
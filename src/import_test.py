@@ -0,0 +1,47 @@
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import unittest
+
+# Runs in a fresh interpreter, where nothing imported sage.all before.
+SCRIPT = """
+import sys
+
+from sage.rings.integer import Integer
+from kplt import algebra_context
+from kplt import ell_power_equiv
+from kplt import left_ideal
+from kplt import special_quaternion_algebra
+from kplt import verify_result
+
+B = special_quaternion_algebra(59)
+O = algebra_context(B).O_special
+i, j, k = B.gens()
+J = left_ideal([2 * i - 2 * j + 2 * k, 24], O)
+J_2, delta = ell_power_equiv(J, O, 3)
+assert verify_result(J, O, Integer(3), J_2, delta)
+
+import kplt_cli
+import service
+
+assert "sage.all" not in sys.modules, "sage.all was imported"
+"""
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_without_sage_all(self):
+        process = subprocess.run(
+            [sys.executable, "-c", SCRIPT],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        self.assertEqual(process.returncode, 0, process.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,33 +1,388 @@
 from __future__ import print_function
 
-from sage.all import *
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from fractions import Fraction
+from functools import lru_cache
+from math import ceil as ceil_float
+from math import isqrt
+from math import log as log_float
+from os import cpu_count
+
+# Only the Sage modules that are used are imported, not sage.all, so that
+# importing this module is cheap. NumPy is imported by sieved_pairs, the only
+# function that uses it.
+from sage.algebras.quatalg.quaternion_algebra import QuaternionAlgebra
 from sage.algebras.quatalg.quaternion_algebra import quaternion_algebra_cython
-from sage.rings.finite_rings.integer_mod import mod
-from sage.rings.integer_ring import ZZ
-from sage.rings.integer import Integer
-from sage.arith.misc import is_prime
-from sage.arith.misc import xgcd
+from sage.arith.functions import lcm
 from sage.arith.misc import gcd
+from sage.arith.misc import is_prime
+from sage.arith.misc import kronecker
 from sage.arith.misc import two_squares
-from sage.arith.functions import lcm
-from sage.sets.primes import Primes
-from sage.rings.finite_rings.finite_field_constructor import FiniteField as GF
-from cornacchia import cornacchia
-from sage.algebras.quatalg.quaternion_algebra import QuaternionAlgebra
+from sage.arith.misc import xgcd
 from sage.matrix.constructor import matrix
+from sage.misc.misc_c import prod
+from sage.misc.randstate import set_random_seed
+from sage.modules.free_module_element import vector
+from sage.quadratic_forms.binary_qf import BinaryQF_reduced_representatives
+from sage.rings.fast_arith import prime_range
+from sage.rings.finite_rings.finite_field_constructor import FiniteField as GF
+from sage.rings.finite_rings.integer_mod import mod
+from sage.rings.integer import Integer
+from sage.rings.integer_ring import ZZ
+from sage.rings.rational_field import QQ
+from cache import cache_key
+from cache import decode_elements
+from cache import encode_elements
+from cancellation import SearchAborted
+from cancellation import check_budget
+from cornacchia import fast_cornacchia
+from lattice import determinant
+from lattice import hnf_mod
+from lattice import vectors_by_norm
+from prime_filter import PrimeFilter
+from prime_filter import merge_stats
+from prime_filter import survivors
+from profiling import NO_PROFILE
+from profiling import Profile
+from profiling import print_stage
+from quaternion import IntegralQuaternion
+
+# The primes below this bound are used by sieved_pairs.
+BATCH_SIEVE_BOUND = 256
+# The number of rows y each task of a parallel element_of_norm searches.
+ELEMENT_OF_NORM_CHUNK = 8
+# r may be a prime times a square of primes below this bound.
+SMOOTH_BOUND = 1000
+# The number of algebras algebra_context keeps the context of.
+ALGEBRA_CONTEXT_CACHE_SIZE = 16
+# How often, in seconds, a budget is checked while waiting for a task on an
+# executor.
+BUDGET_POLL_INTERVAL = 0.1
+
+# How much the functions in this module check their own results, see
+# set_verification_level.
+VERIFY_OFF = 0
+VERIFY_CHEAP = 1
+VERIFY_FULL = 2
+VERIFICATION_LEVELS = {
+    "off": VERIFY_OFF,
+    "cheap": VERIFY_CHEAP,
+    "full": VERIFY_FULL,
+}
+verification = {"level": VERIFY_FULL}
+
+
+def set_verification_level(level):
+    """Sets how much the functions in this module check their results.
+
+    The checks are assert statements, so running Python with -O turns all of
+    them off regardless of the level. The levels are:
+
+        "off" (VERIFY_OFF): No checks at all.
+        "cheap" (VERIFY_CHEAP): Checks that only do arithmetic with integers
+            and quaternions that have already been computed, such as
+            nrd(gamma) == M or congruences modulo N. Their cost is negligible
+            next to the searches.
+        "full" (VERIFY_FULL): Also checks that make Sage compute orders,
+            ideals or membership in them, such as J.left_order() == O or
+            mu in O.left_ideal(...).scale(N), and primality proofs. These can
+            cost more than the computation they check. This is the default.
+
+    verify_result can check the final output of ell_power_equiv once, whatever
+    the level is.
+
+    Args:
+        level: One of "off", "cheap", "full" or the corresponding constant.
+
+    Returns:
+        The previous level as one of the constants.
+    """
+    level = VERIFICATION_LEVELS.get(level, level)
+    if level not in VERIFICATION_LEVELS.values():
+        raise ValueError("Unknown verification level " + str(level))
+    previous = verification["level"]
+    verification["level"] = level
+    return previous
+
+
+def verify(level):
+    """Returns True if the checks of the given level should be run."""
+    return verification["level"] >= level
+
+
+def get_profile(profile, print_progress=False):
+    """Returns the profile the functions below record their stages in.
+
+    This is profile if it is not None. Otherwise it is a Profile that prints
+    every stage if print_progress is True and NO_PROFILE, which records
+    nothing, if it is not.
+    """
+    if profile is not None:
+        return profile
+    if print_progress:
+        return Profile(callback=print_stage)
+    return NO_PROFILE
+
+
+def ceil_log(x, base):
+    """Returns ceil(log(x, base)) for a rational x >= 1.
+
+    This is the smallest e with base^e >= x. It is computed with integers, so
+    it is exact and does not need the symbolic ring.
+    """
+    n = QQ(x).ceil()
+    if n < 1:
+        raise ValueError("x must be at least 1.")
+    e = n.exact_log(base)
+    return e if Integer(base) ** e == n else e + 1
+
+
+def special_order_data(p):
+    """Returns the data of the special maximal order for the prime p.
+
+    These are the orders of Section 2.3 of the paper, due to Pizer. The
+    algebra is B = (-q, -p | Q) and the order O contains R + Rj where
+    R = Z[i], with index D = 4q.
+
+        p = 3 mod 4: q = 1 and O has basis (1+j)/2, (i+k)/2, j, k.
+        p = 5 mod 8: q = 2 and O has basis 1, (1+j+k)/2, (i+2j+k)/4, k.
+        p = 1 mod 8: q is the smallest prime q = 3 mod 4 such that p is not
+            a square mod q, and O has basis (1+i)/2, (j+k)/2, (i+ck)/q, k
+            where c^2*p = -1 mod q.
+
+    Args:
+        p: An odd prime.
+
+    Returns:
+        A tuple (q, D, basis) where basis is the basis of O as the
+        coefficients of 1, i, j, k.
+    """
+    p = Integer(p)
+    if p == 2 or not is_prime(p):
+        raise NotImplementedError("p must be an odd prime.")
+    half = QQ(1) / 2
+    if p % 4 == 3:
+        q = Integer(1)
+        basis = [
+            (half, 0, half, 0),
+            (0, half, 0, half),
+            (0, 0, 1, 0),
+            (0, 0, 0, 1),
+        ]
+    elif p % 8 == 5:
+        q = Integer(2)
+        basis = [
+            (1, 0, 0, 0),
+            (half, 0, half, half),
+            (0, half / 2, half, half / 2),
+            (0, 0, 0, 1),
+        ]
+    else:
+        q = Integer(3)
+        while kronecker(p, q) != -1:
+            q = q.next_prime()
+            while q % 4 != 3:
+                q = q.next_prime()
+        c = Integer((-~mod(p, q)).sqrt())
+        basis = [
+            (half, half, 0, 0),
+            (0, 0, half, half),
+            (0, 1 / q, 0, c / q),
+            (0, 0, 0, 1),
+        ]
+    return q, 4 * q, [tuple(QQ(x) for x in row) for row in basis]
+
 
+def special_quaternion_algebra(p):
+    """Returns the algebra (-q, -p | Q) of the special order for p.
 
-def connecting_ideal(O_1, O_2):
+    For p = 3 mod 4 and p = 5 mod 8 this is QuaternionAlgebra(p). For
+    p = 1 mod 8, QuaternionAlgebra(p) is (-p, -q | Q), with i and j swapped.
+    ell_power_equiv maps its problems here with swap_i_j.
+    """
+    q, _, _ = special_order_data(p)
+    return QuaternionAlgebra(QQ, -q, -Integer(p))
+
+
+def swap_i_j(x, B):
+    """Returns the image of x in B under i -> j, j -> i and k -> -k.
+
+    This is an isomorphism between (-p, -q | Q) and (-q, -p | Q), and it is
+    its own inverse.
+    """
+    t, x_1, y, z = x.coefficient_tuple()
+    return B([t, y, x_1, -z])
+
+
+def swapped_order(O):
+    """Returns the image of O in special_quaternion_algebra(p), see swap_i_j.
+
+    It is cached on O.
+    """
+    try:
+        return O._kplt_swapped_order
+    except AttributeError:
+        pass
+    B = special_quaternion_algebra(O.quaternion_algebra().discriminant())
+    O._kplt_swapped_order = B.quaternion_order(
+        [swap_i_j(x, B) for x in O.basis()]
+    )
+    return O._kplt_swapped_order
+
+
+def norm_form_density(q):
+    """Returns the density of the primes r with x^2 + q*y^2 = r solvable.
+
+    These are the primes that split completely in the ring class field of
+    Z[sqrt(-q)], so the density is 1 / (2h) where h is the number of reduced
+    primitive forms of discriminant -4q. It is 1/2 for q = 1 and q = 2.
+    """
+    h = len(BinaryQF_reduced_representatives(-4 * q, primitive_only=True))
+    return 1.0 / (2 * h)
+
+
+class AlgebraContext(object):
+    """What the functions below need to know about a quaternion algebra.
+
+    The context of B = (a, b | Q) holds its discriminant p and invariants as
+    Integers, with q = -a, its generators, the special maximal order and the
+    index D of R + Rj in it, the primes sieved_pairs uses and the values of
+    log(p, ell), so none of it is recomputed on every call. Use
+    algebra_context() to get one.
+
+    The special order only exists when B is special_quaternion_algebra(p),
+    which is_special tells. is_swapped tells if B is (-p, -q | Q) instead,
+    like QuaternionAlgebra(p) for p = 1 mod 8, which swap_i_j maps to it.
+    """
+
+    def __init__(self, B):
+        self.B = B
+        self.p = Integer(B.discriminant())
+        a, b = B.invariants()
+        self.a = Integer(a)
+        self.b = Integer(b)
+        self.q = -self.a
+        self.gens = B.gens()
+        self.special_basis = None
+        self.is_swapped = False
+        if self.p != 2 and is_prime(self.p):
+            q, _, basis = special_order_data(self.p)
+            if (self.a, self.b) == (-q, -self.p):
+                self.special_basis = basis
+            elif (self.a, self.b) == (-self.p, -q):
+                self.is_swapped = True
+        self.is_special = self.special_basis is not None
+        self.D = 4 * self.q
+        self.sieve_primes = prime_range(BATCH_SIEVE_BOUND)
+        self.log_p = {}
+        self._O_special = None
+        self._norm_density = None
+
+    @property
+    def O_special(self):
+        """The special maximal order, computed when it is first needed."""
+        if self._O_special is None:
+            if not self.is_special:
+                raise NotImplementedError(
+                    "B must be special_quaternion_algebra(p) for a prime p."
+                )
+            self._O_special = self.B.quaternion_order(
+                [self.B(x) for x in self.special_basis]
+            )
+        return self._O_special
+
+    @property
+    def norm_density(self):
+        """norm_form_density(q), computed when it is first needed."""
+        if self._norm_density is None:
+            self._norm_density = norm_form_density(self.q)
+        return self._norm_density
+
+    def ceil_log_p(self, ell):
+        """Returns ceil(log(p, ell))."""
+        ell = Integer(ell)
+        try:
+            return self.log_p[ell]
+        except KeyError:
+            result = ceil_log(self.p, ell)
+            self.log_p[ell] = result
+            return result
+
+
+def algebra_context(B, context=None):
+    """Returns an AlgebraContext for B, reusing a recent one if possible.
+
+    The contexts of the last ALGEBRA_CONTEXT_CACHE_SIZE algebras are kept,
+    by their invariants (a, b). QuaternionAlgebra(p) and
+    special_quaternion_algebra(p) have the same discriminant for p = 1 mod 8,
+    and ell_power_equiv uses both, so they each keep their own context.
+
+    Args:
+        B: A quaternion algebra.
+        context: If not None, it is returned as it is. This lets functions
+            that take an optional context call algebra_context(B, context).
+    """
+    if context is not None:
+        return context
+    a, b = B.invariants()
+    context = cached_algebra_context(Integer(a), Integer(b))
+    if context.B is not B:
+        # B has other names for its generators than (a, b | Q).
+        context = AlgebraContext(B)
+    return context
+
+
+@lru_cache(maxsize=ALGEBRA_CONTEXT_CACHE_SIZE)
+def cached_algebra_context(a, b):
+    """Returns the AlgebraContext of (a, b | Q), see algebra_context."""
+    return AlgebraContext(QuaternionAlgebra(QQ, a, b))
+
+
+def cached_elements(cache, key, B):
+    """Returns the elements of B stored under key in cache or None.
+
+    Args:
+        cache: None or a cache from cache.py.
+        key: A key as returned by cache.cache_key.
+        B: A quaternion algebra.
+    """
+    if cache is None:
+        return None
+    value = cache.get(key)
+    return None if value is None else decode_elements(value, B)
+
+
+def store_elements(cache, key, elements):
+    """Stores elements under key in cache, unless cache is None."""
+    if cache is not None:
+        cache.put(key, encode_elements(elements))
+
+
+def connecting_ideal(O_1, O_2, cache=None):
     """Returns an O_1, O_2-connecting ideal.
 
     Args:
         O_1: A maximal order in a rational quaternion algebra.
         O_2: A maximal order in the same quaternion algebra.
+        cache: If not None, a cache from cache.py. The basis of the result is
+            stored in it under the two orders, so the next call with the same
+            orders returns the same ideal without computing it.
 
     Returns:
         An ideal I that is a left O_1 ideal and a right O_2 ideal. Moreover I
         is a subset of O_1.
     """
+    B = O_1.quaternion_algebra()
+    if cache is not None:
+        key = cache_key("connecting_ideal", [O_1, O_2], B)
+        basis = cached_elements(cache, key, B)
+        if basis is not None:
+            return B.ideal(basis, left_order=O_1, check=False)
+
     # There exists some integer d such that d*O_2 is a subset of O_1. We
     # first compute d.
     mat_1 = matrix([x.coefficient_tuple() for x in O_1.basis()])
@@ -35,16 +390,76 @@ def connecting_ideal(O_1, O_2):
     matcoeff = mat_2 * ~mat_1
     d = lcm(x.denominator() for x in matcoeff.coefficients())
 
-    # J is a subset of O_1 and is a O_1, O_2-ideal by construction.
-    J = left_ideal([d * x * y for x in O_1.basis() for y in O_2.basis()], O_1)
+    # J = d*O_1*O_2 is a subset of O_1 and is a O_1, O_2-ideal by
+    # construction. The products of the basis elements already span it as a
+    # Z-module, and it contains d*O_1.
+    J = ideal_from_module_generators(
+        [d * x * y for x in O_1.basis() for y in O_2.basis()], O_1, scalar=d
+    )
 
-    assert J.left_order() == O_1
-    assert J.right_order() == O_2
-    assert all(x in O_1 for x in J.basis())
+    if verify(VERIFY_FULL):
+        assert J.left_order() == O_1
+        assert J.right_order() == O_2
+        assert all(x in O_1 for x in J.basis())
 
+    if cache is not None:
+        store_elements(cache, key, J.basis())
     return J
 
 
+def ideal_from_module_generators(module_gens, O, scalar=None):
+    """Returns the left O-ideal spanned by module_gens as a Z-module.
+
+    The Hermite normal form is computed with lattice.ModularHNF, so the
+    coefficients stay bounded by the determinant of a sublattice instead of
+    blowing up. That sublattice is scalar*O if scalar is given, and
+    otherwise the span of the first block of four consecutive generators that
+    has full rank. The ideal is created with O as its left order, so Sage
+    does not recompute it.
+
+    Args:
+        module_gens: Elements of B whose Z-span is closed under left
+            multiplication by O.
+        O: An order in a quaternion algebra.
+        scalar: If not None, an integer n such that n*O is contained in the
+            span of module_gens.
+
+    Returns:
+        The left O-ideal.
+    """
+    B = O.quaternion_algebra()
+    module_gens = list(module_gens)
+    if scalar is not None:
+        module_gens += [scalar * x for x in O.basis()]
+    basis = module_basis(module_gens, B, scalar is not None)
+    return B.ideal(basis, left_order=O, check=False)
+
+
+def module_basis(module_gens, B, last_block=False):
+    """Returns the HNF basis of the Z-span of module_gens.
+
+    See ideal_from_module_generators. The modulus of the ModularHNF is the
+    determinant of the last four generators if last_block is True, and of
+    the first block of four consecutive generators with full rank if not.
+    """
+    Z, d = (quaternion_algebra_cython.
+            integral_matrix_and_denom_from_rational_quaternions(module_gens))
+    rows = [[int(c) for c in row] for row in Z.rows()]
+
+    if last_block:
+        modulus = abs(determinant(rows[-4:]))
+    else:
+        dets = [abs(determinant(rows[t:t + 4]))
+                for t in range(0, len(rows) - 3, 4)]
+        modulus = min([x for x in dets if x != 0] or [0])
+    if modulus == 0:
+        raise ValueError("The generators do not span a full rank lattice.")
+
+    H = matrix(ZZ, hnf_mod(rows, modulus))
+    return (quaternion_algebra_cython.
+            rational_quaternions_from_integral_matrix_and_denom(B, H, d))
+
+
 def left_ideal(gens, O):
     """Returns the left O-ideal generated by gens.
 
@@ -61,22 +476,25 @@ def left_ideal(gens, O):
     if not all(x in O for x in gens):
         raise ValueError("All the generators must be in O.")
 
-    module_gens = [x * y for x in O.basis() for y in gens]
-    B = O.quaternion_algebra()
-    Z, d = (quaternion_algebra_cython.
-            integral_matrix_and_denom_from_rational_quaternions(module_gens))
-    H = Z.hermite_form(include_zero_rows=False)
-    basis = (quaternion_algebra_cython.
-             rational_quaternions_from_integral_matrix_and_denom(B, H, d))
-
-    I = O.left_ideal(basis)
+    # The products for one generator are next to each other, which is what
+    # ideal_from_module_generators needs to pick a modulus.
+    I = ideal_from_module_generators(
+        [x * y for y in gens for x in O.basis()], O
+    )
 
-    assert all(x in O for x in I.basis())
-    assert all(x * y in O for x in O.basis() for y in I.basis())
-    assert I.left_order() == O
+    if verify(VERIFY_FULL):
+        assert all(x in O for x in I.basis())
+        assert all(x * y in O for x in O.basis() for y in I.basis())
+        assert I.left_order() == O
     return I
 
 
+def to_fraction(x):
+    """Converts a Sage rational number to a Python Fraction."""
+    x = QQ(x)
+    return Fraction(int(x.numerator()), int(x.denominator()))
+
+
 def random_combination(basis, bound=1000):
     """Return a random integer linear combination of the elements of basis."""
     return sum(ZZ.random_element(-bound, bound + 1) * x_i for x_i in basis)
@@ -102,7 +520,68 @@ def is_minkowski_basis(basis):
     )
 
 
-def prime_norm_representative(I, O, D, ell):
+def gram_matrix(basis):
+    """Returns the Gram matrix of basis with respect to the trace form.
+
+    The (r, c) entry is trd(basis[r] * conjugate(basis[c])), so the diagonal
+    holds twice the reduced norms of the basis elements.
+
+    Args:
+        basis: A list of elements of a quaternion algebra.
+
+    Returns:
+        A symmetric matrix over QQ.
+    """
+    return matrix(
+        QQ,
+        [[(x * y.conjugate()).reduced_trace() for y in basis] for x in basis],
+    )
+
+
+def reduced_basis(I):
+    """Returns an LLL reduced basis of I with respect to the norm form.
+
+    The reduction is done on the Gram matrix of the trace form, so it only
+    involves a 4x4 integer matrix. The result is cached on I, so calling this
+    function repeatedly with the same ideal is cheap.
+
+    Args:
+        I: A fractional ideal in a rational quaternion algebra.
+
+    Returns:
+        A tuple of four elements of I that form a Z-basis for I, sorted by
+        reduced norm.
+    """
+    try:
+        return I._kplt_reduced_basis
+    except AttributeError:
+        pass
+
+    basis = I.basis()
+    G = gram_matrix(basis)
+    G = (G * G.denominator()).change_ring(ZZ)
+    # The columns of U are the coordinates of the reduced basis with respect
+    # to the original one.
+    U = G.LLL_gram()
+    reduced = sorted(
+        (sum(U[r, c] * basis[r] for r in range(4)) for c in range(4)),
+        key=lambda alpha: alpha.reduced_norm(),
+    )
+    I._kplt_reduced_basis = tuple(reduced)
+    return I._kplt_reduced_basis
+
+
+def prime_norm_representative(
+    I,
+    O,
+    D,
+    ell,
+    max_norm=None,
+    stats=None,
+    context=None,
+    cache=None,
+    budget=None,
+):
     """
     Given an order O and a left O-ideal I return another
     left O-ideal J in the same class, but with prime norm.
@@ -112,63 +591,160 @@ def prime_norm_representative(I, O, D, ell):
     a large prime coprime to both D and p, and ell is a quadratic
     nonresidue module N.
 
+    The elements of I are enumerated in order of increasing norm, so the
+    search is deterministic and the N that is found is the smallest possible.
 
     Args:
         I: A left O-ideal.
         O: An order in a quaternion algebra.
         D: An integer.
         ell: A prime.
+        max_norm: Only elements alpha with nrd(alpha) / nrd(I) <= max_norm
+            are tried. If None there is no limit.
+        stats: If not None, a dict. The number of candidates that were tried
+            is stored in stats["candidates"], the normalized norm of the last
+            one in stats["max_norm"] and the counters of the PrimeFilter used
+            to test their norms in stats["filter"].
+        context: The AlgebraContext of the algebra of I or None.
+        cache: If not None, a cache from cache.py. gamma is stored in it
+            under the HNF of I and (p, ell, D), and the search is skipped
+            when it is already there. The stats of a cached result are all 0
+            except for stats["max_norm"].
+        budget: If not None, a cancellation.Budget that is checked for every
+            candidate. When it runs out, SearchAborted is raised with the
+            stats collected so far.
     Returns:
         A pair (J, gamma) where J = I * gamma is a left O-ideal in the same
         class with prime norm N. N will be coprime to both D and p, and ell
         will be a nonquadratic residue module N.
     """
     # TODO: Change so O is not an argument.
-    if not is_minkowski_basis(I.basis()):
-        print(
-            "Warning: The ideal I does not have a minkowski basis"
-            " precomputed and Sage can not do it for you."
+    context = algebra_context(I.quaternion_algebra(), context)
+    if cache is not None:
+        key = cache_key("prime_norm_representative", [I], context.B, ell, D)
+        cached = cached_elements(cache, key, context.B)
+        if cached is not None:
+            gamma = cached[0]
+            J = I.scale(gamma)
+            N = Integer(J.norm())
+            # The search always finds the smallest N, so the result is only
+            # valid for this max_norm if N is below it.
+            if max_norm is None or N <= max_norm:
+                if stats is not None:
+                    stats["candidates"] = 0
+                    stats["max_norm"] = N
+                    stats["filter"] = merge_stats([])
+                return J, gamma
+
+    result = next(
+        prime_norm_representatives(
+            I,
+            O,
+            D,
+            ell,
+            max_norm=max_norm,
+            stats=stats,
+            context=context,
+            budget=budget,
+        ),
+        None,
+    )
+    if result is None:
+        raise ValueError(
+            "No element of I has a suitable norm below " + str(max_norm)
         )
+    J, gamma = result
+    if cache is not None:
+        store_elements(cache, key, [gamma])
+    return J, gamma
+
 
+def prime_norm_representatives(
+    I,
+    O,
+    D,
+    ell,
+    max_norm=None,
+    min_norm=None,
+    stats=None,
+    context=None,
+    budget=None,
+):
+    """Yields the representatives of prime_norm_representative in order.
+
+    The first pair is the one prime_norm_representative returns, and each
+    later one has a larger prime N. Only one representative is yielded for
+    each N. This lets callers move on to the next representative when a
+    later step fails for a particular N.
+
+    Args:
+        I, O, D, ell, max_norm, context, budget: See
+            prime_norm_representative.
+        min_norm: If not None, only representatives with N > min_norm are
+            yielded.
+        stats: If not None, a dict that is kept up to date as in
+            prime_norm_representative every time a pair is yielded and when
+            the search is exhausted.
+
+    Yields:
+        Pairs (J, gamma) as returned by prime_norm_representative.
+    """
     nrd_I = I.norm()
-    B = I.quaternion_algebra()
-    p = B.discriminant()
-    alpha = B(0)
-    normalized_norm = Integer(alpha.reduced_norm() / nrd_I)
-    # Choose random elements in I until one is found with norm N*nrd(I) where N
-    # is prime.
-    m_power = 3
-    m = Integer(2) ** m_power  # TODO: Change this to a proper bound.
+    context = algebra_context(I.quaternion_algebra(), context)
+    p = context.p
+    # Enumerating with respect to a reduced basis keeps the coefficients, and
+    # so the work done per candidate, small.
+    basis = reduced_basis(I)
+    gram = [
+        [to_fraction(x / (2 * nrd_I)) for x in row]
+        for row in gram_matrix(basis)
+    ]
+
+    # Walk through the elements of I in order of increasing norm and pick
+    # the ones with norm N*nrd(I) where N is prime.
+    prime_filter = PrimeFilter(nonresidues=[ell], exclude=[D, ell, p])
     count = 0
-    while (
-        not is_prime(normalized_norm)
-        or normalized_norm.divides(D)
-        or normalized_norm == ell
-        or normalized_norm == p
-        or mod(ell, normalized_norm).is_square()
-    ):
-        # Make a new random element.
-        alpha = random_combination(I.basis(), bound=m)
-        normalized_norm = Integer(alpha.reduced_norm() / nrd_I)
-
-        # Increase the box we search in if we've been trying for too long. Note
-        # this was just a random heuristic I came up with, it's not in the
-        # paper.
+    normalized_norm = None
+    last_norm = min_norm
+
+    def collected_stats():
+        return {
+            "candidates": count,
+            "max_norm": normalized_norm,
+            "filter": prime_filter.stats(),
+        }
+
+    for norm, coeffs in vectors_by_norm(gram, max_norm=max_norm):
+        check_budget(budget, "prime_norm_representative", collected_stats)
         count += 1
-        if count > 4 * m_power:
-            m_power += 1
-            m = Integer(2) ** m_power
-            count = 0
-
-    # We now have an element alpha with norm N*nrd(I) where N is prime. The
-    # ideal J = I*gamma has prime norm where gamma = conjugate(alpha) / nrd(I).
-    gamma = alpha.conjugate() / nrd_I
-    J = I.scale(gamma)
-
-    assert is_prime(Integer(J.norm()))
-    assert not mod(ell, Integer(J.norm())).is_square()
-    assert gcd(Integer(J.norm()), D) == 1
-    return J, gamma
+        normalized_norm = Integer(int(norm))
+        if last_norm is not None and normalized_norm <= last_norm:
+            continue
+        if not (
+            prime_filter(normalized_norm)
+            and prime_filter.prove(normalized_norm)
+        ):
+            continue
+
+        # We now have an element alpha with norm N*nrd(I) where N is prime.
+        # The ideal J = I*gamma has prime norm where
+        # gamma = conjugate(alpha) / nrd(I).
+        alpha = sum(c * x for c, x in zip(coeffs, basis))
+        gamma = alpha.conjugate() / nrd_I
+        J = I.scale(gamma)
+
+        if verify(VERIFY_CHEAP):
+            assert not mod(ell, Integer(J.norm())).is_square()
+            assert gcd(Integer(J.norm()), D) == 1
+        if verify(VERIFY_FULL):
+            assert is_prime(Integer(J.norm()))
+        last_norm = normalized_norm
+        if stats is not None:
+            stats.update(collected_stats())
+        yield J, gamma
+
+    if stats is not None:
+        stats.update(collected_stats())
 
 
 def solve_norm_equation(q, r):
@@ -186,17 +762,176 @@ def solve_norm_equation(q, r):
     if q == 1:
         try:
             sol = two_squares(r)
-            assert sol[0] ** 2 + q * sol[1] ** 2 == r
+            if verify(VERIFY_CHEAP):
+                assert sol[0] ** 2 + q * sol[1] ** 2 == r
             return sol
         except ValueError:
             return None
     else:
-        sol = cornacchia(q, r)
-        assert sol is None or sol[0] ** 2 + q * sol[1] ** 2 == r
+        # r is a prime in all the places this is called from, so the native
+        # integer version of cornacchia can be used.
+        sol = fast_cornacchia(q, r)
+        if sol is None:
+            return None
+        sol = Integer(sol[0]), Integer(sol[1])
+        if verify(VERIFY_CHEAP):
+            assert sol[0] ** 2 + q * sol[1] ** 2 == r
         return sol
 
 
-def element_of_norm(M, O, bound=100):
+@lru_cache(maxsize=16)
+def small_primorial(bound):
+    """Returns the product of the primes below bound."""
+    return prod(prime_range(bound))
+
+
+def smooth_square_part(r, bound):
+    """Writes r = s^2 * m where s is a product of primes below bound.
+
+    Every prime below bound that divides r to an even power is moved into s
+    completely, and to an odd power leaves one factor behind in m. This is
+    trial division, but the primes are only tried if they divide
+    gcd(r, small_primorial(bound)), which is 1 most of the time.
+
+    Args:
+        r: A Sage integer.
+        bound: An integer. If bound <= 2 then s is always 1.
+
+    Returns:
+        A pair (s, m) of Sage integers with r = s^2 * m.
+    """
+    r = Integer(r)
+    s = Integer(1)
+    if r <= 0 or bound <= 2:
+        return s, r
+
+    g = gcd(r, small_primorial(bound))
+    if g == 1:
+        return s, r
+
+    for prime in g.prime_divisors():
+        while r % prime ** 2 == 0:
+            r = r // prime ** 2
+            s = s * prime
+    return s, r
+
+
+def solve_smooth_norm_equation(q, r, prime_filter, smooth_bound):
+    """Solves x^2 + q*y^2 = r where r is a prime times a smooth square.
+
+    In the paper r only has to be the product of a prime and a smooth square,
+    which is much more likely than r being prime. We write r = s^2 * m using
+    smooth_square_part and, if m passes prime_filter, scale a solution of
+    x^2 + q*y^2 = m by s.
+
+    Args:
+        q: A Sage integer.
+        r: A Sage integer.
+        prime_filter: A PrimeFilter that decides which m are worth solving
+            for.
+        smooth_bound: The bound passed to smooth_square_part.
+
+    Returns:
+        Tuple of Sage integers (x, y) or None if r is not of this form or
+        there is no solution.
+    """
+    s, m = smooth_square_part(r, smooth_bound)
+    # A small prime m would mean r is divisible by an odd power of that
+    # prime. Skipping these loses almost nothing and keeps the results in
+    # line with sieved_pairs.
+    if s != 1 and m < smooth_bound:
+        return None
+    if not prime_filter(m):
+        return None
+    sol = solve_norm_equation(q, m)
+    if sol is None:
+        return None
+    return s * sol[0], s * sol[1]
+
+
+def sieved_pairs(
+    M, p, q, bound, block_size, primes, rows=None, smooth_bound=0
+):
+    """Yields the pairs (y, z) where M - p*(y^2 + q*z^2) may be prime.
+
+    The values of r are never computed. Instead r mod s is computed for a
+    block of rows y and all columns z at once with NumPy, for each s in
+    primes, and pairs where some s divides r are discarded. Pairs where r is
+    not positive are discarded too. Pairs where r is smaller than the largest
+    prime in primes are always kept, so small primes r are not lost.
+
+    If r may be a prime times a square of primes below smooth_bound, see
+    smooth_square_part, then for those primes s it is r mod s^2 that is
+    computed, and pairs are only discarded if s divides r but s^2 does not.
+
+    Args:
+        M: A positive integer.
+        p: A positive integer.
+        q: A positive integer.
+        bound: The pairs 0 <= y, z <= bound are considered.
+        block_size: The number of rows y that are sieved at once.
+        primes: A list of small primes to sieve with.
+        rows: If not None, a pair (start, stop). Only the rows y with
+            start <= y < stop are considered.
+        smooth_bound: See above.
+
+    Yields:
+        Pairs (y, z) of Sage integers in the order y = 0, 1, ..., and for each
+        y in the order z = 0, 1, ....
+    """
+    import numpy as np
+
+    M, p, q = Integer(M), Integer(p), Integer(q)
+    small = max(primes) + 1
+    y_first, y_stop = (0, bound + 1) if rows is None else rows
+    z = np.arange(bound + 1, dtype=np.int64)
+    for y_start in range(y_first, y_stop, block_size):
+        y = np.arange(
+            y_start, min(y_start + block_size, y_stop), dtype=np.int64
+        )
+        keep = np.ones((len(y), len(z)), dtype=bool)
+        for s in primes:
+            s = int(s)
+            n = s ** 2 if s < smooth_bound else s
+            row_res = (int(M % n) - int(p % n) * (y * y % n)) % n
+            col_res = int(p * q % n) * (z * z % n) % n
+            res = (row_res[:, None] - col_res[None, :]) % n
+            if n == s:
+                keep &= res != 0
+            else:
+                keep &= (res % s != 0) | (res == 0)
+
+        for row, y_val in enumerate(y):
+            rest = M - p * Integer(int(y_val)) ** 2
+            if rest <= 0:
+                keep[row] = False
+                continue
+            # r > 0 if and only if z <= z_max and r < small if and only if
+            # z >= z_small.
+            z_max = isqrt((rest - 1) // (p * q))
+            keep[row, z_max + 1:] = False
+            if rest < small:
+                z_small = 0
+            else:
+                z_small = isqrt((rest - small) // (p * q)) + 1
+            keep[row, z_small:z_max + 1] = True
+
+        for row, col in zip(*np.nonzero(keep)):
+            yield Integer(int(y[row])), Integer(int(z[col]))
+
+
+def element_of_norm(
+    M,
+    O,
+    bound=100,
+    stats=None,
+    block_size=None,
+    executor=None,
+    rows=None,
+    smooth_bound=SMOOTH_BOUND,
+    context=None,
+    budget=None,
+):
     """Finds an element of B with norm M.
 
     This corresponds to Step 3 of the algorithm in the notes.
@@ -206,34 +941,293 @@ def element_of_norm(M, O, bound=100):
         O: A maximal order in a quaternion algebra.
         bound: The values 0 <= y, z <= bound will be tried. If no solution
             is found then the function returns None.
+        stats: If not None, a dict. The number of pairs (y, z) whose r was
+            tested is stored in stats["pairs"] and the counters of the
+            PrimeFilter used to test the values of r in stats["filter"].
+        block_size: If not None, the pairs (y, z) are first sieved
+            block_size rows at a time with sieved_pairs. This gives the same
+            result but is much faster when bound is large.
+        executor: If not None, a concurrent.futures.Executor. The rows y are
+            then split into chunks that are searched in parallel. The result
+            is the same as without an executor.
+        rows: If not None, a pair (start, stop). Only the rows y with
+            start <= y < stop are searched.
+        smooth_bound: Accept r = M - p*(y^2 + q*z^2) that are a prime times a
+            square of primes below smooth_bound, not only prime r. Set it to
+            0 to only accept prime r.
+        context: The AlgebraContext of the algebra of O or None. It is not
+            passed on to the tasks that run on an executor.
+        budget: If not None, a cancellation.Budget that is checked for every
+            pair (y, z). With an executor the tasks check its deadline and
+            token for every pair and the caller checks it for every chunk.
+            When it runs out, SearchAborted is raised with the stats
+            collected so far.
 
     Returns:
         gamma in B such that gamma.reduced_norm() == M or None if there is no
         solution in the box [0, bound]**2.
     """
-    B = O.quaternion_algebra()
-    a, b = B.invariants()
-    i, j, k = B.gens()
-    q, p = -Integer(a), -Integer(b)
-    for y in range(bound + 1):
-        for z in range(bound + 1):
-            r = M - p * (y ** 2 + q * z ** 2)
+    context = algebra_context(O.quaternion_algebra(), context)
+    i, j, k = context.gens
+    q, p = context.q, -context.b
+    if rows is None:
+        rows = (0, bound + 1)
+
+    if executor is not None:
+        chunk = max(block_size or 1, ELEMENT_OF_NORM_CHUNK)
+        task_budget = None if budget is None else budget.for_task()
+        tasks = (
+            (
+                M,
+                O,
+                bound,
+                block_size,
+                (start, min(start + chunk, rows[1])),
+                smooth_bound,
+                task_budget,
+            )
+            for start in range(rows[0], rows[1], chunk)
+        )
+        results = []
+
+        def collected_stats():
+            return {
+                "pairs": sum(res[1]["pairs"] for res in results),
+                "filter": merge_stats(res[1]["filter"] for res in results),
+            }
+
+        result = first_result(
+            executor,
+            element_of_norm_task,
+            tasks,
+            2 * (cpu_count() or 1),
+            lambda result: result[0] is not None,
+            on_result=results.append,
+            budget=budget,
+            stage="element_of_norm",
+            stats=collected_stats,
+        )
+        if stats is not None:
+            stats.update(collected_stats())
+        return None if result is None else result[0]
+
+    # x^2 + q*y^2 = r can only have a solution with r prime if -q is a square
+    # modulo r.
+    prime_filter = PrimeFilter(residues=[-q])
+    if block_size is None:
+        pairs = (
+            (y, z) for y in range(*rows) for z in range(bound + 1)
+        )
+    else:
+        pairs = sieved_pairs(
+            M,
+            p,
+            q,
+            bound,
+            block_size,
+            context.sieve_primes,
+            rows=rows,
+            smooth_bound=smooth_bound,
+        )
 
-            if not is_prime(r):  # Can replace with easily factorizable.
-                continue
+    gamma = None
+    count = 0
+
+    def collected_stats():
+        return {"pairs": count, "filter": prime_filter.stats()}
+
+    for y, z in pairs:
+        check_budget(budget, "element_of_norm", collected_stats)
+        count += 1
+        r = M - p * (y ** 2 + q * z ** 2)
 
-            # The norm equation is N(x + iy) = x^2 + qy^2.
-            sol = solve_norm_equation(q, r)
-            if sol is not None:
-                t, x = sol
-                gamma = t + x * i + y * j + z * k
+        # The norm equation is N(x + iy) = x^2 + qy^2.
+        sol = solve_smooth_norm_equation(q, r, prime_filter, smooth_bound)
+        if sol is not None:
+            t, x = sol
+            gamma = t + x * i + y * j + z * k
+            if verify(VERIFY_CHEAP):
                 assert Integer((gamma).reduced_norm()) == M
-                return gamma
+            break
 
-    return None
+    if stats is not None:
+        stats["pairs"] = count
+        stats["filter"] = prime_filter.stats()
+    return gamma
+
+
+def element_of_norm_task(
+    M, O, bound, block_size, rows, smooth_bound, budget=None
+):
+    """Searches the given rows for element_of_norm running in parallel.
+
+    Args:
+        budget: If not None, the Budget.for_task() of the budget of the
+            caller. It is checked for every pair, and when it runs out the
+            search of the rows stops.
+
+    Returns:
+        A pair (gamma, stats) where gamma is the result of element_of_norm,
+        or None if it failed or was aborted, and stats are the statistics it
+        collected.
+    """
+    stats = {}
+    try:
+        gamma = element_of_norm(
+            M,
+            O,
+            bound=bound,
+            stats=stats,
+            block_size=block_size,
+            rows=rows,
+            smooth_bound=smooth_bound,
+            budget=budget,
+        )
+    except SearchAborted as e:
+        # The caller checks its own budget and raises with all the stats.
+        return None, e.stats
+    return gamma, stats
+
+
+# The pairs of columns a < b of a 4x4 matrix.
+PAIRS = [(a, b) for a in range(4) for b in range(a + 1, 4)]
+
+
+def permutation_sign(perm):
+    """Returns the sign of a permutation of 0, ..., n - 1."""
+    sign = 1
+    for a in range(len(perm)):
+        for b in range(a + 1, len(perm)):
+            if perm[a] > perm[b]:
+                sign = -sign
+    return sign
+
+
+def independent(u, v):
+    """Returns True if the vectors u and v of length 4 are independent."""
+    return any(u[a] * v[b] != u[b] * v[a] for a, b in PAIRS)
 
 
-def solve_ideal_equation(gamma, I, D, N, O):
+class IdealEquationContext(object):
+    """The part of solve_ideal_equation that only depends on (a, b, N, D).
+
+    O is an order in (a, b | Q) that contains R + Rj with index D, and N is a
+    prime that does not divide D. Then x -> D * c * x, where D * c = 1 mod N,
+    sends O to the Z-span of 1, i, j, k and induces an isomorphism from O/NO
+    to (a, b | GF(N)), so elements of O are reduced by scaling and reducing
+    their coefficients mod N.
+    """
+
+    def __init__(self, a, b, N, D):
+        self.a = Integer(a)
+        self.b = Integer(b)
+        self.N = Integer(N)
+        self.D = Integer(D)
+        d, c, _ = xgcd(self.D, self.N)
+        if d != 1:
+            raise ValueError("N must not divide D.")
+        self.F = GF(self.N)
+        self.scale = self.D * c
+
+    def reduce(self, alphas):
+        """Returns the matrix over GF(N) whose rows are the images of alphas.
+
+        Args:
+            alphas: A list of elements of O.
+        """
+        Z, d = (quaternion_algebra_cython.
+                integral_matrix_and_denom_from_rational_quaternions(alphas))
+        if not d.divides(self.D):
+            raise ValueError("The elements must be in O.")
+        return matrix(self.F, Z) * self.F(self.scale // d)
+
+    def right_multiples(self, g):
+        """Returns the coefficients of g*j and g*k for g = (t, x, y, z)."""
+        a, b = self.a, self.b
+        t, x, y, z = g
+        return (
+            (b * y, b * z, t, x),
+            (-a * b * z, -b * y, a * x, t),
+        )
+
+    def annihilator(self, I):
+        """Returns a 2x4 matrix whose kernel is the image of I in O/NO.
+
+        The image is spanned by two independent rows u and v of the reduced
+        basis. The vectors w^(c) with w^(c)_a = det(u, v, e_c, e_a) are
+        orthogonal to both, and two of them that are independent span the
+        annihilator. Their entries are the 2x2 minors of u and v, so no
+        kernel is computed. The result is cached on I for each (N, D).
+        """
+        try:
+            cached = I._kplt_annihilators
+        except AttributeError:
+            cached = I._kplt_annihilators = {}
+        key = (self.N, self.D)
+        if key not in cached:
+            cached[key] = self.compute_annihilator(
+                self.reduce(list(I.basis())).rows()
+            )
+        return cached[key]
+
+    def compute_annihilator(self, rows):
+        """Returns the annihilator of the span of rows, which has rank 2."""
+        u = next((r for r in rows if r != 0), None)
+        v = None
+        if u is not None:
+            v = next((r for r in rows if independent(u, r)), None)
+        if v is None:
+            raise ValueError("I must have prime norm N.")
+        minors = dict(((a, b), u[a] * v[b] - u[b] * v[a]) for a, b in PAIRS)
+        zero = self.F(0)
+        ws = []
+        for c in range(4):
+            w = []
+            for a in range(4):
+                if a == c:
+                    w.append(zero)
+                else:
+                    # det(u, v, e_c, e_a) is the minor of u and v in the other
+                    # two columns b < d times the sign of (b, d, c, a).
+                    b, d = [x for x in range(4) if x != a and x != c]
+                    w.append(permutation_sign((b, d, c, a)) * minors[(b, d)])
+            ws.append(w)
+        w_1 = next(w for w in ws if any(x != 0 for x in w))
+        w_2 = next(w for w in ws if independent(w_1, w))
+        A = matrix(self.F, [w_1, w_2])
+        if any(x != 0 for r in rows for x in A * r):
+            raise ValueError("I must have prime norm N.")
+        return A
+
+    def solve(self, gamma, I):
+        """Returns (y, z) in GF(N), not both 0, with gamma*(yj + zk) in I/NO.
+
+        The condition is that A*(y*g_j + z*g_k) = 0 where A is the
+        annihilator of I and g_j, g_k are the coefficients of gamma*j and
+        gamma*k. Since I/NO is a 2 dimensional subspace, A is a 2x4 matrix,
+        so this is a 2x2 system that is solved directly.
+        """
+        g = self.reduce([gamma])[0]
+        A = self.annihilator(I)
+        if A.nrows() != 2:
+            raise ValueError("I must have prime norm N.")
+        g_j, g_k = [vector(self.F, v) for v in self.right_multiples(g)]
+        rows = [(w * g_j, w * g_k) for w in A.rows()]
+        if rows[0][0] * rows[1][1] - rows[0][1] * rows[1][0] != 0:
+            raise ValueError("gamma * Rj does not meet I modulo N.")
+        for u, v in rows:
+            if u != 0 or v != 0:
+                return v, -u
+        return self.F(1), self.F(0)
+
+
+@lru_cache(maxsize=16)
+def ideal_equation_context(a, b, N, D):
+    """Returns an IdealEquationContext, reusing a recent one if possible."""
+    return IdealEquationContext(a, b, N, D)
+
+
+def solve_ideal_equation(gamma, I, D, N, O, context=None):
     """Find mu_0 in Rj such that (O* gamma / NO)[mu_0] = I / NO.
 
     Args:
@@ -242,55 +1236,28 @@ def solve_ideal_equation(gamma, I, D, N, O):
         D: The index [O : R + Rj].
         N: The norm of I. Must be prime.
         O: An order in a rational quaternion algebra containing 1, i, j, k.
+        context: The AlgebraContext of the algebra of O or None.
 
     Returns:
         mu_0 in Rj such that 0 != gamma * mu_0 in I.
     """
-    assert N == I.norm()
-    assert is_prime(N)
-
-    # d = D*c + N*_
-    d, c, _ = xgcd(D, N)
-    assert d == 1
+    if verify(VERIFY_CHEAP):
+        assert N == I.norm()
+    if verify(VERIFY_FULL):
+        assert is_prime(N)
 
-    a, b = [Integer(x) for x in O.quaternion_algebra().invariants()]
+    context = algebra_context(O.quaternion_algebra(), context)
+    y, z = ideal_equation_context(
+        context.a, context.b, Integer(N), Integer(D)
+    ).solve(gamma, I)
 
-    F = GF(N)
-    # The suffix _ff means that this element is over a finite field, not the
-    # rationals.
-    B_ff = QuaternionAlgebra(F, a, b)
-    i_ff, j_ff, k_ff = B_ff.gens()
+    i, j, k = context.gens
+    mu_0 = Integer(y) * j + Integer(z) * k
 
-    # phi is homomorphism O -> (a, b | F) with kernel NO.
-    def phi(alpha):
-        # alpha + NO = alpha_prime + NO.
-        alpha_prime = D * c * alpha
-        t, x, y, z = [
-            Integer(coeff) for coeff in alpha_prime.coefficient_tuple()
-        ]
-        return t + x * i_ff + y * j_ff + z * k_ff
-
-    gamma_ff = phi(gamma)
-    gamma_ff_mat = gamma_ff.matrix(action="left")
-    I_basis_ff = [phi(alpha).coefficient_tuple() for alpha in I.basis()]
-    # Only use 2nd and 3rd rows of gamma_ff_mat so solution is in Rj.
-    lin_system = matrix(F, [gamma_ff_mat[2], gamma_ff_mat[3]] + I_basis_ff)
-    sol = lin_system.left_kernel().basis()[0]
-    y, z = sol[0], sol[1]
-    mu_ff = y * j_ff + z * k_ff
-    assert vector(F, (gamma_ff * mu_ff).coefficient_tuple()) in span(
-        I_basis_ff, F
-    )
-
-    B = O.quaternion_algebra()
-    i, j, k = B.gens()
-    mu_0 = sum(
-        Integer(coeff) * elem
-        for coeff, elem in zip(mu_ff.coefficient_tuple(), [1, i, j, k])
-    )
-
-    assert 0 != mu_0
-    assert gamma * mu_0 in I
+    if verify(VERIFY_CHEAP):
+        assert 0 != mu_0
+    if verify(VERIFY_FULL):
+        assert gamma * mu_0 in I
 
     return mu_0
 
@@ -304,7 +1271,8 @@ def solve_linear_congruence(a, b, c, n):
     x = ZZ.random_element(0, n)
     y = (c - a * x) * ~mod(b, n)
     y = Integer(mod(y, n))
-    assert mod(a * x + b * y, n) == mod(c, n)
+    if verify(VERIFY_CHEAP):
+        assert mod(a * x + b * y, n) == mod(c, n)
     return x, y
 
 
@@ -314,171 +1282,1094 @@ def center_around(x, center, modulus):
     """
     x = Integer(x)
     modulus = Integer(modulus)
-    k = ceil((center - modulus / 2 - x) / modulus)
+    k = QQ((center - modulus / 2 - x) / modulus).ceil()
     x_prime = x + modulus * k
 
-    assert mod(x, modulus) == mod(x_prime, modulus)
-    assert center - modulus / 2 <= x_prime <= center + modulus / 2
+    if verify(VERIFY_CHEAP):
+        assert mod(x, modulus) == mod(x_prime, modulus)
+        assert center - modulus / 2 <= x_prime <= center + modulus / 2
     return x_prime
 
 
-def strong_approximation(mu_0, N, O, ell):
+def first_result(
+    executor,
+    fn,
+    tasks,
+    window,
+    is_success,
+    on_result=None,
+    budget=None,
+    stage=None,
+    stats=None,
+):
+    """Runs fn(*args) for each args in tasks and returns the first success.
+
+    At most window tasks are submitted to executor at a time. Results are
+    consumed in the order of tasks, so the result returned is the success of
+    the earliest task, no matter which worker finishes first. Once it is
+    known, the tasks that have not started yet are cancelled.
+
+    Args:
+        executor: A concurrent.futures.Executor.
+        fn: A picklable function.
+        tasks: An iterable of argument tuples for fn.
+        window: The maximum number of tasks in flight.
+        is_success: A function that returns True if a result is a success.
+        on_result: If not None, called with every result that is consumed,
+            including the successful one.
+        budget: If not None, a cancellation.Budget. It is checked for every
+            result, while waiting for one and after the last one, since a
+            task that checks Budget.for_task() returns early without a
+            success. When it runs out, the tasks that have not started are
+            cancelled and SearchAborted is raised with stage and stats, see
+            Budget.check.
+
+    Returns:
+        The first successful result or None if no task succeeded.
+    """
+    tasks = iter(tasks)
+    pending = deque()
+
+    def submit_next():
+        args = next(tasks, None)
+        if args is not None:
+            pending.append(executor.submit(fn, *args))
+
+    for _ in range(window):
+        submit_next()
+
+    while pending:
+        future = pending.popleft()
+        if budget is None:
+            result = future.result()
+        else:
+            try:
+                result = wait_for_result(future, budget, stage, stats)
+            except SearchAborted:
+                for future in pending:
+                    future.cancel()
+                raise
+        if on_result is not None:
+            on_result(result)
+        if is_success(result):
+            for future in pending:
+                future.cancel()
+            return result
+        submit_next()
+
+    check_budget(budget, stage, stats)
+    return None
+
+
+def wait_for_result(future, budget, stage, stats):
+    """Returns future.result(), checking budget while it waits.
+
+    Raises:
+        SearchAborted: If the budget runs out first, see Budget.check.
+    """
+    budget.check(stage, stats)
+    while True:
+        try:
+            return future.result(timeout=BUDGET_POLL_INTERVAL)
+        except FutureTimeoutError:
+            if budget.expired() is not None:
+                future.cancel()
+                budget.check(stage, stats)
+
+
+class ExponentScheduler(object):
+    """Chooses the exponents e that strong_approximation tries and how often.
+
+    An attempt with exponent e succeeds when r = (ell^e - s) / N^2 is a
+    prime of the form x^2 + q*y^2, where s = p*nrd(lambda*beta_0 +
+    N*beta_1). The size of s does not depend much on e, so the values of s
+    seen in earlier attempts give an estimate of the probability that an
+    attempt with exponent e succeeds: the average over them of 0 if r < 2
+    and density / log(r) otherwise, where density is the proportion of
+    primes of that form, see norm_form_density.
+
+    An attempt with exponent e costs about e, the size of r, so the expected
+    work for e is e / probability. The attempts are made in rounds. A round
+    uses the e >= e_min that minimizes the expected work, with ties going to
+    the smaller e, so the resulting norm is as small as possible. It makes
+    enough attempts to succeed with probability 1 - exp(-confidence). If
+    they all fail, later rounds only use larger exponents. Before the first
+    estimate a pilot round of attempts with e_min is made.
+    """
+
+    def __init__(
+        self,
+        e_min,
+        e_max,
+        ell,
+        N,
+        pilot=8,
+        confidence=3,
+        max_trials=10000,
+        max_samples=64,
+        density=0.5,
+    ):
+        """
+        Args:
+            e_min: The smallest exponent for which lambda exists.
+            e_max: Only exponents e_min, e_min + 2, ... below e_max are used.
+            ell: A prime.
+            N: A prime.
+            pilot: The number of attempts in the pilot round.
+            confidence: See above.
+            max_trials: The maximum number of attempts in a round.
+            max_samples: Only the most recent max_samples values of s are
+                kept.
+            density: See above. It is 1/2 for q = 1, where r has to be a
+                prime that is 1 mod 4.
+        """
+        self.e_min = int(e_min)
+        self.e_max = int(e_max)
+        self.ell = int(ell)
+        self.N = int(N)
+        self.pilot = pilot
+        self.confidence = confidence
+        self.max_trials = max_trials
+        self.density = density
+        self.samples = deque(maxlen=max_samples)
+
+    def observe(self, s):
+        """Records the value of s in an attempt."""
+        self.samples.append(int(s))
+
+    def success_probability(self, e):
+        """Returns the estimated probability that an attempt with e works."""
+        if not self.samples:
+            return 0.0
+        ell_e = self.ell ** e
+        N_squared = self.N ** 2
+        total = 0.0
+        for s in self.samples:
+            r = (ell_e - s) // N_squared
+            if r >= 2:
+                total += self.density / log_float(r)
+        return total / len(self.samples)
+
+    def plan(self, e_min):
+        """Returns the pair (e, trials) for a round with e >= e_min.
+
+        Returns None if e_min >= e_max.
+        """
+        best = None
+        for e in range(e_min, self.e_max, 2):
+            probability = self.success_probability(e)
+            if probability == 0:
+                continue
+            work = e / probability
+            if best is None or work < best[0]:
+                best = (work, e, probability)
+        if best is None:
+            # No attempt so far would have worked with any e. Try the largest
+            # one.
+            e = e_min + 2 * ((self.e_max - 1 - e_min) // 2)
+            return (e, self.pilot) if e_min < self.e_max else None
+        _, e, probability = best
+        trials = int(ceil_float(self.confidence / probability))
+        return e, min(max(trials, 1), self.max_trials)
+
+    def rounds(self):
+        """Yields the rounds (e, trials) until no exponent is left.
+
+        The rounds are planned lazily, so values of s that are observed while
+        a round runs are used to plan the next one. The pilot round is
+        repeated until there is a value of s.
+        """
+        while not self.samples:
+            yield self.e_min, self.pilot
+        e_min = self.e_min
+        while True:
+            plan = self.plan(e_min)
+            if plan is None:
+                return
+            yield plan
+            e_min = plan[0] + 2
+
+
+class StrongApproximationFailure(
+    namedtuple(
+        "StrongApproximationFailure", ["exponents", "trials", "e_max"]
+    )
+):
+    """What strong_approximation returns when no exponent below e_max worked.
+
+    exponents are the exponents of the rounds, in order, and trials the total
+    number of attempts. It is false in a boolean context.
+    """
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__
+
+
+def strong_approximation_lambda(mu_0, N, ell, e):
+    """Returns lambda with lambda^2 * nrd(mu_0) = ell^e mod N."""
+    nrd_mu_0 = Integer(mu_0.reduced_norm())
+    lamb = Integer((ell ** e * ~mod(nrd_mu_0, N)).sqrt())
+    if verify(VERIFY_CHEAP):
+        assert mod(ell ** e, N) == mod(lamb ** 2 * nrd_mu_0, N)
+    return lamb
+
+
+def strong_approximation_trial(
+    mu_0,
+    N,
+    O,
+    ell,
+    e,
+    lamb,
+    prime_filter,
+    smooth_bound,
+    samples=None,
+    context=None,
+):
+    """Makes one attempt at finding mu for strong_approximation.
+
+    Args:
+        mu_0: An element of Rj.
+        N: A prime.
+        O: An order contaning 1, i, j, k.
+        ell: A prime.
+        e: The exponent to aim for.
+        lamb: The output of strong_approximation_lambda for e.
+        prime_filter: The PrimeFilter used to test r.
+        smooth_bound: See solve_smooth_norm_equation.
+        samples: If not None, a list that s = p*nrd(lambda*beta_0 +
+            N*beta_1) is appended to, see ExponentScheduler.
+        context: The AlgebraContext of the algebra of O or None.
+
+    Returns:
+        mu in O with nrd(mu) = ell^e and mu = lambda * mu_0 mod NO or None if
+        this attempt failed.
+    """
+    context = algebra_context(O.quaternion_algebra(), context)
+    B = context.B
+    a, b = context.a, context.b
+    p, q = int(context.p), int(context.q)
+    N = int(N)
+    lamb = int(lamb)
+    ell_e = int(ell) ** e
+    # Everything below is done with IntegralQuaternion and Python ints.
+    # Only the result is converted back to an element of B.
+    mu_0 = IntegralQuaternion.from_sage(mu_0)
+    t_0, x_0, y_0, z_0 = mu_0
+    beta_0 = IntegralQuaternion(y_0, z_0, 0, 0, a, b)
+
+    # Then we solve for beta_1. The trace pairing of beta_0 and beta_1 is
+    # 2*(y_0*y_1 + q*z_0*z_1).
+    lhs, rem = divmod(ell_e - p * lamb ** 2 * beta_0.reduced_norm(), N)
+    if verify(VERIFY_CHEAP):
+        assert rem == 0
+    y_1, z_1 = solve_linear_congruence(
+        2 * y_0 * p * lamb, p * lamb * 2 * q * z_0, lhs, N
+    )
+    y_1 = int(center_around(y_1, -2 * lamb * y_0, N))
+    z_1 = int(center_around(z_1, -2 * lamb * y_0, N))
+    beta_1 = IntegralQuaternion(y_1, z_1, 0, 0, a, b)
+    if verify(VERIFY_CHEAP):
+        assert (lhs - p * lamb * beta_0.trace_pairing(beta_1)) % N == 0
+
+    # Now we calculate r.
+    s = p * (lamb * beta_0 + N * beta_1).reduced_norm()
+    if samples is not None:
+        samples.append(s)
+    r, rem = divmod(ell_e - s, N ** 2)
+    if verify(VERIFY_CHEAP):
+        assert rem == 0
+
+    # In the paper they say that r can be the product of a prime and a
+    # smooth square.
+    sol = solve_smooth_norm_equation(
+        context.q, Integer(r), prime_filter, smooth_bound
+    )
+    if sol is None:
+        return None
+
+    t_1, x_1 = sol
+    # mu_1 = alpha_1 + beta_1 * j where alpha_1 = t_1 + x_1 * i.
+    mu_1 = IntegralQuaternion(t_1, x_1, y_1, z_1, a, b)
+    mu = lamb * mu_0 + N * mu_1
+    if verify(VERIFY_CHEAP):
+        assert mu.reduced_norm() == ell_e
+    mu = mu.to_sage(B)
+    if verify(VERIFY_FULL):
+        assert mu - lamb * mu_0.to_sage(B) in O.left_ideal(O.basis()).scale(N)
+    return mu
+
+
+def strong_approximation_batch(
+    mu_0, N, O, ell, e, trials, seed, smooth_bound, budget=None
+):
+    """Makes up to trials attempts with exponent e using the given seed.
+
+    This is the unit of work of strong_approximation when it runs in
+    parallel. If budget is not None, it is the Budget.for_task() of the
+    budget of the caller, and it is checked for every attempt. When it runs
+    out, the batch stops with the attempts made so far.
+
+    Returns:
+        A pair (mu, stats) where mu is as in strong_approximation_trial or
+        None and stats is a dict holding e in stats["exponent"], the number
+        of attempts that were made in stats["trials"], the values of s of
+        the attempts in stats["samples"] and the counters of the PrimeFilter
+        in stats["filter"].
+    """
+    set_random_seed(seed)
+    lamb = strong_approximation_lambda(mu_0, N, ell, e)
+    context = algebra_context(O.quaternion_algebra())
+    prime_filter = PrimeFilter(residues=[-context.q])
+    mu = None
+    count = 0
+    samples = []
+    while mu is None and count < trials:
+        if budget is not None and budget.expired() is not None:
+            # The caller checks its own budget and raises.
+            break
+        count += 1
+        mu = strong_approximation_trial(
+            mu_0,
+            N,
+            O,
+            ell,
+            e,
+            lamb,
+            prime_filter,
+            smooth_bound,
+            samples,
+            context,
+        )
+    return mu, {
+        "exponent": e,
+        "trials": count,
+        "samples": samples,
+        "filter": prime_filter.stats(),
+    }
+
+
+def strong_approximation(
+    mu_0,
+    N,
+    O,
+    ell,
+    executor=None,
+    seed=None,
+    batch_size=16,
+    smooth_bound=SMOOTH_BOUND,
+    stats=None,
+    context=None,
+    budget=None,
+    window=None,
+):
     """Find mu in O with nrd(mu) = ell^e and mu = lambda * mu_0 mod NO
 
+    The exponents e and the number of attempts for each are chosen by an
+    ExponentScheduler.
+
     Args:
         mu_0: An element of Rj.
         N: A prime.
         O: An order contaning 1, i, j, k.
         ell: A prime.
+        executor: If not None, a concurrent.futures.Executor. The attempts
+            are then made in batches of batch_size on the executor.
+        seed: Only used with an executor. Batch number t uses the random seed
+            seed + t, so the result only depends on seed. If None, the seed is
+            drawn from the current Sage random state.
+        batch_size: The number of attempts per batch.
+        smooth_bound: Accept r that are a prime times a square of primes
+            below smooth_bound, see solve_smooth_norm_equation.
+        stats: If not None, a dict. The exponents e that were tried are
+            stored in stats["exponents"], the number of attempts in
+            stats["trials"] and the counters of the PrimeFilter used to test
+            the values of r in stats["filter"].
+        context: The AlgebraContext of the algebra of O or None. It is not
+            passed on to the tasks that run on an executor.
+        budget: If not None, a cancellation.Budget that is checked for every
+            attempt. With an executor the batches check its deadline and
+            token for every attempt and the caller checks it for every batch.
+            When it runs out, SearchAborted is raised with the stats
+            collected so far.
+        window: Only used with an executor. The maximum number of batches in
+            flight, 2 * cpu_count() if None. Each round is planned only from
+            the rounds before it, which have all been consumed by then, so
+            the window does not change the result.
 
     Returns:
-        mu in O with nrd(mu) = ell^e and mu = lambda * mu_0 mod NO.
+        mu in O with nrd(mu) = ell^e and mu = lambda * mu_0 mod NO, or a
+        StrongApproximationFailure if no exponent below e_max worked.
     """
     ell = Integer(ell)
     N = Integer(N)
-    B = O.quaternion_algebra()
-    p = B.discriminant()
-    i, j, k = B.gens()
+    context = algebra_context(O.quaternion_algebra(), context)
+    p, q = context.p, context.q
+    i = context.gens[0]
     t_0, x_0, y_0, z_0 = mu_0.coefficient_tuple()
-    assert t_0 == x_0 == 0
+    if verify(VERIFY_CHEAP):
+        assert t_0 == x_0 == 0
     beta_0 = y_0 + z_0 * i
     # TODO: gracefully handle the case where
     # ~mod(p * Integer(beta_0.reduced_norm()), N) does not exist.
-    e = 2 * ceil(log(N ** 4 * (p + 1) / 2, ell)) + (
+    # This is the smallest e with ell^e > p*nrd(lambda*beta_0 + N*beta_1)
+    # for the typical size of lambda*beta_0 + N*beta_1, with the parity that
+    # makes lambda exist.
+    e = 2 * ceil_log(N ** 4 * (p * (1 + q) + 2) / 4, ell) + (
         0 if (~mod(p * Integer(beta_0.reduced_norm()), N)).is_square() else 1
     )
-    e_max = e + 2 * (2 * ceil(log(p, ell)) + 2)
-
-    # First we solve for lambda.
-    lamb = Integer(
-        (ell ** e * ~mod(p * Integer(beta_0.reduced_norm()), N)).sqrt()
+    e_max = e + 2 * (2 * context.ceil_log_p(ell) + 2)
+    scheduler = ExponentScheduler(
+        e, e_max, ell, N, density=context.norm_density
     )
-    assert mod(ell ** e, N) == mod(lamb ** 2 * Integer(mu_0.reduced_norm()), N)
 
-    mu = None
+    if executor is not None:
+        if seed is None:
+            seed = ZZ.random_element(2 ** 32)
+        if window is None:
+            window = 2 * (cpu_count() or 1)
+        task_budget = None if budget is None else budget.for_task()
+        results = []
+
+        def on_result(result):
+            results.append(result)
+            for s in result[1]["samples"]:
+                scheduler.observe(s)
+
+        def collected_stats():
+            # The batches with the same e are consecutive.
+            exponents = []
+            for res in results:
+                if not exponents or exponents[-1] != res[1]["exponent"]:
+                    exponents.append(res[1]["exponent"])
+            return {
+                "exponents": exponents,
+                "trials": sum(res[1]["trials"] for res in results),
+                "filter": merge_stats(res[1]["filter"] for res in results),
+            }
+
+        result = None
+        batches = 0
+        # The scheduler plans the next round only when this loop asks for
+        # it, which is after every batch of the round before was consumed.
+        for e, trials in scheduler.rounds():
+            tasks = [
+                (
+                    mu_0,
+                    N,
+                    O,
+                    ell,
+                    e,
+                    size,
+                    seed + batches + t,
+                    smooth_bound,
+                    task_budget,
+                )
+                for t, size in enumerate(
+                    min(batch_size, trials - start)
+                    for start in range(0, trials, batch_size)
+                )
+            ]
+            batches += len(tasks)
+            result = first_result(
+                executor,
+                strong_approximation_batch,
+                tasks,
+                window,
+                lambda result: result[0] is not None,
+                on_result=on_result,
+                budget=budget,
+                stage="strong_approximation",
+                stats=collected_stats,
+            )
+            if result is not None:
+                break
+        collected = collected_stats()
+        if stats is not None:
+            stats.update(collected)
+        if result is None:
+            return StrongApproximationFailure(
+                collected["exponents"], collected["trials"], e_max
+            )
+        return result[0]
+
+    # r has to be of the form x^2 + q*y^2.
+    prime_filter = PrimeFilter(residues=[-q])
+    exponents = []
     count = 0
-    count_max = 5 * e
-    while e < e_max:
-        # Then we solve for beta_1.
-        lhs = Integer(
-            (ell ** e - p * lamb ** 2 * Integer(beta_0.reduced_norm())) / N
-        )
-        y_1, z_1 = solve_linear_congruence(
-            2 * Integer(y_0) * p * lamb, p * lamb * 2 * z_0, lhs, N
-        )
-        y_1 = center_around(y_1, -2 * lamb * y_0, N)
-        z_1 = center_around(z_1, -2 * lamb * y_0, N)
-        beta_1 = Integer(y_1) + Integer(z_1) * i
-        assert mod(lhs, N) == mod(
-            p * lamb * (beta_0 * beta_1.conjugate()).reduced_trace(), N
-        )
-
-        # Now we calculate r.
-        r = Integer(
-            (ell ** e - p * (lamb * beta_0 + N * beta_1).reduced_norm())
-            / N ** 2
-        )
-
-        # In the paper they say that r can be the product of a prime and a
-        # smooth square. For simplicity I will just wait for r prime.
-        if not is_prime(r):
+    mu = None
+    samples = []
+
+    def collected_stats():
+        return {
+            "exponents": list(exponents),
+            "trials": count,
+            "filter": prime_filter.stats(),
+        }
+
+    for e, trials in scheduler.rounds():
+        if not exponents or exponents[-1] != e:
+            exponents.append(e)
+            # lambda depends on e, so it has to be recomputed whenever e
+            # changes.
+            lamb = strong_approximation_lambda(mu_0, N, ell, e)
+        for _ in range(trials):
+            check_budget(budget, "strong_approximation", collected_stats)
             count += 1
-            if count > count_max:
-                print("Increasing", e, e_max)
-                e += 2
-                count_max = 0
-
-            continue
-
-        sol = solve_norm_equation(1, r)
-        if sol is not None:
-            t_1, x_1 = sol
-            alpha_1 = t_1 + x_1 * i
-            mu_1 = alpha_1 + beta_1 * j
-            mu = lamb * mu_0 + N * mu_1
-            assert mu - lamb * mu_0 in O.left_ideal(O.basis()).scale(N)
-            assert mu.reduced_norm() == ell ** e
-            return mu
-
-        # This is sort of a random heuristic. Can do better.
-        count += 1
-        if count > count_max:
-            e += 2
-            count_max = 0
-
-    return None
-
-
-def special_ell_power_equiv(I, O, ell, print_progress=False):
+            mu = strong_approximation_trial(
+                mu_0,
+                N,
+                O,
+                ell,
+                e,
+                lamb,
+                prime_filter,
+                smooth_bound,
+                samples,
+                context,
+            )
+            scheduler.observe(samples.pop())
+            if mu is not None:
+                break
+        if mu is not None:
+            break
+
+    if stats is not None:
+        stats["exponents"] = exponents
+        stats["trials"] = count
+        stats["filter"] = prime_filter.stats()
+    if mu is None:
+        return StrongApproximationFailure(exponents, count, e_max)
+    return mu
+
+
+def special_ell_power_equiv(
+    I,
+    O,
+    ell,
+    print_progress=False,
+    executor=None,
+    profile=None,
+    context=None,
+    cache=None,
+    max_representatives=8,
+    budget=None,
+):
     """Solve ell isogeny problem where O is a special order.
 
     Args:
         I: A left O-ideal.
-        O: A special order in a quaternion algebra.
+        O: The special order of its algebra, see special_order_data.
         ell: A prime.
-        print_progress: True if you want to print progress.
+        print_progress: True if you want to print progress. Each stage is
+            printed with the time it took as it finishes.
+        executor: If not None, a concurrent.futures.Executor that
+            element_of_norm and strong_approximation run their searches on.
+        profile: If not None, a profiling.Profile that the time spent in
+            each stage and the counters of the searches are added to.
+        context: The AlgebraContext of the algebra of O or None. It is passed
+            on to every stage.
+        cache: If not None, a cache from cache.py that
+            prime_norm_representative uses.
+        max_representatives: If the steps after prime_norm_representative
+            fail for its N, the next representatives from
+            prime_norm_representatives are tried, up to this many in total.
+        budget: If not None, a cancellation.Budget that every search checks.
+            When it runs out, SearchAborted is raised by the search that was
+            running, with its stats.
 
     Returns:
         A pair (J, delta) where J = I*delta, delta is in the quaternion algebra
         and J is a nonfractional ideal in the same class as I that has ell
         power norm.
     """
-    assert all(x in O for x in I.basis())
+    if verify(VERIFY_FULL):
+        assert all(x in O for x in I.basis())
+    profile = get_profile(profile, print_progress)
+    context = algebra_context(O.quaternion_algebra(), context)
     ell = Integer(ell)
-    D = 4
-    I_prime, beta_I_prime = prime_norm_representative(I, O, D, ell)
-    N = Integer(I_prime.norm())
-    gamma = element_of_norm(N * ell ** 20, O)
-    # TODO: Handle failure to find gamma better.
-    if gamma is None:
-        raise ValueError("Couldn't find element of correct norm")
+    D = context.D
+    stats = {}
+    with profile.stage("prime_norm_representative"):
+        I_prime, beta_I_prime = prime_norm_representative(
+            I,
+            O,
+            D,
+            ell,
+            stats=stats,
+            context=context,
+            cache=cache,
+            budget=budget,
+        )
+    profile.count(
+        "prime_norm_representative",
+        candidates=stats["candidates"],
+        primes=survivors(stats["filter"]),
+    )
+    profile.note("prime_norm_representative", max_norm=stats["max_norm"])
+
+    # The later representatives are only searched for if they are needed.
+    representatives = prime_norm_representatives(
+        I,
+        O,
+        D,
+        ell,
+        min_norm=Integer(I_prime.norm()),
+        context=context,
+        budget=budget,
+    )
+    tried = []
+    while True:
+        N = Integer(I_prime.norm())
+        try:
+            beta = prime_norm_ell_power_equiv(
+                I_prime, O, ell, D, executor, profile, context, budget
+            )
+            break
+        except ValueError:
+            tried.append(N)
+            if len(tried) >= max_representatives:
+                raise
+        with profile.stage("prime_norm_representative"):
+            I_prime, beta_I_prime = next(representatives, (None, None))
+        if I_prime is None:
+            raise ValueError(
+                "No prime norm representative worked, tried N in "
+                + str(tried)
+            )
+        profile.count("prime_norm_representative", retries=1)
 
-    mu_0 = solve_ideal_equation(gamma, I_prime, D, N, O)
-    mu = strong_approximation(mu_0, N, O, ell)
-    assert gamma * mu in I_prime
-    beta = (gamma * mu).conjugate() / N
     J = I_prime.scale(beta)
     delta = beta_I_prime * beta
-    assert J.left_order() == O
-    assert Integer(J.norm()).prime_factors() == [ell]
-    assert [x in O for x in J.basis()]
+    if verify(VERIFY_CHEAP):
+        assert Integer(J.norm()).prime_factors() == [ell]
+    if verify(VERIFY_FULL):
+        assert J.left_order() == O
+        assert all(x in O for x in J.basis())
     return J, delta
 
 
-def ell_power_equiv(J, O, ell, print_progress=False):
+def prime_norm_ell_power_equiv(
+    I, O, ell, D, executor, profile, context, budget=None
+):
+    """Solves the ell isogeny problem for an ideal I of prime norm.
+
+    These are the steps of special_ell_power_equiv after
+    prime_norm_representative.
+
+    Returns:
+        beta such that I*beta has ell power norm.
+
+    Raises:
+        ValueError: If element_of_norm or strong_approximation fails for the
+            norm of I.
+    """
+    N = Integer(I.norm())
+    stats = {}
+    with profile.stage("element_of_norm"):
+        gamma = element_of_norm(
+            N * ell ** 20,
+            O,
+            stats=stats,
+            executor=executor,
+            context=context,
+            budget=budget,
+        )
+    profile.count(
+        "element_of_norm",
+        pairs=stats["pairs"],
+        primes=survivors(stats["filter"]),
+    )
+    if gamma is None:
+        raise ValueError("Couldn't find element of correct norm")
+
+    with profile.stage("ideal_equation"):
+        mu_0 = solve_ideal_equation(gamma, I, D, N, O, context=context)
+
+    stats = {}
+    with profile.stage("strong_approximation"):
+        mu = strong_approximation(
+            mu_0,
+            N,
+            O,
+            ell,
+            executor=executor,
+            stats=stats,
+            context=context,
+            budget=budget,
+        )
+    profile.count(
+        "strong_approximation",
+        trials=stats["trials"],
+        primes=survivors(stats["filter"]),
+    )
+    profile.note("strong_approximation", exponents=stats["exponents"])
+    if isinstance(mu, StrongApproximationFailure):
+        raise ValueError(
+            "strong_approximation failed after %s attempts with exponents %s"
+            % (mu.trials, mu.exponents)
+        )
+    if verify(VERIFY_FULL):
+        assert gamma * mu in I
+    return (gamma * mu).conjugate() / N
+
+
+# The part of ell_power_equiv that only depends on (B, O, ell). O_special is
+# the special maximal order of B, I is an O_special, O-connecting ideal and
+# gamma_1 is the element special_ell_power_equiv returns for I.
+EllPowerEquivSetup = namedtuple(
+    "EllPowerEquivSetup", ["O", "ell", "O_special", "I", "gamma_1"]
+)
+
+
+def ell_power_equiv_setup(
+    O, ell, executor=None, profile=None, context=None, cache=None, budget=None
+):
+    """Does the work of ell_power_equiv that does not depend on the ideal.
+
+    Args:
+        O: An order in a quaternion algebra.
+        ell: A prime.
+        executor: See ell_power_equiv.
+        profile: See special_ell_power_equiv.
+        context: The AlgebraContext of the algebra of O or None.
+        cache: If not None, a cache from cache.py that connecting_ideal and
+            prime_norm_representative use.
+        budget: See special_ell_power_equiv.
+
+    Returns:
+        An EllPowerEquivSetup that can be passed to ell_power_equiv. If the
+        algebra of O is swapped, see AlgebraContext, it is the setup of
+        swapped_order(O).
+    """
+    context = algebra_context(O.quaternion_algebra(), context)
+    if context.is_swapped:
+        return ell_power_equiv_setup(
+            swapped_order(O),
+            ell,
+            executor=executor,
+            profile=profile,
+            cache=cache,
+            budget=budget,
+        )
+    if not context.is_special:
+        raise NotImplementedError(
+            "The quaternion algebra must be special_quaternion_algebra(p) for"
+            " an odd prime p."
+        )
+
+    ell = Integer(ell)
+    O_special = context.O_special
+    profile = get_profile(profile)
+    with profile.stage("connecting_ideal"):
+        I = connecting_ideal(O_special, O, cache=cache)
+    I_1, gamma_1 = special_ell_power_equiv(
+        I,
+        O_special,
+        ell,
+        executor=executor,
+        profile=profile,
+        context=context,
+        cache=cache,
+        budget=budget,
+    )
+    return EllPowerEquivSetup(O, ell, O_special, I, gamma_1)
+
+
+def ell_power_equiv(
+    J,
+    O,
+    ell,
+    print_progress=False,
+    executor=None,
+    setup=None,
+    profile=None,
+    context=None,
+    cache=None,
+    budget=None,
+):
     """Solve ell isogeny problem.
 
-    This function only works in quaternion algebras with prime discriminant
-    p = 3 mod 4.
+    This function works in the quaternion algebras
+    special_quaternion_algebra(p) for odd primes p, and in
+    QuaternionAlgebra(p) for p = 1 mod 8, where i and j are swapped. There
+    the problem is mapped to special_quaternion_algebra(p) with swap_i_j,
+    solved there and mapped back.
 
     Args:
         J: A left O-ideal.
         O: An order in a quaternion algebra.
         ell: A prime.
-        print_progress: True if you want to print progress.
+        print_progress: True if you want to print progress, see
+            special_ell_power_equiv.
+        executor: If not None, a concurrent.futures.Executor to run the
+            searches on, see special_ell_power_equiv.
+        setup: The output of ell_power_equiv_setup(O, ell). If None it is
+            computed.
+        profile: If not None, a profiling.Profile. Every stage, including
+            the ones of the setup, is recorded in it. Stages that run more
+            than once add up.
+        context: The AlgebraContext of the algebra of O or None. Services
+            that solve many problems in the same algebra can get it once
+            with algebra_context(B) and pass it to every call.
+        cache: If not None, a cache from cache.py. gamma is stored in it under
+            the HNF of J and (p, ell, D), and a call for an ideal with the same
+            HNF returns the stored result without any search. It is also
+            passed on to the setup and prime_norm_representative.
+        budget: If not None, a cancellation.Budget shared by every search,
+            including the ones of the setup. A service can give each request
+            a deadline this way, or cancel it from another thread through the
+            token of the budget. When it runs out, SearchAborted is raised
+            with the stats of the search that was running.
 
     Returns:
         A pair (J, delta) where J = I*delta, delta is in the quaternion algebra
         and J is a nonfractional ideal in the same class as I that has ell
         power norm.
     """
-    B = O.quaternion_algebra()
-    if not is_prime(B.discriminant()) or not mod(B.discriminant(), 4) == 3:
-        raise NotImplementedError(
-            "The quaternion algebra must have prime" " discrimint p = 3 mod 4."
+    profile = get_profile(profile, print_progress)
+    context = algebra_context(O.quaternion_algebra(), context)
+    if context.is_swapped:
+        O_swapped = swapped_order(O)
+        B_swapped = O_swapped.quaternion_algebra()
+        # swap_i_j maps a basis of J to a basis of its image, so nothing has
+        # to be recomputed.
+        J_swapped = B_swapped.ideal(
+            [swap_i_j(x, B_swapped) for x in J.basis()],
+            left_order=O_swapped,
+            check=False,
         )
-
-    # When B has discriminant p = 3 mod 4 the call B.maximal_order() always
-    # returns the first maximal order in the cases environment in Lemma 2 of
-    # the paper. I probably shouldn't rely on this.
-    O_special = B.maximal_order()
-    I = connecting_ideal(O_special, O)
-    K = I * J
-    I_1, gamma_1 = special_ell_power_equiv(I, O_special, ell)
-    I_2, gamma_2 = special_ell_power_equiv(K, O_special, ell)
-    gamma = gamma_1.conjugate() * gamma_2 * I.norm()
+        _, gamma = ell_power_equiv(
+            J_swapped,
+            O_swapped,
+            ell,
+            executor=executor,
+            setup=setup,
+            profile=profile,
+            cache=cache,
+            budget=budget,
+        )
+        gamma = swap_i_j(gamma, context.B)
+        J_2 = J.scale(gamma)
+        if verify(VERIFY_CHEAP):
+            assert Integer(J_2.norm()).prime_factors() == [Integer(ell)]
+        return J_2, gamma
+    if cache is not None:
+        key = cache_key("ell_power_equiv", [J], context.B, ell, context.D)
+        cached = cached_elements(cache, key, context.B)
+        if cached is not None:
+            gamma = cached[0]
+            J_2 = J.scale(gamma)
+            if verify(VERIFY_CHEAP):
+                assert Integer(J_2.norm()).prime_factors() == [ell]
+            return J_2, gamma
+    if setup is None:
+        setup = ell_power_equiv_setup(
+            O,
+            ell,
+            executor=executor,
+            profile=profile,
+            context=context,
+            cache=cache,
+            budget=budget,
+        )
+    if verify(VERIFY_CHEAP):
+        assert setup.O == O and setup.ell == ell
+
+    I = setup.I
+    with profile.stage("connecting_ideal"):
+        K = I * J
+    I_2, gamma_2 = special_ell_power_equiv(
+        K,
+        setup.O_special,
+        setup.ell,
+        executor=executor,
+        profile=profile,
+        context=context,
+        cache=cache,
+        budget=budget,
+    )
+    gamma = setup.gamma_1.conjugate() * gamma_2 * I.norm()
     J_2 = J.scale(gamma)
-    assert J_2.left_order() == O
-    assert Integer(J_2.norm()).prime_factors() == [ell]
-    assert [x in O for x in J_2.basis()]
+    if verify(VERIFY_CHEAP):
+        assert Integer(J_2.norm()).prime_factors() == [ell]
+    if verify(VERIFY_FULL):
+        assert J_2.left_order() == O
+        assert all(x in O for x in J_2.basis())
+    if cache is not None:
+        store_elements(cache, key, [gamma])
     return J_2, gamma
+
+
+def verify_result(J, O, ell, J_2, gamma):
+    """Checks the output of ell_power_equiv once.
+
+    This does all the checks that matter for the final result, whatever the
+    verification level is, so the searches can run with the level set to
+    "off" and the result is still checked.
+
+    Args:
+        J: The left O-ideal that was passed to ell_power_equiv.
+        O: An order in a quaternion algebra.
+        ell: A prime.
+        J_2: The ideal returned by ell_power_equiv(J, O, ell).
+        gamma: The element returned by ell_power_equiv(J, O, ell).
+
+    Returns:
+        True if J_2 = J*gamma, J_2 is a left O-ideal contained in O and the
+        norm of J_2 is a power of ell.
+    """
+    nrd = J_2.norm()
+    return (
+        nrd in ZZ
+        and Integer(nrd).prime_factors() == [Integer(ell)]
+        and J_2 == J.scale(gamma)
+        and all(x in O for x in J_2.basis())
+        and J_2.left_order() == O
+    )
+
+
+def ell_power_equiv_batch(ideals, O, ell, executor=None):
+    """Solve the ell isogeny problem for many left O-ideals.
+
+    The connecting ideal and the solution for it are computed once and shared
+    by all the ideals, see ell_power_equiv_setup. With an executor the ideals
+    are solved in parallel, with a bounded number of ideals in flight, so
+    ideals can be a long or infinite iterator.
+
+    Args:
+        ideals: An iterable of left O-ideals.
+        O: An order in a quaternion algebra.
+        ell: A prime.
+        executor: If not None, a concurrent.futures.Executor. Each ideal is
+            solved by a separate task.
+
+    Yields:
+        Triples (index, J_2, gamma) where (J_2, gamma) is the output of
+        ell_power_equiv for the ideal at position index in ideals. With an
+        executor they are yielded in the order they complete, otherwise in
+        the order of ideals.
+    """
+    setup = ell_power_equiv_setup(O, ell, executor=executor)
+    ideals = enumerate(ideals)
+    if executor is None:
+        for index, J in ideals:
+            J_2, gamma = ell_power_equiv(J, O, ell, setup=setup)
+            yield index, J_2, gamma
+        return
+
+    pending = {}
+
+    def submit_next():
+        item = next(ideals, None)
+        if item is not None:
+            index, J = item
+            future = executor.submit(ell_power_equiv, J, O, ell, setup=setup)
+            pending[future] = index
+
+    for _ in range(2 * (cpu_count() or 1)):
+        submit_next()
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            J_2, gamma = future.result()
+            yield index, J_2, gamma
+            submit_next()
+
+
+def ell_isogeny_path(J, O, ell):
+    """Yields the ideals of norm ell of the ell-isogeny path of J.
+
+    J is a left O-ideal contained in O with norm a power of ell, like the J_2
+    that ell_power_equiv returns. It is first divided by the largest ell^s
+    with J in ell^s*O. That changes neither its class nor its right order,
+    and leaves a cyclic ideal of norm ell^e. Then I_k = J + ell^k*O is the
+    only left O-ideal of norm ell^k that contains J, and
+
+        L_k = conj(I_(k-1)) * I_k / ell^(k-1)
+
+    is an ideal of norm ell from O_(k-1), the right order of I_(k-1), to O_k,
+    with I_k = L_1 * ... * L_k.
+
+    The coordinates of J in the basis of O are computed once. I_k is then the
+    HNF of those coordinates modulo ell^k, so no entry is larger than ell^k.
+    O_k is computed from L_k as conj(L_k) * L_k / ell and becomes the left
+    order of L_(k+1), so no order is computed from scratch. Only one step is
+    computed at a time, so long paths are never held in memory.
+
+    Args:
+        J: A left O-ideal contained in O whose norm is a power of ell.
+        O: An order in a quaternion algebra.
+        ell: A prime.
+
+    Yields:
+        L_1, ..., L_e. The left order of L_k is set to O_(k-1).
+    """
+    ell = Integer(ell)
+    B = O.quaternion_algebra()
+    O_basis = list(O.basis())
+    coords = matrix(QQ, [x.coefficient_tuple() for x in J.basis()]) * (
+        matrix(QQ, [x.coefficient_tuple() for x in O_basis]).inverse()
+    )
+    if coords.denominator() != 1:
+        raise ValueError("J must be contained in O.")
+    rows = [[int(c) for c in row] for row in coords.rows()]
+    norm = Integer(J.norm())
+    while all(c % ell == 0 for row in rows for c in row):
+        rows = [[c // int(ell) for c in row] for row in rows]
+        norm = norm // ell ** 2
+    e = norm.valuation(ell) if norm != 1 else 0
+    if norm != ell ** e:
+        raise ValueError("The norm of J must be a power of ell.")
+    if verify(VERIFY_CHEAP):
+        assert abs(determinant(rows)) == ell ** (2 * e)
+    rows = hnf_mod(rows, ell ** e)
+
+    def prefix(k):
+        """Returns I_k = J + ell^k*O."""
+        H = hnf_mod(rows, ell ** k)
+        basis = [sum(c * x for c, x in zip(row, O_basis)) for row in H]
+        return B.ideal(basis, left_order=O, check=False)
+
+    I_prev = prefix(0)
+    O_prev = O
+    for k in range(1, e + 1):
+        I_k = prefix(k)
+        scale = QQ(1) / ell ** (k - 1)
+        L = B.ideal(
+            module_basis(
+                [
+                    scale * x.conjugate() * y
+                    for x in I_prev.basis()
+                    for y in I_k.basis()
+                ],
+                B,
+            ),
+            left_order=O_prev,
+            check=False,
+        )
+        if verify(VERIFY_CHEAP):
+            assert L.norm() == ell
+        if verify(VERIFY_FULL):
+            assert L.left_order() == O_prev
+        O_prev = B.quaternion_order(
+            module_basis(
+                [
+                    x.conjugate() * y / ell
+                    for x in L.basis()
+                    for y in L.basis()
+                ],
+                B,
+            ),
+            check=False,
+        )
+        if verify(VERIFY_FULL):
+            assert O_prev == L.right_order()
+        yield L
+        I_prev = I_k
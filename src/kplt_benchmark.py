@@ -0,0 +1,347 @@
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from sage.all import *
+from benchmark_stats import percentile
+from benchmark_stats import summary
+from kplt import algebra_context
+from kplt import element_of_norm
+from kplt import ell_power_equiv
+from kplt import left_ideal
+from kplt import prime_norm_representative
+from kplt import solve_ideal_equation
+from kplt import strong_approximation
+from profiling import Profile
+
+
+def special_prime(digits):
+    """Returns the smallest prime p = 3 mod 4 above 10^digits."""
+    p = next_prime(10 ** digits)
+    while mod(p, 4) != 3:
+        p = next_prime(p)
+    return p
+
+
+def random_ideal(O):
+    """Returns a random left O-ideal O*alpha + O*n with n | nrd(alpha)."""
+    while True:
+        alpha = O.random_element()
+        nrd = alpha.reduced_norm()
+        if nrd == 0:
+            continue
+        n = choice(Integer(nrd).divisors()[1:])
+        return left_ideal([alpha, n], O)
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process so far."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def isolated_stages(I, O, ell, seed, runs):
+    """Times the stages of special_ell_power_equiv one at a time.
+
+    The inputs of each stage are computed once from I, so every run of a
+    stage gets the same input and only that stage is timed.
+
+    Returns:
+        A dict from the name of each stage to the summary of its times.
+    """
+    context = algebra_context(O.quaternion_algebra())
+    D = context.D
+    I_prime, _ = prime_norm_representative(I, O, D, ell, context=context)
+    N = Integer(I_prime.norm())
+    gamma = element_of_norm(N * ell ** 20, O, context=context)
+    if gamma is None:
+        raise ValueError("element_of_norm found no element of norm N*ell^20")
+    mu_0 = solve_ideal_equation(gamma, I_prime, D, N, O, context=context)
+    stages = [
+        (
+            "prime_norm_representative",
+            lambda: prime_norm_representative(
+                I, O, D, ell, context=context
+            ),
+        ),
+        (
+            "element_of_norm",
+            lambda: element_of_norm(N * ell ** 20, O, context=context),
+        ),
+        (
+            "ideal_equation",
+            lambda: solve_ideal_equation(
+                gamma, I_prime, D, N, O, context=context
+            ),
+        ),
+        (
+            "strong_approximation",
+            lambda: strong_approximation(mu_0, N, O, ell, context=context),
+        ),
+    ]
+    result = {}
+    for name, stage in stages:
+        times = []
+        for t in range(runs):
+            set_random_seed(seed + t)
+            start = time.time()
+            stage()
+            times.append(time.time() - start)
+        result[name] = summary(times)
+    return result
+
+
+def run_case(digits, ell, seed, runs, trace_memory):
+    """Runs ell_power_equiv runs times on a random ideal.
+
+    The ideal only depends on (digits, ell, seed) and run number t uses the
+    random seed seed + t, so the whole case is reproducible. run() calls
+    this in a fresh process for every case, so the peak RSS is the one of
+    this case alone. The growth of the peak during the runs, after the
+    algebra and the ideal are set up, is reported separately.
+    """
+    p = special_prime(digits)
+    B = QuaternionAlgebra(p)
+    O = algebra_context(B).O_special
+    ell = Integer(ell)
+    set_random_seed(seed)
+    I = random_ideal(O)
+    baseline_rss = peak_rss_kb()
+
+    totals = []
+    stages = {}
+    traced_peaks = []
+    for t in range(runs):
+        set_random_seed(seed + t)
+        profile = Profile()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        ell_power_equiv(I, O, ell, profile=profile)
+        totals.append(time.time() - start)
+        if trace_memory:
+            traced_peaks.append(tracemalloc.get_traced_memory()[1] // 1024)
+            tracemalloc.stop()
+        for name, entry in profile.as_dict().items():
+            stage = stages.setdefault(name, {"time": [], "counters": {}})
+            stage["time"].append(entry["time"])
+            for key, n in entry["counters"].items():
+                stage["counters"].setdefault(key, []).append(n)
+
+    result = {
+        "digits": digits,
+        "p": str(p),
+        "ell": int(ell),
+        "seed": seed,
+        "norm": str(I.norm()),
+        "runs": runs,
+        "total": summary(totals),
+        "stages": dict(
+            (
+                name,
+                {
+                    "time": summary(stage["time"]),
+                    "counters": dict(
+                        (key, percentile(values, 50))
+                        for key, values in stage["counters"].items()
+                    ),
+                },
+            )
+            for name, stage in stages.items()
+        ),
+        "peak_rss_kb": peak_rss_kb(),
+        "rss_growth_kb": peak_rss_kb() - baseline_rss,
+        "isolated_stages": isolated_stages(I, O, ell, seed, runs),
+    }
+    if trace_memory:
+        result["peak_traced_kb"] = max(traced_peaks)
+    return result
+
+
+def case_key(case):
+    return "p=%s ell=%s seed=%s" % (case["p"], case["ell"], case["seed"])
+
+
+# Values below these floors, by unit, are compared as the floor, so that a
+# baseline of 0, like a counter of retries or the growth of the RSS, does not
+# turn any change into a huge ratio.
+COMPARE_FLOORS = {"s": 0.01, "kB": 1024, "": 1}
+
+
+def compare(old, new, threshold):
+    """Prints the cases and stages of new that got worse than in old.
+
+    A median time, a median counter, such as the number of candidates or
+    trials of a search, or a peak memory counts as a regression if it is
+    more than threshold times the old one, see COMPARE_FLOORS. Cases that
+    failed in either run are skipped. Returns the number of regressions.
+    """
+    old_cases = dict((case_key(case), case) for case in old["cases"])
+    regressions = 0
+    for case in new["cases"]:
+        key = case_key(case)
+        if key not in old_cases:
+            print("%s: not in the old results" % key)
+            continue
+        old_case = old_cases[key]
+        if "error" in case or "error" in old_case:
+            print(
+                "%s: failed, %s"
+                % (key, case.get("error") or old_case.get("error"))
+            )
+            continue
+        rows = [
+            ("total", "s", old_case["total"]["median"],
+             case["total"]["median"]),
+        ]
+        for name, stage in sorted(case["stages"].items()):
+            if name not in old_case["stages"]:
+                continue
+            old_stage = old_case["stages"][name]
+            rows.append((name, "s", old_stage["time"]["median"],
+                         stage["time"]["median"]))
+            for counter, n in sorted(stage["counters"].items()):
+                if counter in old_stage["counters"]:
+                    rows.append(("%s.%s" % (name, counter), "",
+                                 old_stage["counters"][counter], n))
+        for name, stage in sorted(case.get("isolated_stages", {}).items()):
+            old_stage = old_case.get("isolated_stages", {}).get(name)
+            if old_stage is not None:
+                rows.append(("isolated %s" % name, "s", old_stage["median"],
+                             stage["median"]))
+        for field in ["peak_rss_kb", "rss_growth_kb", "peak_traced_kb"]:
+            if field in case and field in old_case:
+                rows.append((field, "kB", old_case[field], case[field]))
+        for name, unit, old_value, new_value in rows:
+            floor = COMPARE_FLOORS[unit]
+            ratio = max(new_value, floor) / max(old_value, floor)
+            flag = ""
+            if ratio > threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            print(
+                "%-32s %-36s %11.3f %11.3f %-2s %6.2fx %s"
+                % (key, name, old_value, new_value, unit, ratio, flag)
+            )
+    return regressions
+
+
+def run(args):
+    cases = []
+    # Each case runs in a fresh process, so its peak memory is its own.
+    spawn = multiprocessing.get_context("spawn")
+    for digits in args.digits:
+        for ell in args.ell:
+            for seed in range(args.seed, args.seed + args.ideals):
+                try:
+                    with ProcessPoolExecutor(
+                        1, mp_context=spawn
+                    ) as executor:
+                        case = executor.submit(
+                            run_case,
+                            digits,
+                            ell,
+                            seed,
+                            args.runs,
+                            args.memory,
+                        ).result()
+                except Exception as e:
+                    # A failed case, for example a search that found
+                    # nothing, must not stop the rest of the grid.
+                    case = {
+                        "digits": digits,
+                        "p": str(special_prime(digits)),
+                        "ell": ell,
+                        "seed": seed,
+                        "error": "%s: %s" % (type(e).__name__, e),
+                    }
+                    print("%-32s %s" % (case_key(case), case["error"]))
+                else:
+                    print(
+                        "%-32s %9.3f s median %9.3f s p95"
+                        % (
+                            case_key(case),
+                            case["total"]["median"],
+                            case["total"]["p95"],
+                        )
+                    )
+                cases.append(case)
+    results = {
+        "config": {
+            "digits": args.digits,
+            "ell": args.ell,
+            "ideals": args.ideals,
+            "runs": args.runs,
+            "seed": args.seed,
+        },
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark ell_power_equiv and compare results."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser(
+        "run", help="Run the benchmark and write the results as JSON."
+    )
+    run_parser.add_argument(
+        "--digits",
+        type=int_list,
+        default=[3, 6, 10, 15, 20, 30],
+        help="The sizes of p as exponents of 10, separated by commas. p is "
+        "the smallest suitable prime above 10^digits.",
+    )
+    run_parser.add_argument("--ell", type=int_list, default=[2, 3])
+    run_parser.add_argument(
+        "--ideals",
+        type=int,
+        default=3,
+        help="The number of random ideals for each p and ell.",
+    )
+    run_parser.add_argument(
+        "--runs", type=int, default=5, help="The number of runs per ideal."
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also trace the peak Python memory of each run. This is slow.",
+    )
+    run_parser.add_argument("--output", default="kplt_benchmark.json")
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two result files."
+    )
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Flag median times that grew by more than this factor.",
+    )
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,296 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from math import lcm
+from os import cpu_count
+
+from sage.rings.integer import Integer
+from sage.rings.rational_field import QQ
+from kplt import algebra_context
+from kplt import special_quaternion_algebra
+from profiling import Profile
+from serialization import IdealReader
+from serialization import IdealWriter
+from serialization import ideal_from_record
+from service import solve
+from service import warm_worker
+
+# The format of a JSON lines record.
+#
+# An input record is an object with the keys
+#
+#     p: An odd prime. The ideal is in special_quaternion_algebra(p).
+#     ell: A prime.
+#     basis: The basis of a left ideal J, as 4 lists of 4 rational numbers,
+#         the coefficients of 1, i, j, k, written as strings like "-3/2". It
+#         has to be a Z-basis of a left O-ideal, this is not checked.
+#     order: Optional. The basis of the left order O of J in the same form.
+#         If it is missing, O is the special maximal order of the algebra.
+#     id: Optional. Any value, it is copied to the output record.
+#
+# An output record has the keys index, the position of the input record
+# starting from 0, id if the input had one, p and ell, and then either
+#
+#     basis: The basis of J_2 = J*delta in the same form.
+#     delta: The 4 coefficients of delta.
+#     timings: The seconds each stage of ell_power_equiv took and the total.
+#
+# or error, the message of the exception ell_power_equiv raised.
+#
+# With the binary format of serialization.py, an input file only holds ideal
+# bases, so p and ell are given on the command line. An output file holds J_2
+# and delta, with the index and the timings in the info of the record. A
+# failed input gets a FAILED record with the index and the error in its info,
+# so the output stays aligned with the input, and the error is also reported
+# on stderr. A FAILED record in a binary input fails again in the output.
+
+
+def coefficients(x):
+    return [str(c) for c in x.coefficient_tuple()]
+
+
+def basis_from_record(denominator, entries):
+    """Converts a binary record to the basis of a JSON record."""
+    return [
+        [str(Fraction(x, denominator)) for x in entries[4 * r:4 * r + 4]]
+        for r in range(4)
+    ]
+
+
+def record_from_basis(basis):
+    """Converts the basis of a JSON record to (denominator, entries)."""
+    coeffs = [Fraction(c) for row in basis for c in row]
+    denominator = lcm(*[c.denominator for c in coeffs])
+    return denominator, [int(c * denominator) for c in coeffs]
+
+
+def solve_task(task, timeout=None):
+    """Returns the output record of the input record task."""
+    result = dict(
+        (key, task[key]) for key in ("index", "id", "p", "ell") if key in task
+    )
+    if "error" in task:
+        result["error"] = task["error"]
+        return result
+    try:
+        B = special_quaternion_algebra(task["p"])
+        ell = Integer(task["ell"])
+        if "order" in task:
+            O = B.quaternion_order(
+                [B([QQ(c) for c in row]) for row in task["order"]]
+            )
+        else:
+            O = algebra_context(B).O_special
+        # The basis is used as it is, like IdealReader does, so nothing about
+        # J is recomputed.
+        if "record" in task:
+            J = ideal_from_record(O, *task["record"])
+        else:
+            basis = [B([QQ(c) for c in row]) for row in task["basis"]]
+            J = B.ideal(basis, left_order=O, check=False)
+        profile = Profile()
+        J_2, delta = solve(J, O, ell, timeout, profile)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        return result
+    result["basis"] = [coefficients(x) for x in J_2.basis()]
+    result["delta"] = coefficients(delta)
+    timings = dict(
+        (name, entry["time"]) for name, entry in profile.as_dict().items()
+    )
+    timings["total"] = profile.total_time()
+    result["timings"] = timings
+    return result
+
+
+def read_tasks(args, f, skip):
+    """Yields the input records after the first skip, one at a time."""
+    if args.input_format == "jsonl":
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if index >= skip:
+                task = json.loads(line)
+                task["index"] = index
+                yield task
+            index += 1
+    else:
+        if args.p is None or args.ell is None:
+            raise SystemExit("--p and --ell are needed for binary input.")
+        for index, (denominator, entries, _, info) in enumerate(
+            IdealReader(f).records()
+        ):
+            if index < skip:
+                continue
+            task = {"index": index, "p": args.p, "ell": args.ell}
+            if denominator is None:
+                task["error"] = (info or {}).get("error", "Failed record")
+            else:
+                task["record"] = (denominator, entries)
+            yield task
+
+
+class Output(object):
+    """Writes the output records and the checkpoint.
+
+    The checkpoint is a small JSON file holding the number of records written
+    and the size of the output file after the last of them. It is replaced
+    atomically after each record. On resume, the output is truncated to that
+    size, so a record that was only partly written is dropped and written
+    again.
+    """
+
+    def __init__(self, args):
+        self.format = args.output_format
+        self.checkpoint = args.checkpoint
+        self.records = 0
+        offset = 0
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            self.records = state["records"]
+            offset = state["offset"]
+        if args.output is None:
+            if self.checkpoint is not None:
+                raise SystemExit("--checkpoint needs --output.")
+            self.f = sys.stdout.buffer
+        elif offset:
+            self.f = open(args.output, "r+b")
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        else:
+            self.f = open(args.output, "wb")
+        if self.format == "binary":
+            self.writer = IdealWriter(self.f, header=not offset)
+
+    def write(self, result):
+        if self.format == "jsonl":
+            line = json.dumps(result, sort_keys=True) + "\n"
+            self.f.write(line.encode())
+        elif "error" in result:
+            print(
+                "record %d: %s" % (result["index"], result["error"]),
+                file=sys.stderr,
+            )
+            info = {"index": result["index"], "error": result["error"]}
+            self.writer.write_record(None, None, None, info)
+        else:
+            denominator, entries = record_from_basis(result["basis"])
+            delta = [
+                (c.numerator, c.denominator)
+                for c in map(Fraction, result["delta"])
+            ]
+            info = {"index": result["index"], "timings": result["timings"]}
+            self.writer.write_record(denominator, entries, delta, info)
+        self.f.flush()
+        self.records += 1
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        state = {"records": self.records, "offset": self.f.tell()}
+        path = self.checkpoint + ".tmp"
+        with open(path, "w") as f:
+            json.dump(state, f)
+        os.replace(path, self.checkpoint)
+
+    def close(self):
+        if self.f is not sys.stdout.buffer:
+            self.f.close()
+
+
+def run(args):
+    """Solves the input records and writes them in input order.
+
+    At most window records are in flight, so the input is never held in
+    memory as a whole. Records are written as soon as they and all records
+    before them are done.
+    """
+    output = Output(args)
+    binary = args.input_format == "binary"
+    if args.input == "-":
+        f = sys.stdin.buffer if binary else sys.stdin
+    else:
+        f = open(args.input, "rb" if binary else "r")
+    tasks = read_tasks(args, f, output.records)
+    try:
+        if args.workers == 0:
+            for task in tasks:
+                output.write(solve_task(task, args.timeout))
+            return
+        primes = [] if args.p is None else [args.p]
+        window = args.window or 2 * args.workers
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=warm_worker,
+            initargs=(primes,),
+        ) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(
+                    executor.submit(solve_task, task, args.timeout)
+                )
+                if len(pending) >= window:
+                    output.write(pending.popleft().result())
+            while pending:
+                output.write(pending.popleft().result())
+    finally:
+        output.close()
+        if f not in (sys.stdin, sys.stdin.buffer):
+            f.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run ell_power_equiv on a stream of ideals."
+    )
+    parser.add_argument(
+        "input", nargs="?", default="-", help="The input file, - for stdin."
+    )
+    parser.add_argument("--output", help="The output file. Default stdout.")
+    parser.add_argument(
+        "--input-format", choices=["jsonl", "binary"], default="jsonl"
+    )
+    parser.add_argument(
+        "--output-format", choices=["jsonl", "binary"], default="jsonl"
+    )
+    parser.add_argument(
+        "--p", type=int, help="The prime p of all ideals of a binary input."
+    )
+    parser.add_argument(
+        "--ell",
+        type=int,
+        help="The prime ell of all ideals of a binary input.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=cpu_count() or 1,
+        help="The number of worker processes. 0 runs everything in this "
+        "process.",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=None,
+        help="The number of records in flight. Default twice the workers.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="The number of seconds each record may take.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="A file recording the progress. If it exists, the run resumes "
+        "after the last record written to --output.",
+    )
+    run(parser.parse_args())
@@ -0,0 +1,147 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sage.all import *
+from kplt import algebra_context
+from kplt import left_ideal
+from kplt import verify_result
+from kplt_cli import basis_from_record
+from kplt_cli import record_from_basis
+from kplt_cli import run
+from serialization import IdealReader
+from serialization import IdealWriter
+
+
+class CliTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def args(self, **kwargs):
+        args = dict(
+            input=os.path.join(self.dir, "input.jsonl"),
+            output=os.path.join(self.dir, "output.jsonl"),
+            input_format="jsonl",
+            output_format="jsonl",
+            p=None,
+            ell=None,
+            workers=0,
+            window=None,
+            timeout=None,
+            checkpoint=os.path.join(self.dir, "checkpoint.json"),
+        )
+        args.update(kwargs)
+        return argparse.Namespace(**args)
+
+    def test_records(self):
+        basis = [
+            ["1/2", "0", "1/2", "0"],
+            ["0", "1/2", "0", "-1/2"],
+            ["0", "0", "3", "0"],
+            ["0", "0", "0", "3"],
+        ]
+        denominator, entries = record_from_basis(basis)
+        self.assertEqual(denominator, 2)
+        self.assertEqual(entries[:4], [1, 0, 1, 0])
+        self.assertEqual(basis_from_record(denominator, entries), basis)
+
+    def test_resume(self):
+        B = QuaternionAlgebra(59)
+        O = algebra_context(B).O_special
+        i, j, k = B.gens()
+        alpha = 2 * i - 2 * j + 2 * k
+        ideals = [left_ideal([alpha, n], O) for n in [24, 12, 8]]
+        lines = [
+            json.dumps(
+                {
+                    "id": n,
+                    "p": 59,
+                    "ell": 3,
+                    "basis": [
+                        [str(c) for c in x.coefficient_tuple()]
+                        for x in I.basis()
+                    ],
+                }
+            )
+            for n, I in enumerate(ideals)
+        ]
+        args = self.args()
+        with open(args.input, "w") as f:
+            f.write("\n".join(lines[:2]) + "\n")
+        run(args)
+        with open(args.output) as f:
+            first = f.read()
+        self.assertEqual(len(first.splitlines()), 2)
+
+        # A third record is appended and only it is solved on resume.
+        with open(args.input, "a") as f:
+            f.write(lines[2] + "\n")
+        run(args)
+        with open(args.output) as f:
+            text = f.read()
+        self.assertTrue(text.startswith(first))
+        results = [json.loads(line) for line in text.splitlines()]
+        self.assertEqual([r["index"] for r in results], [0, 1, 2])
+        for I, result in zip(ideals, results):
+            self.assertEqual(result["id"], result["index"])
+            J_2 = left_ideal(
+                [B([QQ(c) for c in row]) for row in result["basis"]], O
+            )
+            delta = B([QQ(c) for c in result["delta"]])
+            self.assertTrue(verify_result(I, O, Integer(3), J_2, delta))
+            self.assertIn("total", result["timings"])
+
+    def test_binary_failures(self):
+        B = QuaternionAlgebra(59)
+        O = algebra_context(B).O_special
+        i, j, k = B.gens()
+        alpha = 2 * i - 2 * j + 2 * k
+        ideals = [left_ideal([alpha, n], O) for n in [24, 12]]
+        args = self.args(
+            input=os.path.join(self.dir, "input.bin"),
+            output=os.path.join(self.dir, "output.bin"),
+            input_format="binary",
+            output_format="binary",
+            p=59,
+            ell=3,
+        )
+        with open(args.input, "wb") as f:
+            writer = IdealWriter(f)
+            writer.write(ideals[0])
+            writer.write(None, info={"error": "bad input"})
+            writer.write(ideals[1])
+        run(args)
+        with open(args.output, "rb") as f:
+            records = list(IdealReader(f).records())
+        # The failed record keeps the output aligned with the input.
+        self.assertEqual(len(records), 3)
+        self.assertEqual(
+            [info["index"] for _, _, _, info in records], [0, 1, 2]
+        )
+        self.assertEqual(records[1][:3], (None, None, None))
+        self.assertIn("bad input", records[1][3]["error"])
+        for I, index in zip(ideals, [0, 2]):
+            denominator, entries, delta, info = records[index]
+            J_2 = left_ideal(
+                [
+                    B([QQ(c) for c in row])
+                    for row in basis_from_record(denominator, entries)
+                ],
+                O,
+            )
+            delta = B([QQ(n) / d for n, d in delta])
+            self.assertTrue(verify_result(I, O, Integer(3), J_2, delta))
+            self.assertIn("total", info["timings"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,12 +11,16 @@ from kplt import strong_approximation
 from kplt import special_ell_power_equiv
 from kplt import solve_ideal_equation
 from kplt import connecting_ideal
+from cancellation import Budget
+from cancellation import SearchAborted
 from kplt import ell_power_equiv
+from kplt import special_quaternion_algebra
+from profiling import Profile
 
-large_primes = (next_prime(x) for x in range(1000000000, 1010000000))
-primes_generator = (x for x in large_primes if mod(x, 4) == 3)
+# All odd primes are used, so each of the special orders is exercised.
+primes_generator = (next_prime(x) for x in range(1000000000, 1010000000))
 for p in primes_generator:
-    B = QuaternionAlgebra(p)
+    B = special_quaternion_algebra(p)
     O = B.maximal_order()
     ell = Integer(2)
     alpha = O.random_element()
@@ -26,10 +30,16 @@ for p in primes_generator:
     if I == O:
         print("I == O")
     print("p = ", p, "I = ", I)
-    if p == 311:
-        continue
     start = time.time()
+    profile = Profile()
     # The assert statements at in the function ell_power_equiv ensure that the
     # result is correct.
-    _ = ell_power_equiv(I, O, ell)
+    try:
+        _ = ell_power_equiv(
+            I, O, ell, profile=profile, budget=Budget(timeout=600)
+        )
+    except SearchAborted as e:
+        print(e, e.stats)
     end = time.time() - start
+    print(profile.report())
+    print("total: %.3f s" % end)
@@ -1,17 +1,45 @@
 from __future__ import print_function
 
+import itertools
 import unittest
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from sage.all import *
+from sage.algebras.quatalg.quaternion_algebra import quaternion_algebra_cython
 
 from kplt import prime_norm_representative
+from kplt import prime_norm_representatives
 from kplt import element_of_norm
+from kplt import element_of_norm_task
 from kplt import left_ideal
 from kplt import strong_approximation
+from kplt import strong_approximation_batch
 from kplt import special_ell_power_equiv
 from kplt import solve_ideal_equation
 from kplt import connecting_ideal
+from kplt import ell_power_equiv
+from kplt import ell_power_equiv_batch
+from kplt import set_verification_level
+from kplt import verify_result
+from kplt import reduced_basis
+from kplt import smooth_square_part
+from kplt import algebra_context
+from kplt import ExponentScheduler
+from kplt import StrongApproximationFailure
+from kplt import ell_isogeny_path
+from kplt import ell_power_equiv_setup
+from kplt import module_basis
+from kplt import norm_form_density
+from kplt import special_quaternion_algebra
+from kplt import swap_i_j
+from kplt import swapped_order
+from profiling import Profile
+from cache import MemoryCache
+from cache import lattice_key
+from cancellation import Budget
+from cancellation import CancellationToken
+from cancellation import SearchAborted
 
 set_random_seed(0)
 
@@ -25,6 +53,17 @@ class IdealsTest(unittest.TestCase):
         t = time.time() - self.startTime
         print("%s: %.3f" % (self.id(), t))
 
+    def test_algebra_context(self):
+        B = QuaternionAlgebra(1019)
+        context = algebra_context(B)
+        self.assertTrue(algebra_context(B) is context)
+        self.assertTrue(algebra_context(B, context) is context)
+        self.assertEqual((context.p, context.q), (1019, 1))
+        self.assertTrue(context.O_special == B.maximal_order())
+        self.assertEqual(context.ceil_log_p(2), 10)
+        other = QuaternionAlgebra(1031)
+        self.assertTrue(algebra_context(other).B is other)
+
     def test_connecting_ideal(self):
         B = QuaternionAlgebra(59)
         i, j, k = B.gens()
@@ -35,6 +74,22 @@ class IdealsTest(unittest.TestCase):
         self.assertTrue(J.right_order() == O_2)
         self.assertTrue(all(x in O_1 for x in J.basis()))
 
+    def test_left_ideal(self):
+        B = QuaternionAlgebra(1000003)
+        i, j, k = B.gens()
+        O = B.maximal_order()
+        alpha = 3 + 5 * i + 7 * j + 11 * k
+        I = left_ideal([alpha, 1009], O)
+        products = [x * y for x in O.basis() for y in [alpha, 1009]]
+        Z, d = (quaternion_algebra_cython.
+                integral_matrix_and_denom_from_rational_quaternions(products))
+        H = Z.hermite_form(include_zero_rows=False)
+        expected = (quaternion_algebra_cython.
+                    rational_quaternions_from_integral_matrix_and_denom(
+                        B, H, d))
+        self.assertEqual(list(I.basis()), list(expected))
+        self.assertTrue(I.left_order() == O)
+
     def test_prime_norm_representative(self):
         B = QuaternionAlgebra(59)
         O = B.maximal_order()
@@ -42,6 +97,67 @@ class IdealsTest(unittest.TestCase):
         J, _ = prime_norm_representative(I, O, 4, 2)
         self.assertTrue(is_prime(Integer(J.norm())) and J.left_order() == O)
 
+    def test_prime_norm_representative_deterministic(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j + 5 * k, 10007], O)
+        stats = {}
+        J_1, gamma_1 = prime_norm_representative(I, O, 4, 3, stats=stats)
+        J_2, gamma_2 = prime_norm_representative(I, O, 4, 3)
+        self.assertTrue(J_1 == J_2 and gamma_1 == gamma_2)
+        self.assertTrue(stats["candidates"] >= 1)
+        with self.assertRaises(ValueError):
+            prime_norm_representative(I, O, 4, 3, max_norm=1)
+
+    def test_prime_norm_representatives(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j + 5 * k, 10007], O)
+        first = prime_norm_representative(I, O, 4, 3)
+        representatives = list(
+            itertools.islice(prime_norm_representatives(I, O, 4, 3), 4)
+        )
+        self.assertTrue(representatives[0] == first)
+        norms = [Integer(J.norm()) for J, _ in representatives]
+        self.assertEqual(norms, sorted(set(norms)))
+        self.assertTrue(all(is_prime(N) for N in norms))
+        later = next(prime_norm_representatives(I, O, 4, 3, min_norm=norms[0]))
+        self.assertEqual(Integer(later[0].norm()), norms[1])
+
+    def test_reduced_basis(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j + 5 * k, 10007], O)
+        basis = reduced_basis(I)
+        self.assertTrue(O.left_ideal(basis) == I)
+        norms = [x.reduced_norm() for x in basis]
+        self.assertTrue(norms == sorted(norms))
+        self.assertTrue(reduced_basis(I) is basis)
+
+    def test_smooth_square_part(self):
+        r = 2 ** 5 * 3 ** 4 * 7 * 1009 ** 2 * 10007
+        s, m = smooth_square_part(r, 1000)
+        self.assertEqual(s, 2 ** 2 * 3 ** 2)
+        self.assertEqual(m, 2 * 7 * 1009 ** 2 * 10007)
+        self.assertEqual(smooth_square_part(r, 0), (1, r))
+        self.assertEqual(smooth_square_part(10007, 1000), (1, 10007))
+
+    def test_solve_ideal_equation(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j + 5 * k, 10007], O)
+        I_prime, _ = prime_norm_representative(I, O, 4, 3)
+        N = Integer(I_prime.norm())
+        gamma = element_of_norm(N * 3 ** 20, O)
+        mu_0 = solve_ideal_equation(gamma, I_prime, 4, N, O)
+        t, x, _, _ = mu_0.coefficient_tuple()
+        self.assertTrue(mu_0 != 0 and t == x == 0)
+        self.assertTrue(gamma * mu_0 in I_prime)
+
     def test_strong_approximation(self):
         B = QuaternionAlgebra(59)
         ell = 3
@@ -52,6 +168,107 @@ class IdealsTest(unittest.TestCase):
         mu = strong_approximation(mu_0, N, O, ell)
         self.assertTrue(Integer(mu.reduced_norm()).prime_factors() == [ell])
 
+    def test_budget(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j + 5 * k, 10007], O)
+        with self.assertRaises(SearchAborted) as cm:
+            prime_norm_representative(
+                I, O, 4, 3, budget=Budget(max_iterations=0)
+            )
+        self.assertEqual(cm.exception.stage, "prime_norm_representative")
+        self.assertEqual(cm.exception.stats["candidates"], 0)
+
+        B = QuaternionAlgebra(59)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        token = CancellationToken()
+        token.cancel()
+        N = next_prime(100000)
+        with self.assertRaises(SearchAborted) as cm:
+            strong_approximation(
+                16 * j + 24 * k, N, O, 3, budget=Budget(token=token)
+            )
+        self.assertEqual(cm.exception.reason, "cancelled")
+        self.assertEqual(cm.exception.stats["trials"], 0)
+
+        # The tasks on an executor stop at the deadline on their own.
+        expired = Budget(deadline=time.monotonic() - 1).for_task()
+        gamma, stats = element_of_norm_task(
+            N * 3 ** 20, O, 100, None, (0, 101), 1, expired
+        )
+        self.assertEqual((gamma, stats["pairs"]), (None, 0))
+        # lambda only exists for one parity of e.
+        e = 40 if mod(3 ** 40 * 59 * 832, N).is_square() else 41
+        mu, stats = strong_approximation_batch(
+            16 * j + 24 * k, N, O, 3, e, 16, 1, 1, expired
+        )
+        self.assertEqual((mu, stats["trials"]), (None, 0))
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            with self.assertRaises(SearchAborted) as cm:
+                strong_approximation(
+                    16 * j + 24 * k,
+                    N,
+                    O,
+                    3,
+                    executor=executor,
+                    budget=Budget(timeout=0),
+                )
+        self.assertEqual(cm.exception.reason, "deadline")
+
+    def test_exponent_scheduler(self):
+        scheduler = ExponentScheduler(10, 20, 2, 5)
+        self.assertEqual(next(scheduler.rounds()), (10, scheduler.pilot))
+        for _ in range(8):
+            scheduler.observe(2 ** 12)
+        self.assertEqual(scheduler.success_probability(12), 0)
+        self.assertTrue(scheduler.success_probability(14) > 0)
+        rounds = list(scheduler.rounds())
+        self.assertEqual(rounds[0][0], 14)
+        exponents = [e for e, _ in rounds]
+        self.assertEqual(exponents, sorted(set(exponents)))
+        self.assertTrue(all(e < 20 for e in exponents))
+        self.assertFalse(StrongApproximationFailure([14], 10, 20))
+
+    def test_strong_approximation_parallel(self):
+        B = QuaternionAlgebra(59)
+        ell = 3
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        N = next_prime(100000)
+        mu_0 = 16 * j + 24 * k
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            mu_1 = strong_approximation(
+                mu_0, N, O, ell, executor=executor, seed=1
+            )
+            mu_2 = strong_approximation(
+                mu_0, N, O, ell, executor=executor, seed=1
+            )
+            # The window only changes how many batches are in flight.
+            mu_3 = strong_approximation(
+                mu_0, N, O, ell, executor=executor, seed=1, window=1
+            )
+            mu_4 = strong_approximation(
+                mu_0, N, O, ell, executor=executor, seed=1, window=7
+            )
+        self.assertTrue(Integer(mu_1.reduced_norm()).prime_factors() == [ell])
+        self.assertTrue(mu_1 == mu_2)
+        self.assertTrue(mu_3 == mu_1)
+        self.assertTrue(mu_4 == mu_1)
+
+    def test_element_of_norm_parallel(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        M = 3 * 2 ** 40
+        stats = {}
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            gamma = element_of_norm(
+                M, O, bound=200, executor=executor, stats=stats
+            )
+        self.assertTrue(gamma == element_of_norm(M, O, bound=200))
+        self.assertTrue(stats["pairs"] >= 1)
+
     def test_element_of_norm(self):
         B = QuaternionAlgebra(59)
         O = B.maximal_order()
@@ -60,6 +277,20 @@ class IdealsTest(unittest.TestCase):
         gamma = element_of_norm(M, O)
         self.assertTrue(gamma.reduced_norm() == M)
 
+    def test_element_of_norm_batched(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        M = 3 * 2 ** 40
+        stats = {}
+        gamma = element_of_norm(M, O, bound=200, block_size=16, stats=stats)
+        self.assertTrue(gamma.reduced_norm() == M)
+        unsieved = {}
+        self.assertTrue(
+            gamma == element_of_norm(M, O, bound=200, stats=unsieved)
+        )
+        # The sieve only drops pairs, so it never tests more of them.
+        self.assertTrue(stats["pairs"] <= unsieved["pairs"])
+
     def test_element_of_norm_large(self):
         B = QuaternionAlgebra(1019)
         O = B.maximal_order()
@@ -80,6 +311,30 @@ class IdealsTest(unittest.TestCase):
         self.assertTrue(Integer(J.norm()).prime_factors() == [ell])
         self.assertTrue([x in O for x in J.basis()])
 
+    def test_special_ell_power_equiv_profile(self):
+        B = QuaternionAlgebra(59)
+        ell = Integer(3)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j, 13], O)
+        profile = Profile()
+        special_ell_power_equiv(I, O, ell, profile=profile)
+        stages = profile.as_dict()
+        self.assertEqual(
+            list(stages),
+            [
+                "prime_norm_representative",
+                "element_of_norm",
+                "ideal_equation",
+                "strong_approximation",
+            ],
+        )
+        self.assertTrue(all(s["calls"] == 1 for s in stages.values()))
+        self.assertTrue(stages["element_of_norm"]["counters"]["primes"] >= 1)
+        self.assertTrue(
+            stages["strong_approximation"]["counters"]["trials"] >= 1
+        )
+
     def ell_power_equiv(self):
         B = QuaternionAlgebra(59)
         ell = Integer(3)
@@ -94,6 +349,147 @@ class IdealsTest(unittest.TestCase):
         self.assertTrue(Integer(J.norm()).prime_factors() == [ell])
         self.assertTrue([x in O for x in J.basis()])
 
+    def test_ell_power_equiv_cache(self):
+        B = QuaternionAlgebra(59)
+        ell = Integer(3)
+        i, j, k = B.gens()
+        gens = [(1 + k) / 2, (i + j) / 2, j, k]
+        O = B.quaternion_order(gens)
+        I = left_ideal([2 * i - 2 * j + 2 * k, 24], O)
+        cache = MemoryCache()
+        J_1, gamma_1 = ell_power_equiv(I, O, ell, cache=cache)
+        profile = Profile()
+        J_2, gamma_2 = ell_power_equiv(
+            O.left_ideal(I.basis()), O, ell, cache=cache, profile=profile
+        )
+        self.assertTrue(J_1 == J_2 and gamma_1 == gamma_2)
+        self.assertEqual(len(profile.as_dict()), 0)
+
+    def test_ell_isogeny_path(self):
+        B = QuaternionAlgebra(59)
+        ell = Integer(3)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        I = left_ideal([1 + 2 * j, 13], O)
+        J, _ = ell_power_equiv(I, O, ell)
+        path = list(ell_isogeny_path(J, O, ell))
+        e = Integer(J.norm()).valuation(ell)
+        self.assertEqual((e - len(path)) % 2, 0)
+        self.assertTrue(all(L.norm() == ell for L in path))
+        self.assertTrue(path[0].left_order() == O)
+        for L_1, L_2 in zip(path, path[1:]):
+            self.assertTrue(L_1.right_order() == L_2.left_order())
+        basis = list(O.basis())
+        for L in path:
+            basis = module_basis(
+                [x * y for x in basis for y in L.basis()], B
+            )
+        s = (e - len(path)) // 2
+        self.assertEqual(
+            lattice_key(basis), lattice_key(J.scale(QQ(1) / ell ** s).basis())
+        )
+        # Multiples of J by ell have the same path.
+        scaled = list(ell_isogeny_path(J.scale(ell), O, ell))
+        self.assertEqual(
+            [lattice_key(L.basis()) for L in scaled],
+            [lattice_key(L.basis()) for L in path],
+        )
+
+    def test_special_orders(self):
+        # p = 3 mod 4, 5 mod 8 and 1 mod 8 twice.
+        for p, q in [(59, 1), (101, 2), (113, 3), (73, 7)]:
+            B = special_quaternion_algebra(p)
+            context = algebra_context(B)
+            self.assertEqual((context.p, context.q, context.D), (p, q, 4 * q))
+            O = context.O_special
+            self.assertEqual(O.discriminant(), p)
+            self.assertTrue(all(x in O for x in B.gens()))
+        self.assertEqual(context.norm_density, 0.5)
+        # x^2 + 11*y^2 is one of 3 reduced forms of discriminant -44.
+        self.assertEqual(norm_form_density(11), 1.0 / 6)
+        # QuaternionAlgebra(73) is (-73, -7 | Q), with i and j swapped.
+        O_special = algebra_context(special_quaternion_algebra(73)).O_special
+        B = QuaternionAlgebra(73)
+        self.assertTrue(algebra_context(B).is_swapped)
+        O = B.quaternion_order([swap_i_j(x, B) for x in O_special.basis()])
+        self.assertTrue(swapped_order(O) == O_special)
+        self.assertEqual(swap_i_j(swap_i_j(B.gens()[2], B), B), B.gens()[2])
+        self.assertTrue(ell_power_equiv_setup(O, 3).O == O_special)
+        with self.assertRaises(NotImplementedError):
+            ell_power_equiv_setup(
+                QuaternionAlgebra(QQ, -1, -1).maximal_order(), 3
+            )
+
+    def test_ell_power_equiv_p_1_mod_4(self):
+        ell = Integer(3)
+        for p, n in [(101, 17), (113, 19), (73, 37)]:
+            B = special_quaternion_algebra(p)
+            i, j, k = B.gens()
+            O = B.maximal_order()
+            alpha = 1 + j
+            J = left_ideal([alpha, n], O)
+            J_2, gamma = ell_power_equiv(J, O, ell)
+            self.assertTrue(verify_result(J, O, ell, J_2, gamma))
+
+        # In QuaternionAlgebra(p) the result is mapped back from
+        # special_quaternion_algebra(p).
+        B = QuaternionAlgebra(73)
+        i, j, k = B.gens()
+        O = B.quaternion_order(
+            [
+                swap_i_j(x, B)
+                for x in algebra_context(
+                    special_quaternion_algebra(73)
+                ).O_special.basis()
+            ]
+        )
+        J = left_ideal([1 + i, 37], O)
+        contexts = [
+            algebra_context(B),
+            algebra_context(special_quaternion_algebra(73)),
+        ]
+        for _ in range(2):
+            J_2, gamma = ell_power_equiv(J, O, ell)
+            self.assertTrue(verify_result(J, O, ell, J_2, gamma))
+        # Both algebras have discriminant 73 and keep their own context.
+        self.assertTrue(algebra_context(B) is contexts[0])
+        self.assertTrue(
+            algebra_context(special_quaternion_algebra(73)) is contexts[1]
+        )
+
+    def test_ell_power_equiv_batch(self):
+        B = QuaternionAlgebra(59)
+        ell = Integer(3)
+        i, j, k = B.gens()
+        gens = [(1 + k) / 2, (i + j) / 2, j, k]
+        O = B.quaternion_order(gens)
+        alpha = 2 * i - 2 * j + 2 * k
+        ideals = [left_ideal([alpha, n], O) for n in [24, 12, 8]]
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(ell_power_equiv_batch(ideals, O, ell, executor))
+        self.assertEqual(sorted(index for index, _, _ in results), [0, 1, 2])
+        for index, J, gamma in results:
+            self.assertTrue(J == ideals[index].scale(gamma))
+            self.assertTrue(J.left_order() == O)
+            self.assertTrue(Integer(J.norm()).prime_factors() == [ell])
+
+    def test_verification_level(self):
+        B = QuaternionAlgebra(59)
+        ell = Integer(3)
+        i, j, k = B.gens()
+        gens = [(1 + k) / 2, (i + j) / 2, j, k]
+        O = B.quaternion_order(gens)
+        I = left_ideal([2 * i - 2 * j + 2 * k, 24], O)
+        previous = set_verification_level("off")
+        try:
+            J, gamma = ell_power_equiv(I, O, ell)
+        finally:
+            set_verification_level(previous)
+        self.assertTrue(verify_result(I, O, ell, J, gamma))
+        self.assertFalse(verify_result(I, O, ell, J, 2 * gamma))
+        with self.assertRaises(ValueError):
+            set_verification_level("some")
+
 
 if __name__ == "__main__":
     # We do this instead of unittest.main() so that the time for each test is
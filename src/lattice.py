@@ -0,0 +1,222 @@
+from __future__ import division, print_function
+
+from fractions import Fraction
+from math import isqrt
+
+
+def cholesky_form(gram):
+    """Returns the coefficients of the quadratic completion of gram.
+
+    Writes Q(x) = x^T * gram * x as
+
+        Q(x) = sum_i q[i][i] * (x_i + sum_{j > i} q[i][j] * x_j)^2.
+
+    This is the decomposition used by Fincke-Pohst enumeration, see Algorithm
+    2.7.6 in Cohen's "A Course in Computational Algebraic Number Theory".
+
+    Args:
+        gram: A symmetric positive definite matrix given as a list of lists of
+            integers or Fractions.
+
+    Returns:
+        The matrix q as a list of lists of Fractions. Only the diagonal and the
+        entries above it are meaningful.
+    """
+    n = len(gram)
+    q = [[Fraction(x) for x in row] for row in gram]
+    for i in range(n):
+        if q[i][i] <= 0:
+            raise ValueError("The Gram matrix must be positive definite.")
+        for j in range(i + 1, n):
+            q[j][i] = q[i][j]
+            q[i][j] = q[i][j] / q[i][i]
+        for k in range(i + 1, n):
+            for l in range(k, n):
+                q[k][l] -= q[k][i] * q[i][l]
+    return q
+
+
+def short_vectors(gram, bound):
+    """Yields every nonzero x with x^T * gram * x <= bound.
+
+    Only one of x and -x is returned, namely the one whose first nonzero
+    coordinate is positive. All arithmetic is exact, so this works for Gram
+    matrices with arbitrarily large entries.
+
+    Args:
+        gram: A symmetric positive definite matrix given as a list of lists of
+            integers or Fractions.
+        bound: A nonnegative integer or Fraction.
+
+    Yields:
+        Pairs (norm, x) where x is a tuple of integers and norm is the value
+        x^T * gram * x as a Fraction. The order is not specified.
+    """
+    n = len(gram)
+    q = cholesky_form(gram)
+    bound = Fraction(bound)
+    x = [0] * n
+
+    def search(i, remaining):
+        # remaining = bound - sum_{l > i} q[l][l] * (x_l + U_l)^2.
+        centre = -sum(q[i][j] * x[j] for j in range(i + 1, n))
+        radius = isqrt(int(remaining / q[i][i])) + 1
+        # The interval below is slightly too large. The exact condition is
+        # checked for every x_i.
+        lo = int(centre) - radius - 1
+        hi = int(centre) + radius + 1
+        for x_i in range(lo, hi + 1):
+            rest = remaining - q[i][i] * (x_i - centre) ** 2
+            if rest < 0:
+                continue
+            x[i] = x_i
+            if i == 0:
+                yield bound - rest, tuple(x)
+            else:
+                for result in search(i - 1, rest):
+                    yield result
+        x[i] = 0
+
+    for norm, vec in search(n - 1, bound):
+        first = next((c for c in vec if c != 0), 0)
+        if first > 0:
+            yield norm, vec
+
+
+def vectors_by_norm(gram, max_norm=None):
+    """Yields the nonzero vectors of a lattice in order of increasing norm.
+
+    The vectors are found in shells lower < Q(x) <= upper where the upper
+    bound doubles each time, so no vector is returned twice. Only one of x and
+    -x is returned.
+
+    Args:
+        gram: A symmetric positive definite matrix given as a list of lists of
+            integers or Fractions.
+        max_norm: Stop after all vectors of norm at most max_norm have been
+            returned. If None the generator never stops.
+
+    Yields:
+        Pairs (norm, x) as in short_vectors, sorted by norm and then by x.
+    """
+    lower = Fraction(0)
+    upper = min(Fraction(gram[i][i]) for i in range(len(gram)))
+    while max_norm is None or lower < max_norm:
+        if max_norm is not None:
+            upper = min(upper, Fraction(max_norm))
+        shell = sorted(
+            (norm, vec)
+            for norm, vec in short_vectors(gram, upper)
+            if norm > lower
+        )
+        for norm, vec in shell:
+            yield norm, vec
+        lower, upper = upper, 2 * upper
+
+
+def xgcd(a, b):
+    """Returns (g, s, t) with g = gcd(a, b) = s*a + t*b and g >= 0."""
+    s_0, s_1, t_0, t_1 = 1, 0, 0, 1
+    while b != 0:
+        q, r = divmod(a, b)
+        a, b = b, r
+        s_0, s_1 = s_1, s_0 - q * s_1
+        t_0, t_1 = t_1, t_0 - q * t_1
+    if a < 0:
+        return -a, -s_0, -t_0
+    return a, s_0, t_0
+
+
+def determinant(rows):
+    """Returns the determinant of a square integer matrix.
+
+    Uses Bareiss' fraction free elimination, so all intermediate values are
+    integers of size comparable to the minors of the matrix.
+    """
+    a = [list(row) for row in rows]
+    n = len(a)
+    sign, prev = 1, 1
+    for c in range(n):
+        pivot = next((r for r in range(c, n) if a[r][c] != 0), None)
+        if pivot is None:
+            return 0
+        if pivot != c:
+            a[c], a[pivot] = a[pivot], a[c]
+            sign = -sign
+        for r in range(c + 1, n):
+            for l in range(c + 1, n):
+                a[r][l] = (a[r][l] * a[c][c] - a[r][c] * a[c][l]) // prev
+        prev = a[c][c]
+    return sign * a[n - 1][n - 1]
+
+
+class ModularHNF(object):
+    """The Hermite normal form of a full rank lattice, one vector at a time.
+
+    The lattice is the span of the vectors passed to add() together with
+    modulus * Z^n, so modulus should be a multiple of the determinant of the
+    lattice the vectors span, or the result is the HNF of a larger lattice.
+
+    The rows modulus * e_i are part of the state from the start. Every
+    vector that is added is reduced by the current rows before it is merged
+    in, so no entry ever grows much beyond modulus, no matter how many
+    vectors are added. This is what makes it cheaper than computing the HNF
+    of all the vectors at once.
+    """
+
+    def __init__(self, n, modulus):
+        modulus = abs(modulus)
+        if modulus == 0:
+            raise ValueError("The modulus must be nonzero.")
+        self.n = n
+        self.rows = [
+            [modulus if r == c else 0 for c in range(n)] for r in range(n)
+        ]
+
+    def add(self, vector):
+        """Adds an integer vector of length n to the lattice."""
+        v = list(vector)
+        for c in range(self.n):
+            h = self.rows[c]
+            q = v[c] // h[c]
+            if q != 0:
+                v = [x - q * y for x, y in zip(v, h)]
+            if v[c] == 0:
+                continue
+            g, s, t = xgcd(h[c], v[c])
+            a, b = h[c] // g, v[c] // g
+            self.rows[c] = [s * x + t * y for x, y in zip(h, v)]
+            v = [a * y - b * x for x, y in zip(h, v)]
+            self.reduce_row(c)
+
+    def reduce_row(self, r):
+        """Reduces the entries right of the diagonal in row r."""
+        row = self.rows[r]
+        for c in range(r + 1, self.n):
+            q = row[c] // self.rows[c][c]
+            if q != 0:
+                row = [x - q * y for x, y in zip(row, self.rows[c])]
+        self.rows[r] = row
+
+    def hnf(self):
+        """Returns the Hermite normal form as a list of rows.
+
+        The matrix is upper triangular with positive diagonal entries and
+        each entry right of the diagonal is in [0, d) where d is the diagonal
+        entry in its column.
+        """
+        for r in range(self.n):
+            self.reduce_row(r)
+        return [list(row) for row in self.rows]
+
+
+def hnf_mod(vectors, modulus):
+    """Returns the HNF of the span of vectors and modulus * Z^n.
+
+    See ModularHNF.
+    """
+    vectors = [list(v) for v in vectors]
+    builder = ModularHNF(len(vectors[0]), modulus)
+    for v in vectors:
+        builder.add(v)
+    return builder.hnf()
@@ -0,0 +1,87 @@
+from __future__ import print_function
+
+import itertools
+import unittest
+from fractions import Fraction
+
+from lattice import ModularHNF
+from lattice import determinant
+from lattice import hnf_mod
+from lattice import short_vectors
+from lattice import vectors_by_norm
+
+
+def quadratic_form(gram, x):
+    return sum(gram[r][c] * x[r] * x[c] for r in range(len(x))
+               for c in range(len(x)))
+
+
+class LatticeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gram = [
+            [4, 1, 0, -1],
+            [1, 6, 2, 0],
+            [0, 2, 5, 1],
+            [-1, 0, 1, 9],
+        ]
+
+    def brute_force(self, bound):
+        return sorted(
+            (Fraction(quadratic_form(self.gram, x)), x)
+            for x in itertools.product(range(-6, 7), repeat=4)
+            if 0 < quadratic_form(self.gram, x) <= bound
+            and next(c for c in x if c != 0) > 0
+        )
+
+    def test_short_vectors(self):
+        res = sorted(short_vectors(self.gram, 30))
+        self.assertEqual(res, self.brute_force(30))
+
+    def test_short_vectors_rational(self):
+        gram = [[Fraction(x, 3) for x in row] for row in self.gram]
+        res = sorted(short_vectors(gram, 10))
+        expected = [(norm / 3, x) for norm, x in self.brute_force(30)]
+        self.assertEqual(res, expected)
+
+    def test_vectors_by_norm(self):
+        res = list(vectors_by_norm(self.gram, max_norm=30))
+        self.assertEqual(res, self.brute_force(30))
+        self.assertEqual(len(set(x for _, x in res)), len(res))
+
+    def test_vectors_by_norm_unbounded(self):
+        gen = vectors_by_norm(self.gram)
+        res = [next(gen) for _ in range(50)]
+        norms = [norm for norm, _ in res]
+        self.assertEqual(norms, sorted(norms))
+
+    def test_determinant(self):
+        self.assertEqual(determinant(self.gram), 846)
+        self.assertEqual(determinant([[0, 1], [1, 0]]), -1)
+        self.assertEqual(determinant([[1, 2], [2, 4]]), 0)
+
+    def test_hnf_mod(self):
+        vectors = [
+            [2, 4, 6, 8],
+            [0, 3, 5, 7],
+            [1, 1, 0, 0],
+            [0, 0, 4, 2],
+            [5, -3, 2, 11],
+        ]
+        modulus = determinant(vectors[:4])
+        H = hnf_mod(vectors, modulus)
+        self.assertEqual(
+            H, [[1, 0, 1, 1], [0, 1, 1, 0], [0, 0, 2, 1], [0, 0, 0, 6]]
+        )
+        self.assertEqual(hnf_mod(vectors, 3 * modulus), H)
+
+    def test_modular_hnf_incremental(self):
+        builder = ModularHNF(2, 12)
+        builder.add([4, 2])
+        self.assertEqual(builder.hnf(), [[4, 2], [0, 6]])
+        builder.add([0, 1])
+        self.assertEqual(builder.hnf(), [[4, 0], [0, 1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
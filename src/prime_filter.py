@@ -0,0 +1,149 @@
+from __future__ import print_function
+
+from sage.arith.misc import gcd
+from sage.arith.misc import is_prime
+from sage.arith.misc import is_pseudoprime
+from sage.arith.misc import kronecker
+from sage.misc.misc_c import prod
+from sage.rings.fast_arith import prime_range
+from sage.rings.integer import Integer
+
+
+class PrimeFilter(object):
+    """Staged test that decides which candidate norms are worth keeping.
+
+    The search loops in kplt.py try many integers n and only keep those that
+    are prime and satisfy a few extra conditions. Proving primality is by far
+    the most expensive of these checks, so the cheap checks are run first and
+    each candidate is rejected by the first stage it fails. The stages are, in
+    order:
+
+        "sieve": n must have no prime factor below sieve_bound (other than n
+            itself). This costs a single gcd with a precomputed primorial.
+        "symbol": kronecker(a, n) must be 1 for every a in residues and -1 for
+            every a in nonresidues.
+        "exclude": n must not divide any element of exclude.
+        "probable_prime": n must pass is_pseudoprime.
+
+    Candidates that survive every stage are only probable primes. Use prove()
+    on the candidate that is finally used if primality matters.
+
+    The number of candidates and the number rejected at each stage are kept,
+    see stats() and hit_rates().
+    """
+
+    STAGES = ("sieve", "symbol", "exclude", "probable_prime")
+
+    def __init__(self, residues=(), nonresidues=(), exclude=(),
+                 sieve_bound=1000):
+        """
+        Args:
+            residues: Integers that must be squares modulo n.
+            nonresidues: Integers that must not be squares modulo n.
+            exclude: Integers that n must not divide.
+            sieve_bound: Trial divide by all primes below this bound.
+        """
+        self.residues = [Integer(a) for a in residues]
+        self.nonresidues = [Integer(a) for a in nonresidues]
+        self.exclude = [Integer(m) for m in exclude]
+        self.sieve_bound = Integer(sieve_bound)
+        self.small_primes = frozenset(prime_range(sieve_bound))
+        self.primorial = prod(self.small_primes)
+        self.candidates = 0
+        self.proofs = 0
+        self.rejected = dict((stage, 0) for stage in self.STAGES)
+
+    def __call__(self, n):
+        """Returns True if n survives every stage."""
+        self.candidates += 1
+        stage = self.first_failure(Integer(n))
+        if stage is None:
+            return True
+        self.rejected[stage] += 1
+        return False
+
+    def first_failure(self, n):
+        """Returns the name of the first stage n fails or None."""
+        if n < 2:
+            return "sieve"
+        if n < self.sieve_bound:
+            if n not in self.small_primes:
+                return "sieve"
+        elif gcd(n, self.primorial) != 1:
+            return "sieve"
+
+        # Every integer is a square modulo 2.
+        if n == 2:
+            if self.nonresidues:
+                return "symbol"
+        elif not (
+            all(kronecker(a, n) == 1 for a in self.residues)
+            and all(kronecker(a, n) == -1 for a in self.nonresidues)
+        ):
+            return "symbol"
+
+        if any(n.divides(m) for m in self.exclude):
+            return "exclude"
+
+        if not is_pseudoprime(n):
+            return "probable_prime"
+
+        return None
+
+    def prove(self, n):
+        """Returns True if n is provably prime."""
+        self.proofs += 1
+        return is_prime(n)
+
+    def stats(self):
+        """Returns the counters as a dict."""
+        return {
+            "candidates": self.candidates,
+            "rejected": dict(self.rejected),
+            "proofs": self.proofs,
+        }
+
+    def hit_rates(self):
+        """Returns the fraction of candidates each stage rejected.
+
+        The rate of a stage is relative to the number of candidates that
+        reached it, not to the total number of candidates.
+        """
+        rates = {}
+        remaining = self.candidates
+        for stage in self.STAGES:
+            rejected = self.rejected[stage]
+            rates[stage] = float(rejected) / remaining if remaining else 0.0
+            remaining -= rejected
+        return rates
+
+
+def merge_stats(stats):
+    """Adds up the output of PrimeFilter.stats() for several filters.
+
+    Args:
+        stats: An iterable of dicts as returned by PrimeFilter.stats().
+
+    Returns:
+        A dict of the same shape holding the totals.
+    """
+    total = {
+        "candidates": 0,
+        "rejected": dict((stage, 0) for stage in PrimeFilter.STAGES),
+        "proofs": 0,
+    }
+    for s in stats:
+        total["candidates"] += s["candidates"]
+        total["proofs"] += s["proofs"]
+        for stage, count in s["rejected"].items():
+            total["rejected"][stage] += count
+    return total
+
+
+def survivors(stats):
+    """Returns the number of candidates that passed every stage.
+
+    Args:
+        stats: A dict as returned by PrimeFilter.stats() or merge_stats().
+    """
+    return stats["candidates"] - sum(stats["rejected"].values())
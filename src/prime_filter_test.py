@@ -0,0 +1,43 @@
+from __future__ import print_function
+
+import unittest
+
+from sage.all import *
+from prime_filter import PrimeFilter
+from prime_filter import survivors
+
+
+class PrimeFilterTest(unittest.TestCase):
+
+    def test_prime_filter(self):
+        prime_filter = PrimeFilter(nonresidues=[3], exclude=[4, 3, 59])
+        accepted = [n for n in range(-5, 5000) if prime_filter(n)]
+        expected = [
+            n for n in range(-5, 5000)
+            if is_prime(n) and n not in (2, 3, 59)
+            and not mod(3, n).is_square()
+        ]
+        self.assertEqual(accepted, expected)
+        self.assertEqual(prime_filter.candidates, 5005)
+        stats = prime_filter.stats()
+        self.assertEqual(
+            sum(stats["rejected"].values()), 5005 - len(expected)
+        )
+        self.assertEqual(survivors(stats), len(expected))
+        self.assertTrue(all(0 <= x <= 1
+                            for x in prime_filter.hit_rates().values()))
+
+    def test_residues(self):
+        prime_filter = PrimeFilter(residues=[-1])
+        n = next_prime(10 ** 30)
+        while mod(n, 4) != 1:
+            n = next_prime(n)
+        self.assertTrue(prime_filter(n))
+        self.assertTrue(prime_filter.prove(n))
+        self.assertFalse(prime_filter(n * next_prime(n)))
+        self.assertFalse(prime_filter(997 * n))
+        self.assertEqual(prime_filter.rejected["sieve"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
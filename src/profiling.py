@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextlib import nullcontext
+from time import perf_counter
+
+
+class Profile(object):
+    """Collects the time spent in each stage of a computation and counters.
+
+    Pass an instance as the profile argument of ell_power_equiv and the
+    functions it calls. Each stage records the number of times it ran, the
+    total time spent in it, counters that are added up over the runs and
+    values that are appended to a list, see stage(), count() and note().
+
+    Args:
+        callback: If not None, called as callback(name, elapsed, entry) every
+            time a stage finishes, where entry is the dict for the stage as
+            in as_dict().
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = OrderedDict()
+
+    def entry(self, name):
+        try:
+            return self.stages[name]
+        except KeyError:
+            entry = {
+                "calls": 0,
+                "time": 0.0,
+                "counters": OrderedDict(),
+                "values": OrderedDict(),
+            }
+            self.stages[name] = entry
+            return entry
+
+    @contextmanager
+    def stage(self, name):
+        """Times the body of a with statement as one run of a stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            entry = self.entry(name)
+            entry["calls"] += 1
+            entry["time"] += elapsed
+            if self.callback is not None:
+                self.callback(name, elapsed, entry)
+
+    def count(self, name, **counters):
+        """Adds the given amounts to the counters of a stage."""
+        entry = self.entry(name)["counters"]
+        for key, n in counters.items():
+            entry[key] = entry.get(key, 0) + n
+
+    def note(self, name, **values):
+        """Appends the given values to the lists of values of a stage."""
+        entry = self.entry(name)["values"]
+        for key, value in values.items():
+            entry.setdefault(key, []).append(value)
+
+    def total_time(self):
+        return sum(entry["time"] for entry in self.stages.values())
+
+    def as_dict(self):
+        """Returns the stages as a dict of plain dicts and lists.
+
+        The keys are the names of the stages in the order they first ran.
+        """
+        return OrderedDict(
+            (
+                name,
+                {
+                    "calls": entry["calls"],
+                    "time": entry["time"],
+                    "counters": dict(entry["counters"]),
+                    "values": dict(
+                        (key, list(values))
+                        for key, values in entry["values"].items()
+                    ),
+                },
+            )
+            for name, entry in self.stages.items()
+        )
+
+    def report(self):
+        """Returns a table of the stages as a string."""
+        lines = ["%-28s %6s %10s" % ("stage", "calls", "time (s)")]
+        for name, entry in self.stages.items():
+            lines.append(
+                "%-28s %6d %10.3f" % (name, entry["calls"], entry["time"])
+            )
+            for key, n in entry["counters"].items():
+                lines.append("    %-24s %s" % (key, n))
+            for key, values in entry["values"].items():
+                lines.append(
+                    "    %-24s %s" % (key, " ".join(str(x) for x in values))
+                )
+        return "\n".join(lines)
+
+
+class NullProfile(object):
+    """A Profile that records nothing.
+
+    This is what the functions in kplt.py use when no profile is passed, so
+    instrumenting a stage costs a couple of method calls.
+    """
+
+    enabled = False
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, **counters):
+        pass
+
+    def note(self, name, **values):
+        pass
+
+
+NO_PROFILE = NullProfile()
+
+
+def print_stage(name, elapsed, entry):
+    """A callback for Profile that prints every stage as it finishes."""
+    print("%-28s %8.3f s" % (name, elapsed))
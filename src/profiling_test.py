@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import unittest
+
+from profiling import NO_PROFILE
+from profiling import Profile
+
+
+class ProfileTest(unittest.TestCase):
+
+    def test_profile(self):
+        finished = []
+        profile = Profile(
+            callback=lambda name, elapsed, entry: finished.append(name)
+        )
+        for e in [10, 12]:
+            with profile.stage("search"):
+                profile.count("search", trials=3, primes=1)
+                profile.note("search", exponents=e)
+        with profile.stage("setup"):
+            pass
+        stages = profile.as_dict()
+        self.assertEqual(list(stages), ["search", "setup"])
+        self.assertEqual(stages["search"]["calls"], 2)
+        self.assertEqual(
+            stages["search"]["counters"], {"trials": 6, "primes": 2}
+        )
+        self.assertEqual(stages["search"]["values"], {"exponents": [10, 12]})
+        self.assertEqual(finished, ["search", "search", "setup"])
+        self.assertTrue(profile.total_time() >= 0)
+        self.assertTrue("exponents" in profile.report())
+
+    def test_stage_records_failures(self):
+        profile = Profile()
+        with self.assertRaises(ValueError):
+            with profile.stage("search"):
+                raise ValueError()
+        self.assertEqual(profile.as_dict()["search"]["calls"], 1)
+
+    def test_no_profile(self):
+        with NO_PROFILE.stage("search"):
+            NO_PROFILE.count("search", trials=1)
+            NO_PROFILE.note("search", exponents=1)
+        self.assertFalse(NO_PROFILE.enabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
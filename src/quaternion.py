@@ -0,0 +1,164 @@
+from __future__ import print_function
+
+
+class IntegralQuaternion(object):
+    """An element t + x*i + y*j + z*k of (a, b | Q) with integer coefficients.
+
+    Sage quaternion elements have rational coefficients and every operation
+    goes through coercion, which is slow in the loops of kplt.py that do a
+    few multiplications and norms per iteration. This class only stores the
+    four coefficients as Python ints together with the invariants a = i^2 and
+    b = j^2 of the algebra, and the formulas are written out for (a, b).
+
+    Use from_sage() and to_sage() to convert at the boundaries.
+    """
+
+    __slots__ = ("t", "x", "y", "z", "a", "b")
+
+    def __init__(self, t, x, y, z, a, b):
+        self.t = int(t)
+        self.x = int(x)
+        self.y = int(y)
+        self.z = int(z)
+        self.a = int(a)
+        self.b = int(b)
+
+    @classmethod
+    def from_sage(cls, alpha):
+        """Returns alpha, an element of a Sage quaternion algebra.
+
+        The coefficients of alpha in the basis 1, i, j, k must be integers.
+        """
+        a, b = alpha.parent().invariants()
+        t, x, y, z = alpha.coefficient_tuple()
+        if any(c.denominator() != 1 for c in (t, x, y, z)):
+            raise ValueError("The coefficients must be integers.")
+        return cls(t, x, y, z, a, b)
+
+    def to_sage(self, B):
+        """Returns this element as an element of the Sage algebra B."""
+        return B([self.t, self.x, self.y, self.z])
+
+    def coefficient_tuple(self):
+        return (self.t, self.x, self.y, self.z)
+
+    def __iter__(self):
+        return iter(self.coefficient_tuple())
+
+    def __getstate__(self):
+        return (self.t, self.x, self.y, self.z, self.a, self.b)
+
+    def __setstate__(self, state):
+        self.t, self.x, self.y, self.z, self.a, self.b = state
+
+    def __repr__(self):
+        return "IntegralQuaternion(%d, %d, %d, %d, a=%d, b=%d)" % (
+            self.t,
+            self.x,
+            self.y,
+            self.z,
+            self.a,
+            self.b,
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, IntegralQuaternion):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def check_parent(self, other):
+        if self.a != other.a or self.b != other.b:
+            raise ValueError("The elements are in different algebras.")
+
+    def __add__(self, other):
+        if not isinstance(other, IntegralQuaternion):
+            return NotImplemented
+        self.check_parent(other)
+        return IntegralQuaternion(
+            self.t + other.t,
+            self.x + other.x,
+            self.y + other.y,
+            self.z + other.z,
+            self.a,
+            self.b,
+        )
+
+    def __sub__(self, other):
+        if not isinstance(other, IntegralQuaternion):
+            return NotImplemented
+        self.check_parent(other)
+        return IntegralQuaternion(
+            self.t - other.t,
+            self.x - other.x,
+            self.y - other.y,
+            self.z - other.z,
+            self.a,
+            self.b,
+        )
+
+    def __neg__(self):
+        return IntegralQuaternion(
+            -self.t, -self.x, -self.y, -self.z, self.a, self.b
+        )
+
+    def __mul__(self, other):
+        if not isinstance(other, IntegralQuaternion):
+            # Multiplication by an integer.
+            n = int(other)
+            if n != other:
+                return NotImplemented
+            return IntegralQuaternion(
+                n * self.t, n * self.x, n * self.y, n * self.z, self.a, self.b
+            )
+        self.check_parent(other)
+        a, b = self.a, self.b
+        t_1, x_1, y_1, z_1 = self.t, self.x, self.y, self.z
+        t_2, x_2, y_2, z_2 = other.t, other.x, other.y, other.z
+        return IntegralQuaternion(
+            t_1 * t_2 + a * x_1 * x_2 + b * y_1 * y_2 - a * b * z_1 * z_2,
+            t_1 * x_2 + x_1 * t_2 - b * y_1 * z_2 + b * z_1 * y_2,
+            t_1 * y_2 + y_1 * t_2 + a * x_1 * z_2 - a * z_1 * x_2,
+            t_1 * z_2 + z_1 * t_2 + x_1 * y_2 - y_1 * x_2,
+            a,
+            b,
+        )
+
+    def __rmul__(self, other):
+        # Integers commute with everything.
+        return self.__mul__(other)
+
+    def conjugate(self):
+        return IntegralQuaternion(
+            self.t, -self.x, -self.y, -self.z, self.a, self.b
+        )
+
+    def reduced_norm(self):
+        """Returns t^2 - a*x^2 - b*y^2 + a*b*z^2."""
+        a, b = self.a, self.b
+        return (
+            self.t ** 2
+            - a * self.x ** 2
+            - b * self.y ** 2
+            + a * b * self.z ** 2
+        )
+
+    def reduced_trace(self):
+        return 2 * self.t
+
+    def trace_pairing(self, other):
+        """Returns trd(self * conjugate(other)) without forming the product."""
+        self.check_parent(other)
+        a, b = self.a, self.b
+        return 2 * (
+            self.t * other.t
+            - a * self.x * other.x
+            - b * self.y * other.y
+            + a * b * self.z * other.z
+        )
@@ -0,0 +1,57 @@
+from __future__ import print_function
+
+import random
+import unittest
+
+from quaternion import IntegralQuaternion
+
+
+class IntegralQuaternionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def random_element(self, a, b):
+        return IntegralQuaternion(
+            *[self.rng.randint(-50, 50) for _ in range(4)], a=a, b=b
+        )
+
+    def test_gens(self):
+        a, b = -1, -7
+        one = IntegralQuaternion(1, 0, 0, 0, a, b)
+        i = IntegralQuaternion(0, 1, 0, 0, a, b)
+        j = IntegralQuaternion(0, 0, 1, 0, a, b)
+        k = IntegralQuaternion(0, 0, 0, 1, a, b)
+        self.assertEqual(i * i, a * one)
+        self.assertEqual(j * j, b * one)
+        self.assertEqual(i * j, k)
+        self.assertEqual(j * i, -k)
+        self.assertEqual(k * k, -a * b * one)
+
+    def test_norm_and_trace(self):
+        for a, b in [(-1, -3), (-1, -1000003), (-2, -5), (3, -7)]:
+            for _ in range(20):
+                x = self.random_element(a, b)
+                y = self.random_element(a, b)
+                self.assertEqual(
+                    (x * y).reduced_norm(), x.reduced_norm() * y.reduced_norm()
+                )
+                self.assertEqual(
+                    x * x.conjugate(),
+                    IntegralQuaternion(x.reduced_norm(), 0, 0, 0, a, b),
+                )
+                self.assertEqual(
+                    x.trace_pairing(y), (x * y.conjugate()).reduced_trace()
+                )
+                self.assertEqual((x * y) * x, x * (y * x))
+                self.assertEqual(x + y - y, x)
+
+    def test_different_algebras(self):
+        x = IntegralQuaternion(1, 2, 3, 4, -1, -3)
+        y = IntegralQuaternion(1, 2, 3, 4, -1, -7)
+        with self.assertRaises(ValueError):
+            x * y
+
+
+if __name__ == "__main__":
+    unittest.main()
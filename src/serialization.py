@@ -0,0 +1,275 @@
+from __future__ import print_function
+
+import json
+
+from sage.algebras.quatalg.quaternion_algebra import quaternion_algebra_cython
+from sage.matrix.constructor import matrix
+from sage.rings.integer_ring import ZZ
+from sage.rings.rational_field import QQ
+
+# A file of ideal records starts with these bytes. The last one is the
+# version of the format. There is only version 1, described below, and files
+# of any other version are rejected.
+MAGIC = b"KPLTIDL\x01"
+
+# Bits of the flags byte of a record.
+HAS_DELTA = 1
+FAILED = 2
+HAS_INFO = 4
+
+# The format of a file of ideal records.
+#
+# After MAGIC, the file is a sequence of records. Each record is its length in
+# bytes as a varint followed by that many bytes:
+#
+#     flags: One byte, see HAS_DELTA, FAILED and HAS_INFO.
+#     Unless flags has FAILED:
+#         d: The common denominator of the basis.
+#         16 integers: The coefficients of the basis times d, row by row. For
+#             the ideals of kplt.py this is the Hermite normal form of the
+#             basis.
+#     If flags has HAS_DELTA: 4 pairs (numerator, denominator), the
+#         coefficients of delta.
+#     If flags has HAS_INFO: A JSON object encoded as UTF-8, preceded by its
+#         length as a varint. kplt_cli.py stores the index of the input
+#         record and the timings or the error in it.
+#
+# A FAILED record stands for an input that has no result, so that the
+# records of an output file stay aligned with the records of the input.
+#
+# A varint is the usual base 128 encoding of a nonnegative integer with the
+# high bit of each byte set on all but the last byte. An integer n is first
+# mapped to 2n if n >= 0 and -2n - 1 if n < 0, and then written as the number
+# of bytes of that as a varint followed by the bytes in little endian order,
+# so small and huge integers are both cheap to encode.
+
+
+def write_varint(out, n):
+    """Appends the varint encoding of n >= 0 to the bytearray out."""
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    """Returns (n, pos) where n is the varint at data[pos:] and pos is the
+    position after it."""
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def write_int(out, n):
+    """Appends the encoding of the integer n to the bytearray out."""
+    n = int(n)
+    n = 2 * n if n >= 0 else -2 * n - 1
+    length = (n.bit_length() + 7) // 8
+    write_varint(out, length)
+    out += n.to_bytes(length, "little")
+
+
+def read_int(data, pos):
+    """Returns (n, pos) where n is the integer at data[pos:]."""
+    length, pos = read_varint(data, pos)
+    n = int.from_bytes(data[pos:pos + length], "little")
+    n = n // 2 if n % 2 == 0 else -(n + 1) // 2
+    return n, pos + length
+
+
+def encode_record(denominator, entries, delta=None, info=None):
+    """Returns the bytes of a record, without its length.
+
+    Args:
+        denominator: A positive integer d, or None for a FAILED record.
+        entries: The 16 integers of the basis times d, or None for a FAILED
+            record.
+        delta: None or 4 pairs of integers (numerator, denominator).
+        info: None or a dict that can be written as JSON.
+    """
+    flags = 0
+    if denominator is None:
+        flags |= FAILED
+    if delta is not None:
+        flags |= HAS_DELTA
+    if info is not None:
+        flags |= HAS_INFO
+    out = bytearray()
+    out.append(flags)
+    if denominator is not None:
+        write_int(out, denominator)
+        for x in entries:
+            write_int(out, x)
+    if delta is not None:
+        for numerator, denom in delta:
+            write_int(out, numerator)
+            write_int(out, denom)
+    if info is not None:
+        text = json.dumps(info, sort_keys=True).encode("utf-8")
+        write_varint(out, len(text))
+        out += text
+    return bytes(out)
+
+
+def decode_record(data):
+    """Returns (denominator, entries, delta, info) as passed to
+    encode_record."""
+    flags = data[0]
+    pos = 1
+    denominator = entries = None
+    if not flags & FAILED:
+        denominator, pos = read_int(data, pos)
+        entries = []
+        for _ in range(16):
+            x, pos = read_int(data, pos)
+            entries.append(x)
+    delta = None
+    if flags & HAS_DELTA:
+        delta = []
+        for _ in range(4):
+            numerator, pos = read_int(data, pos)
+            denom, pos = read_int(data, pos)
+            delta.append((numerator, denom))
+    info = None
+    if flags & HAS_INFO:
+        length, pos = read_varint(data, pos)
+        info = json.loads(data[pos:pos + length].decode("utf-8"))
+    return denominator, entries, delta, info
+
+
+class IdealWriter(object):
+    """Writes ideals, each with an optional element delta, to a binary file.
+
+    Args:
+        f: A file opened for writing in binary mode.
+        header: Whether to start by writing MAGIC. It is False when records
+            are appended to an existing file.
+    """
+
+    def __init__(self, f, header=True):
+        self.f = f
+        self.count = 0
+        if header:
+            f.write(MAGIC)
+
+    def write_record(self, denominator, entries, delta=None, info=None):
+        """Writes a record given as integers, see encode_record."""
+        record = encode_record(denominator, entries, delta, info)
+        out = bytearray()
+        write_varint(out, len(record))
+        self.f.write(bytes(out))
+        self.f.write(record)
+        self.count += 1
+
+    def write(self, I, delta=None, info=None):
+        """Writes the basis of the ideal I and delta if it is not None.
+
+        The basis is written as it is, so an ideal that is read back has the
+        same basis as I. I is None for a FAILED record.
+        """
+        if I is None:
+            self.write_record(None, None, None, info)
+            return
+        Z, d = (quaternion_algebra_cython.
+                integral_matrix_and_denom_from_rational_quaternions(
+                    list(I.basis())))
+        if delta is not None:
+            delta = [
+                (c.numerator(), c.denominator())
+                for c in delta.coefficient_tuple()
+            ]
+        self.write_record(d, Z.list(), delta, info)
+
+
+class IdealReader(object):
+    """Reads the records IdealWriter wrote, one at a time.
+
+    Iterating over a reader yields pairs (I, delta) where I is a left O-ideal
+    and delta is an element of the algebra of O or None. I and delta are
+    both None for a FAILED record. The ideals are built directly from the
+    stored basis with their left order set to O, so nothing is recomputed.
+
+    Args:
+        f: A file opened for reading in binary mode.
+        O: The left order of the ideals. It is only needed to iterate over
+            the reader, not for records().
+    """
+
+    def __init__(self, f, O=None):
+        self.f = f
+        self.O = O
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a file of ideal records.")
+
+    def records(self):
+        """Yields the records as (denominator, entries, delta, info), see
+        decode_record."""
+        while True:
+            length = self.read_length()
+            if length is None:
+                return
+            data = self.f.read(length)
+            if len(data) != length:
+                raise ValueError("The last record is truncated.")
+            yield decode_record(data)
+
+    def read_length(self):
+        """Returns the length of the next record or None at the end."""
+        n = 0
+        shift = 0
+        while True:
+            byte = self.f.read(1)
+            if not byte:
+                if shift:
+                    raise ValueError("The last record is truncated.")
+                return None
+            byte = byte[0]
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def __iter__(self):
+        if self.O is None:
+            raise ValueError("The order O is needed to build the ideals.")
+        B = self.O.quaternion_algebra()
+        for denominator, entries, delta, _ in self.records():
+            if denominator is None:
+                yield None, None
+                continue
+            I = ideal_from_record(self.O, denominator, entries)
+            if delta is not None:
+                delta = B([QQ(n) / d for n, d in delta])
+            yield I, delta
+
+
+def ideal_from_record(O, denominator, entries):
+    """Returns the left O-ideal with the basis of a record.
+
+    The ideal is built directly from the basis with its left order set to
+    O, so nothing is recomputed or checked.
+    """
+    B = O.quaternion_algebra()
+    basis = (quaternion_algebra_cython.
+             rational_quaternions_from_integral_matrix_and_denom(
+                 B, matrix(ZZ, 4, 4, entries), ZZ(denominator)))
+    return B.ideal(basis, left_order=O, check=False)
+
+
+def write_ideals(f, ideals):
+    """Writes pairs (I, delta) to f and returns the number written."""
+    writer = IdealWriter(f)
+    for I, delta in ideals:
+        writer.write(I, delta)
+    return writer.count
+
+
+def read_ideals(f, O):
+    """Yields the pairs (I, delta) stored in f, see IdealReader."""
+    return iter(IdealReader(f, O))
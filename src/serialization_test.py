@@ -0,0 +1,63 @@
+from __future__ import print_function
+
+import io
+import unittest
+
+from sage.all import *
+from kplt import left_ideal
+from serialization import IdealReader
+from serialization import decode_record
+from serialization import encode_record
+from serialization import read_ideals
+from serialization import write_ideals
+
+
+class SerializationTest(unittest.TestCase):
+
+    def test_records(self):
+        entries = [0, 1, -1, 127, 128, -129, 2 ** 200, -(3 ** 150)] * 2
+        for delta in [None, [(1, 2), (-3, 4), (0, 1), (2 ** 100, 7)]]:
+            record = encode_record(4, entries, delta)
+            self.assertEqual(
+                decode_record(record), (4, entries, delta, None)
+            )
+        info = {"index": 3, "error": "ValueError: no prime norm"}
+        record = encode_record(None, None, None, info)
+        self.assertEqual(decode_record(record), (None, None, None, info))
+        record = encode_record(4, entries, None, {"index": 4})
+        self.assertEqual(
+            decode_record(record), (4, entries, None, {"index": 4})
+        )
+
+    def test_ideals(self):
+        B = QuaternionAlgebra(1019)
+        O = B.maximal_order()
+        i, j, k = B.gens()
+        ideals = [
+            (left_ideal([1 + 2 * j + 5 * k, 10007], O), None),
+            (left_ideal([3 + i + k, 11], O), 1 + i / 2 - 3 * k / 5),
+        ]
+        f = io.BytesIO()
+        self.assertEqual(write_ideals(f, ideals + [(None, None)]), 3)
+        f.seek(0)
+        loaded = list(read_ideals(f, O))
+        self.assertEqual(len(loaded), 3)
+        for (I, delta), (J, epsilon) in zip(ideals, loaded):
+            self.assertEqual(list(I.basis()), list(J.basis()))
+            self.assertTrue(J.left_order() == O)
+            self.assertEqual(delta, epsilon)
+        self.assertEqual(loaded[2], (None, None))
+
+    def test_bad_files(self):
+        with self.assertRaises(ValueError):
+            IdealReader(io.BytesIO(b"not a file"))
+        f = io.BytesIO()
+        write_ideals(f, [])
+        f.write(b"\x80")
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            list(IdealReader(f).records())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,277 @@
+from __future__ import print_function
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from time import monotonic
+
+from cache import cache_key
+from cancellation import Budget
+from cancellation import SearchAborted
+from kplt import algebra_context
+from kplt import ell_power_equiv
+from kplt import ell_power_equiv_setup
+from kplt import special_quaternion_algebra
+
+# The setups of ell_power_equiv a worker has computed, by order and ell.
+_setups = {}
+
+
+def warm_worker(primes):
+    """Initializer of the worker processes of EllPowerEquivService.
+
+    Importing this module already imports kplt and the parts of Sage it
+    uses, which takes a few seconds. This also builds the algebra contexts of
+    the given primes.
+    """
+    for p in primes:
+        context = algebra_context(special_quaternion_algebra(p))
+        # The special order is only computed when it is first used.
+        context.O_special
+
+
+def ping():
+    """A task that does nothing, used to make the workers start."""
+    return None
+
+
+def solve(J, O, ell, timeout=None, profile=None, deadline=None):
+    """Runs ell_power_equiv(J, O, ell) with the setup this worker keeps.
+
+    Args:
+        J, O, ell: See kplt.ell_power_equiv.
+        timeout: If not None, the number of seconds the call may take.
+        profile: See kplt.ell_power_equiv.
+        deadline: If not None, the time.monotonic() by which the call has to
+            be done. It is the same clock in every process of a machine.
+    """
+    budget = None
+    if timeout is not None or deadline is not None:
+        budget = Budget(timeout=timeout, deadline=deadline)
+    key = cache_key("setup", [O], O.quaternion_algebra(), ell)
+    setup = _setups.get(key)
+    if setup is None:
+        setup = ell_power_equiv_setup(
+            O, ell, profile=profile, budget=budget
+        )
+        _setups[key] = setup
+    return ell_power_equiv(
+        J, O, ell, setup=setup, profile=profile, budget=budget
+    )
+
+
+def solve_batch(requests):
+    """Solves a batch of requests in a worker process.
+
+    Args:
+        requests: A list of tuples (J, O, ell, deadline) where deadline is
+            the time.monotonic() by which the request has to be done or
+            None. The deadline is absolute, so the time the earlier requests
+            of the batch take counts against it.
+
+    Returns:
+        A list with one entry for each request: the pair (J_2, gamma) that
+        ell_power_equiv returns or the exception it raised.
+    """
+    results = []
+    for J, O, ell, deadline in requests:
+        try:
+            results.append(solve(J, O, ell, deadline=deadline))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def cancel_requests(entries):
+    """Cancels the futures of queue entries that are not done yet."""
+    for _, future in entries:
+        if not future.done():
+            future.cancel()
+
+
+class EllPowerEquivService(object):
+    """An asyncio front end for ell_power_equiv backed by a process pool.
+
+    The workers are started once, when the service starts, and kept, so the
+    cost of importing Sage is paid once per worker and not per request. Each
+    worker also keeps the setup of ell_power_equiv for every (O, ell) it has
+    seen.
+
+    Requests wait in a queue of at most max_pending entries, so callers of
+    ell_power_equiv() wait when the service is overloaded. At most one batch
+    per worker is running at a time. While other workers are idle a request
+    is sent on its own, so requests never wait behind each other while a
+    worker could take them. Only the batch for the last idle worker takes up
+    to batch_size requests, waiting up to batch_delay seconds for it to
+    fill.
+
+    Use it as
+
+        async with EllPowerEquivService(primes=[p]) as service:
+            J_2, gamma = await service.ell_power_equiv(J, O, ell, timeout=60)
+
+    Args:
+        max_workers: The number of worker processes. If None, the number of
+            CPUs.
+        max_pending: The maximum number of requests waiting in the queue.
+        batch_size: The maximum number of requests in a batch.
+        batch_delay: How long to wait for a batch to fill, in seconds.
+        primes: Primes p whose algebra contexts the workers build when they
+            start.
+    """
+
+    def __init__(
+        self,
+        max_workers=None,
+        max_pending=1024,
+        batch_size=8,
+        batch_delay=0.01,
+        primes=(),
+    ):
+        self.max_workers = max_workers or cpu_count() or 1
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.primes = list(primes)
+        self.executor = None
+        self.queue = None
+        self.dispatcher = None
+        self.slots = None
+        self.running = set()
+
+    async def start(self):
+        """Starts the workers and waits until all of them are ready."""
+        loop = asyncio.get_running_loop()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=warm_worker,
+            initargs=(self.primes,),
+        )
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(self.executor, ping)
+                for _ in range(self.max_workers)
+            ]
+        )
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.slots = asyncio.Semaphore(self.max_workers)
+        self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+    async def close(self):
+        """Stops taking requests and waits for the running batches.
+
+        The requests that have not been sent to a worker are cancelled.
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+        while self.queue is not None and not self.queue.empty():
+            cancel_requests([self.queue.get_nowait()])
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def ell_power_equiv(self, J, O, ell, timeout=None):
+        """Returns what kplt.ell_power_equiv(J, O, ell) returns.
+
+        Args:
+            J, O, ell: See kplt.ell_power_equiv.
+            timeout: If not None, the number of seconds the request may take,
+                including the time it waits in the queue. The searches stop
+                when it runs out and SearchAborted is raised.
+        """
+        if self.queue is None:
+            raise RuntimeError("The service has not been started.")
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else monotonic() + timeout
+        future = loop.create_future()
+        await self.queue.put(((J, O, ell, deadline), future))
+        return await future
+
+    async def next_batch(self):
+        """Waits for the next batch of requests from the queue.
+
+        It is a single request if another worker is idle. If the dispatcher
+        is cancelled while the batch fills, the requests already taken from
+        the queue are cancelled, so their callers do not wait forever.
+        """
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            batch.append(await self.queue.get())
+            if not self.slots.locked():
+                return batch
+            end = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self.queue.get(), remaining)
+                    )
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            cancel_requests(batch)
+            raise
+        return batch
+
+    async def dispatch(self):
+        """Sends the batches to the workers until the service is closed."""
+        while True:
+            await self.slots.acquire()
+            try:
+                batch = await self.next_batch()
+            except BaseException:
+                self.slots.release()
+                raise
+            requests = []
+            futures = []
+            for (J, O, ell, deadline), future in batch:
+                if future.cancelled():
+                    continue
+                if deadline is not None and monotonic() >= deadline:
+                    future.set_exception(SearchAborted("deadline", "queue"))
+                    continue
+                requests.append((J, O, ell, deadline))
+                futures.append(future)
+            if not requests:
+                self.slots.release()
+                continue
+            task = asyncio.ensure_future(self.run_batch(requests, futures))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run_batch(self, requests, futures):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, solve_batch, requests
+            )
+        except Exception as e:
+            results = [e] * len(futures)
+        finally:
+            self.slots.release()
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
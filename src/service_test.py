@@ -0,0 +1,68 @@
+from __future__ import print_function
+
+import asyncio
+import unittest
+
+from sage.all import *
+from cancellation import SearchAborted
+from kplt import left_ideal
+from kplt import verify_result
+from service import EllPowerEquivService
+
+
+class EllPowerEquivServiceTest(unittest.TestCase):
+
+    def test_service(self):
+        B = QuaternionAlgebra(59)
+        ell = Integer(3)
+        i, j, k = B.gens()
+        gens = [(1 + k) / 2, (i + j) / 2, j, k]
+        O = B.quaternion_order(gens)
+        alpha = 2 * i - 2 * j + 2 * k
+        ideals = [left_ideal([alpha, n], O) for n in [24, 12, 8]]
+
+        async def run():
+            async with EllPowerEquivService(
+                max_workers=2, batch_size=2, primes=[59]
+            ) as service:
+                results = await asyncio.gather(
+                    *[service.ell_power_equiv(J, O, ell) for J in ideals]
+                )
+                with self.assertRaises(SearchAborted):
+                    await service.ell_power_equiv(ideals[0], O, ell, timeout=0)
+            return results
+
+        results = asyncio.run(run())
+        for J, (J_2, gamma) in zip(ideals, results):
+            self.assertTrue(verify_result(J, O, ell, J_2, gamma))
+
+    def test_close_while_batching(self):
+        B = QuaternionAlgebra(59)
+        O = B.maximal_order()
+        J = O.left_ideal(O.basis()).scale(2)
+
+        async def run():
+            service = EllPowerEquivService(
+                max_workers=1, batch_size=4, batch_delay=60
+            )
+            await service.start()
+            # There is no other idle worker, so the dispatcher holds the
+            # requests it took from the queue while the batch fills.
+            requests = [
+                asyncio.ensure_future(service.ell_power_equiv(J, O, 3))
+                for _ in range(2)
+            ]
+            await asyncio.sleep(0.1)
+            await service.close()
+            return await asyncio.wait_for(
+                asyncio.gather(*requests, return_exceptions=True), 10
+            )
+
+        results = asyncio.run(run())
+        self.assertTrue(
+            all(isinstance(r, asyncio.CancelledError) for r in results)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
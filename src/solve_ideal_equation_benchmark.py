@@ -0,0 +1,101 @@
+from __future__ import print_function
+
+import argparse
+import time
+
+from sage.all import *
+from kplt import element_of_norm
+from kplt import left_ideal
+from kplt import random_combination
+from kplt import set_verification_level
+from kplt import solve_ideal_equation
+
+
+def kernel_solve_ideal_equation(gamma, I, D, N, O):
+    """solve_ideal_equation as it was before IdealEquationContext.
+
+    Builds GF(N) and the algebra over it on every call and solves the
+    system with a general kernel computation.
+    """
+    d, c, _ = xgcd(D, N)
+    a, b = [Integer(x) for x in O.quaternion_algebra().invariants()]
+    F = GF(N)
+    B_ff = QuaternionAlgebra(F, a, b)
+    i_ff, j_ff, k_ff = B_ff.gens()
+
+    def phi(alpha):
+        t, x, y, z = [
+            Integer(coeff) for coeff in (D * c * alpha).coefficient_tuple()
+        ]
+        return t + x * i_ff + y * j_ff + z * k_ff
+
+    gamma_ff_mat = phi(gamma).matrix(action="left")
+    I_basis_ff = [phi(alpha).coefficient_tuple() for alpha in I.basis()]
+    lin_system = matrix(F, [gamma_ff_mat[2], gamma_ff_mat[3]] + I_basis_ff)
+    sol = lin_system.left_kernel().basis()[0]
+    i, j, k = O.quaternion_algebra().gens()
+    return Integer(sol[0]) * j + Integer(sol[1]) * k
+
+
+def ideals_of_norm(O, gamma, N, count):
+    """Returns count left O-ideals of norm N.
+
+    O*gamma*delta + NO has norm N for every delta that is a unit mod N, and
+    different delta give different ideals.
+    """
+    result = []
+    while len(result) < count:
+        delta = random_combination(O.basis())
+        I = left_ideal([gamma * delta, N], O)
+        if I.norm() == N:
+            result.append(I)
+    return result
+
+
+def benchmark(name, fn, pairs):
+    start = time.time()
+    results = [fn(gamma, I) for gamma, I in pairs]
+    elapsed = time.time() - start
+    print(
+        "%-10s %8.3f s %10.1f us/call"
+        % (name, elapsed, 1e6 * elapsed / len(pairs))
+    )
+    return elapsed, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare solve_ideal_equation with a kernel computation."
+    )
+    parser.add_argument("--p", type=int, default=1000003)
+    parser.add_argument("--N", type=int, default=10007)
+    parser.add_argument("--ell", type=int, default=2)
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    set_random_seed(args.seed)
+    D = 4
+    N = Integer(args.N)
+    B = QuaternionAlgebra(args.p)
+    O = B.maximal_order()
+    gamma = element_of_norm(N * Integer(args.ell) ** 20, O)
+    ideals = ideals_of_norm(O, gamma, N, args.count)
+    pairs = [(gamma, I) for I in ideals]
+
+    # Only time the solving, not the checks.
+    set_verification_level("off")
+    print("p = %s, N = %s, %s ideals" % (args.p, N, len(pairs)))
+    kernel_time, kernel_results = benchmark(
+        "kernel",
+        lambda gamma, I: kernel_solve_ideal_equation(gamma, I, D, N, O),
+        pairs,
+    )
+    context_time, context_results = benchmark(
+        "context",
+        lambda gamma, I: solve_ideal_equation(gamma, I, D, N, O),
+        pairs,
+    )
+    for (gamma, I), mu_0 in zip(pairs, context_results):
+        assert mu_0 != 0 and gamma * mu_0 in I
+    print("speedup: %.1fx" % (kernel_time / context_time))